@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+'''
+Serial reader ceiling benchmark
+
+Pushes pre-encoded code_track events into a pty as fast as the kernel takes
+them and measures how fast `scan_serial` (conveyor/session.py) reads, parses
+and queues them over a real pyserial port. This is the reader's upper limit
+independent of any Arduino baud rate.
+
+    python benchmarks/bench_reader.py --events 200000
+'''
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    from Queue import Queue
+else:
+    from queue import Queue
+
+from common import ProcessMeter, print_table
+
+import pty
+import tty
+import serial
+from rig.protocol import encode
+from session import scan_serial, code_track, code_end
+
+columns = ['mode', 'events', 'events_per_s', 'bytes_per_s', 'cpu', 'rss_mb']
+
+
+def make_stream(n, binary):
+    if binary:
+        body = b''.join(encode(code_track, ts, 1) for ts in range(n))
+        return body + encode(code_end, n)
+    body = ''.join('{},{},1\r\n'.format(code_track, ts) for ts in range(n))
+    return (body + '{},{}\r\n'.format(code_end, n)).encode('ascii')
+
+
+def feed(fd, data):
+    view = memoryview(data)
+    while len(view):
+        written = os.write(fd, view[:4096])
+        view = view[written:]
+
+
+def run(n=200000, binary=False):
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    ser = serial.Serial(os.ttyname(slave), timeout=1)
+    data = make_stream(n, binary)
+    q = Queue()
+
+    feeder = threading.Thread(target=feed, args=(master, data))
+    feeder.daemon = True
+    meter = ProcessMeter().start()
+    t0 = time.time()
+    feeder.start()
+    scan_serial(q, ser, binary=binary)
+    elapsed = time.time() - t0
+    meter.stop()
+
+    ser.close()
+    for fd in (master, slave):
+        os.close(fd)
+
+    received = sum(len(batch) for batch in q.queue)
+    return {
+        'mode': 'binary' if binary else 'ascii',
+        'events': received,
+        'events_per_s': received / elapsed,
+        'bytes_per_s': len(data) / elapsed,
+        'cpu': meter.cpu,
+        'rss_mb': meter.rss_peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='scan_serial throughput benchmark')
+    parser.add_argument('--events', type=int, default=200000)
+    args = parser.parse_args()
+
+    results = [run(args.events, binary) for binary in (False, True)]
+    print_table('Reader', results, columns)
+
+
+if __name__ == '__main__':
+    main()
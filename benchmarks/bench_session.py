@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+'''
+End-to-end conveyor session benchmark
+
+Runs a headless Session (conveyor/session.py) against rig.simulator in a
+separate process, so the measured CPU is only the host side: serial
+reading, dispatch and HDF5 storage. For each rate of code_track events
+reports:
+
+    rate            events/s offered by the simulator
+    delivered       fraction of sent events handled
+    lost            events lost, repeated or malformed on the serial link,
+                    from their sequence numbers (see rig/protocol.py)
+    events_per_s    handled events / session length
+    event_p99_ms    serial read -> handled, 99th percentile
+    stop_ms         stop command -> end code handled
+    baud            negotiated baud rate (see rig/baud.py)
+    bytes_per_s     serial bytes received / session length
+    link_load       share of the baud rate those bytes would use on a real
+                    link (10 bits per byte); above 1 the rate can't be
+                    reached with a real Arduino
+    link            'real' if a real link could carry the rate, otherwise
+                    'host only': the pty has no baud limit, so the run is a
+                    stress test of the host side only
+    cpu             % of one core
+    rss_mb          peak resident memory
+    bytes_per_event HDF5 file size / handled events
+
+    python benchmarks/bench_session.py --rates 1000 10000 --duration 5
+'''
+
+import os
+import re
+import sys
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import collections
+
+from common import ROOT, ProcessMeter, print_table
+
+from session import Session, DEFAULT_PARAMETERS
+
+columns = ['rate', 'delivered', 'lost', 'events_per_s', 'event_p99_ms', 'stop_ms',
+           'baud', 'bytes_per_s', 'link_load', 'link', 'cpu', 'rss_mb', 'bytes_per_event']
+
+
+def start_simulator(rate, duration, binary):
+    ''' rig.simulator in a subprocess; returns (process, port) '''
+    cmd = [sys.executable, '-u', '-m', 'rig.simulator',
+           '--track-rate', str(rate), '--duration', str(duration)]
+    if binary:
+        cmd.append('--binary')
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True)
+    port = re.search(r'on (\S+)', proc.stdout.readline()).group(1)
+    return proc, port
+
+
+def run(rate, duration=5000, binary=False, stop_early=False):
+    ''' One session at `rate` events/s for `duration` ms; returns result dict '''
+    parameters = collections.OrderedDict(DEFAULT_PARAMETERS)
+    parameters.update(pre_session=duration, post_session=0, trial_num=0)
+
+    # With stop_early, the session runs forever and is ended by a stop command
+    proc, port = start_simulator(rate, duration * 10 if stop_early else duration, binary)
+    folder = tempfile.mkdtemp()
+    filename = os.path.join(folder, 'bench.h5')
+    try:
+        session = Session(binary=binary, latency=True)
+        if not session.open(port, parameters):
+            raise RuntimeError('Simulator did not respond')
+
+        meter = ProcessMeter().start()
+        session.start(filename)
+        if stop_early:
+            threading.Timer(duration / 1000., session.request_stop).start()
+        try:
+            while session.poll(0.1):
+                meter.sample()
+        finally:
+            # Close the file even if the run fails; its writer thread would keep us alive
+            session.stop()
+        meter.stop()
+
+        out = proc.stdout.readline() + proc.stdout.readline()
+        sent = int(re.search(r'Events sent: (\d+)', out).group(1))
+        sent_bytes = int(re.search(r'Bytes sent: (\d+)', out).group(1))
+        handled = session.dispatcher.handled
+        length = max(session.arduino_end or 0, 1) / 1000.
+        stats = session.latency.stages
+        link_load = sent_bytes * 10 / length / session.baudrate
+        return {
+            'rate': rate,
+            'sent': sent,
+            'delivered': handled / float(sent + 1),     # +1: end code isn't counted as sent
+            'lost': sum(session.loss.totals()),
+            'events_per_s': handled / length,
+            'event_p99_ms': stats['event'].percentile(99) / 1000.,
+            'stop_ms': stats['stop'].max / 1000. if stats['stop'].n else float('nan'),
+            'baud': session.baudrate,
+            'bytes_per_s': sent_bytes / length,
+            'link_load': link_load,
+            'link': 'real' if link_load <= 1 else 'host only',
+            'cpu': meter.cpu,
+            'rss_mb': meter.rss_peak,
+            'bytes_per_event': os.path.getsize(filename) / float(max(handled, 1)),
+        }
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        shutil.rmtree(folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Conveyor session throughput benchmark')
+    parser.add_argument('--rates', type=int, nargs='+', default=[100, 1000, 5000, 20000])
+    parser.add_argument('--duration', type=int, default=5000, help='session length per rate (ms)')
+    parser.add_argument('--binary', action='store_true', help='binary serial protocol')
+    args = parser.parse_args()
+
+    results = [run(rate, args.duration, args.binary) for rate in args.rates]
+    print_table('Session ({})'.format('binary' if args.binary else 'ASCII'), results, columns)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Shared helpers for the benchmarks: process CPU/memory meters, thresholds
+and result tables.
+'''
+
+import os
+import sys
+import json
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'conveyor'))
+
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+
+def rss_mb():
+    ''' Current resident memory of this process (MB) '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+class ProcessMeter(object):
+    ''' CPU (% of one core) and peak RSS of this process between start() and stop() '''
+
+    def start(self):
+        self.t0 = time.time()
+        self.cpu0 = sum(os.times()[:2])
+        self.rss_peak = rss_mb()
+        return self
+
+    def sample(self):
+        self.rss_peak = max(self.rss_peak, rss_mb())
+
+    def stop(self):
+        self.elapsed = time.time() - self.t0
+        self.cpu = 100 * (sum(os.times()[:2]) - self.cpu0) / self.elapsed
+        self.sample()
+        return self
+
+
+def load_thresholds(filename=THRESHOLDS):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def check(name, result, limits):
+    '''Compare `result` against `limits` ({'min_x': v} / {'max_x': v}).
+
+    Returns a list of failure messages.
+    '''
+    failures = []
+    for key, limit in sorted(limits.items()):
+        bound, metric = key.split('_', 1)
+        if metric not in result:
+            continue
+        value = result[metric]
+        if (bound == 'min' and value < limit) or (bound == 'max' and value > limit):
+            failures.append('{}: {} = {:.4g} ({} {})'.format(
+                name, metric, value, 'below' if bound == 'min' else 'above', limit))
+    return failures
+
+
+def print_table(title, results, columns):
+    print(title)
+    print(''.join('{:>16}'.format(c) for c in columns))
+    for result in results:
+        print(''.join('{:>16.4g}'.format(result[c]) if isinstance(result[c], float)
+                      else '{:>16}'.format(result[c]) for c in columns))
+    print('')
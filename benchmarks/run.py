@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+'''
+Benchmark suite
+
+Runs the reader and session benchmarks on a Linux box with no hardware
+(ptys and rig.simulator stand in for the Arduino) and compares the results
+with thresholds.json. Exits with status 1 if any limit is exceeded, so it
+can gate changes to the serial, dispatch or storage paths:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --quick            # shorter sessions, fewer events
+    python benchmarks/run.py --json results.json
+
+Thresholds are {'min_<metric>': value} or {'max_<metric>': value}; session
+limits under "all" apply to every rate, those under "rates" to one rate.
+
+Rates that need more than the negotiated baud rate (link_load above 1, e.g.
+10000 events/s in ASCII) are host-only stress tests: the pty has no baud
+limit, but a real link couldn't carry them. They have no max_link_load and
+are labelled "host only" in the output.
+'''
+
+import sys
+import json
+import argparse
+
+from common import load_thresholds, check, print_table, THRESHOLDS
+import bench_reader
+import bench_session
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run benchmarks and check thresholds')
+    parser.add_argument('--thresholds', default=THRESHOLDS)
+    parser.add_argument('--quick', action='store_true', help='shorter runs (less stable numbers)')
+    parser.add_argument('--binary', action='store_true', help='binary protocol for session runs')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    thresholds = load_thresholds(args.thresholds)
+    failures = []
+    report = {}
+
+    # Reader ceiling
+    events = 50000 if args.quick else 200000
+    results = []
+    for binary in (False, True):
+        result = bench_reader.run(events, binary)
+        results.append(result)
+        failures += check('reader ' + result['mode'], result,
+                          thresholds['reader'].get(result['mode'], {}))
+    print_table('Reader', results, bench_reader.columns)
+    report['reader'] = results
+
+    # Sessions at increasing rates
+    limits = thresholds['session']
+    duration = 2000 if args.quick else limits.get('duration', 5000)
+    results = []
+    for rate in sorted(limits['rates'], key=int):
+        result = bench_session.run(int(rate), duration, args.binary)
+        results.append(result)
+        combined = dict(limits.get('all', {}))
+        combined.update(limits['rates'][rate])
+        failures += check('session {}/s'.format(rate), result, combined)
+
+    # Stop command latency
+    stop = thresholds['stop']
+    result = bench_session.run(stop['rate'], stop.get('duration', 2000), args.binary, stop_early=True)
+    results.append(result)
+    failures += check('stop', result, dict((k, v) for k, v in stop.items() if k.startswith('max_')))
+    print_table('Session', results, bench_session.columns)
+    report['session'] = results
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if failures:
+        print('FAILED')
+        for failure in failures:
+            print('  ' + failure)
+        sys.exit(1)
+    print('All benchmarks within thresholds')
+    stress = ['{}/s'.format(r['rate']) for r in report['session'] if r['link'] != 'real']
+    if stress:
+        print('Host-only stress tests (beyond a real serial link): ' + ', '.join(stress))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,14 @@ Odor presentation
 Creates GUI to control behavioral and imaging devices for in vivo calcium
 imaging. Script interfaces with Arduino microcontroller and imaging devices.
 '''
+import os
 import sys
+
+# Shared rig modules live at the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from rig import startup
+startup.install()     # Time imports until the window is up
+
 is_py2 = sys.version[0] == '2'
 
 import matplotlib
@@ -32,35 +39,38 @@ import collections
 import serial
 import serial.tools.list_ports
 import threading
-from slackclient import SlackClient
 import time
 from datetime import datetime
 from datetime import timedelta
-import os
-import sys
-import h5py
 import numpy as np
 from matplotlib.figure import Figure
 import matplotlib.animation as animation
 from matplotlib.colors import LinearSegmentedColormap
 from matplotlib import style
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
-import seaborn as sns
 
-import pdb
+pdb = startup.lazy_import('pdb')
+
+# Shared rig modules
+from rig.notify import SlackNotifier, SlackClientBackend
+from rig.storage import StorageError
+
+# Session logic (no Tk) lives in session.py
+from session import Session, STREAMS
 
 
 # Setup Slack
+# Messages are sent from a background thread (see rig.notify)
 try:
     slack_token = os.environ['SLACK_API_TOKEN']
 except KeyError:
     print('Environment variable SLACK_API_TOKEN not identified')
     slack = None
 else:
-    slack = SlackClient(slack_token)
-
-# Header to print with Arduino outputs
-arduino_head = '  [a]: '
+    def slack_backend():
+        from slackclient import SlackClient
+        return SlackClientBackend(SlackClient(slack_token))
+    slack = SlackNotifier(slack_backend, username='Conveyor bot')
 
 entry_width = 10
 ew = 10  # Width of Entry UI
@@ -69,15 +79,6 @@ py = 5
 px1 = 5
 py1 = 2
 
-# Serial codes
-code_end = 0
-code_steps = 1
-code_trial_start = 3
-code_trial_man = 4
-code_rail_leave = 5
-code_rail_home = 6
-code_track = 7
-
 
 class InputManager(tk.Frame):
 
@@ -107,6 +108,10 @@ class InputManager(tk.Frame):
         self.var_image_all = tk.BooleanVar()
         self.var_verbose = tk.BooleanVar()
         self.var_print_arduino = tk.BooleanVar()
+        self.var_binary = tk.BooleanVar()
+        self.var_latency = tk.BooleanVar()
+        self.var_latency_readout = tk.StringVar()
+        self.var_loss_readout = tk.StringVar()
         self.var_stop = tk.BooleanVar()
 
         # Lay out GUI
@@ -228,8 +233,16 @@ class InputManager(tk.Frame):
         ## UI for debug options
         self.check_verbose = ttk.Checkbutton(frame_debug, text=' Verbose', variable=self.var_verbose)
         self.check_print = ttk.Checkbutton(frame_debug, text=' Print Arduino output', variable=self.var_print_arduino)
+        self.check_binary = ttk.Checkbutton(frame_debug, text=' Binary serial protocol', variable=self.var_binary)
+        self.check_latency = ttk.Checkbutton(frame_debug, text=' Latency stats', variable=self.var_latency)
+        self.label_latency = tk.Label(frame_debug, textvariable=self.var_latency_readout, anchor='w')
+        self.label_loss = tk.Label(frame_debug, textvariable=self.var_loss_readout, anchor='w')
         self.check_verbose.grid(row=0, column=0, padx=px1, sticky='w')
         self.check_print.grid(row=1, column=0, padx=px1, sticky='w') 
+        self.check_binary.grid(row=2, column=0, padx=px1, sticky='w')
+        self.check_latency.grid(row=3, column=0, padx=px1, sticky='w')
+        self.label_latency.grid(row=4, column=0, padx=px1, sticky='w')
+        self.label_loss.grid(row=5, column=0, padx=px1, sticky='w')
 
         ## Notes
         tk.Label(frame_notes, text='Notes:').grid(row=0, column=0, sticky='w')
@@ -251,7 +264,7 @@ class InputManager(tk.Frame):
         ## Slack
         tk.Label(frame_slack, text='Slack address: ', anchor='w').grid(row=0, column=0, sticky='we')
         self.entry_slack = ttk.Entry(frame_slack)
-        self.button_slack = ttk.Button(frame_slack, command=lambda: slack_msg(self.entry_slack.get(), 'Test', test=True))
+        self.button_slack = ttk.Button(frame_slack, command=self.slack_test)
         self.entry_slack.grid(row=1, column=0, sticky='wens')
         self.button_slack.grid(row=1, column=1, sticky='e')
 
@@ -277,7 +290,9 @@ class InputManager(tk.Frame):
             self.entry_trial_dur,
             self.entry_track_period,
             self.entry_track_steps,
-            self.check_print
+            self.check_print,
+            self.check_binary,
+            self.check_latency
         ]
         # Boolean of objects in list above that should be enabled when time...
         self.obj_enabled_at_open = [False] * len(self.obj_to_disable_at_open)
@@ -317,11 +332,8 @@ class InputManager(tk.Frame):
         self.button_stop['state'] = 'disabled'
 
         ###### SESSION VARIABLES ######
-        self.parameters = collections.OrderedDict()
-        self.ser = serial.Serial(timeout=1, baudrate=9600)
-        self.counter = {}
-        self.q = Queue()
-        self.gui_update_ct = 0  # count number of times GUI has been updated
+        self.session = None
+        self.last_readout = 0
 
     def update_ports(self):
         ports_info = list(serial.tools.list_ports.comports())
@@ -381,7 +393,7 @@ class InputManager(tk.Frame):
 
             self.entry_serial_status['state'] = 'normal'
             self.entry_serial_status.delete(0, 'end')
-            self.entry_serial_status.insert(0, 'Opened')
+            self.entry_serial_status.insert(0, 'Opened ({})'.format(self.session.baudrate))
             self.entry_serial_status['state'] = 'readonly'
 
         elif option == 'close':
@@ -412,7 +424,7 @@ class InputManager(tk.Frame):
             self.entry_serial_status.insert(0, 'Closed')
             self.entry_serial_status['state'] = 'readonly'
 
-    def open_serial(self, delay=3, timeout=5):
+    def open_serial(self, timeout=5):
         ''' Open serial connection to Arduino
         Executes when 'Open' is pressed
         '''
@@ -420,273 +432,123 @@ class InputManager(tk.Frame):
         # Disable GUI components
         self.gui_util('open')
 
-        # Open serial
-        self.ser.port = self.var_port.get()
+        # Define parameters
+        # NOTE: Order is important here since this order is preserved when sending via serial.
+        parameters = collections.OrderedDict()
+        parameters['pre_session'] = int(self.entry_pre_session.get())
+        parameters['post_session'] = int(self.entry_post_session.get())
+        parameters['trial_num'] = int(self.entry_trial_num.get())
+        parameters['trial_duration'] = int(self.entry_trial_dur.get())
+        parameters['iti'] = int(self.entry_iti.get())
+        parameters['img_all'] = int(self.var_image_all.get())
+        parameters['img_ttl_dur'] = int(self.entry_image_ttl_dur.get())
+        parameters['track_period'] = int(self.entry_track_period.get())
+        parameters['track_steps'] = int(self.entry_track_steps.get())
+
+        # Open serial and upload parameters
+        self.session = Session(verbose=self.var_verbose.get(),
+                               print_arduino=self.var_print_arduino.get(),
+                               binary=self.var_binary.get(),
+                               latency=self.var_latency.get())
         try:
-            self.ser.open()
+            opened = self.session.open(self.var_port.get(), parameters, timeout)
         except serial.SerialException as err:
             # Error during serial.open()
             err_msg = err.args[0]
             tkMessageBox.showerror('Serial error', err_msg)
             print('Serial error: ' + err_msg)
             self.close_serial()
-            self.gui_util('close')
             return
-        else:
-            # Serial opened successfully
-            time.sleep(delay)
-            self.gui_util('opened')
-            if self.var_verbose.get(): print('Connection to Arduino opened')
 
-        # Handle opening message from serial
-        if self.var_print_arduino.get():
-            while self.ser.in_waiting:
-                sys.stdout.write(arduino_head + self.ser.readline())
+        if opened:
+            self.gui_util('opened')
         else:
-            self.ser.flushInput()
-
-        # Define parameters
-        # NOTE: Order is important here since this order is preserved when sending via serial.
-        self.parameters['pre_session'] = int(self.entry_pre_session.get())
-        self.parameters['post_session'] = int(self.entry_post_session.get())
-        self.parameters['trial_num'] = int(self.entry_trial_num.get())
-        self.parameters['trial_duration'] = int(self.entry_trial_dur.get())
-        self.parameters['iti'] = int(self.entry_iti.get())
-        self.parameters['img_all'] = int(self.var_image_all.get())
-        self.parameters['img_ttl_dur'] = int(self.entry_image_ttl_dur.get())
-        self.parameters['track_period'] = int(self.entry_track_period.get())
-        self.parameters['track_steps'] = int(self.entry_track_steps.get())
-
-        # Send parameters and make sure it's processed
-        values = self.parameters.values()
-        if self.var_verbose.get(): print('Sending parameters: {}'.format(values))
-        self.ser.write('+'.join(str(s) for s in values))
-
-        start_time = time.time()
-        while 1:
-            if self.ser.in_waiting:
-                if self.var_print_arduino.get():
-                    # Print incoming data
-                    while self.ser.in_waiting:
-                        sys.stdout.write(arduino_head + self.ser.readline())
-                print('Parameters uploaded to Arduino')
-                print('Ready to start')
-                return
-            elif time.time() >= start_time + timeout:
-                print('Error sending parameters to Arduino')
-                print('Uploading timed out. Start signal not found.')
-                self.gui_util('close')
-                self.close_serial()
-                return
+            self.gui_util('close')
     
     def close_serial(self):
         ''' Close serial connection to Arduino '''
-        self.ser.close()
+        if self.session:
+            self.session.close()
         self.gui_util('close')
-        print('Connection to Arduino closed.')
     
     def start(self):
         self.gui_util('start')
 
-        # Clear Queues
-        for q in [self.q]:
-            with q.mutex:
-                q.queue.clear()
-
-        session_length = self.parameters['pre_session'] + self.parameters['post_session'] + self.parameters['iti'] * self.parameters['trial_num']
-        nstepframes = 2 * session_length / float(self.entry_track_period.get())
-
-        # Create data file
-        if self.entry_save.get():
-            try:
-                # Create file if it doesn't already exist ('x' parameter)
-                self.data_file = h5py.File(self.entry_save.get(), 'x')
-            except IOError:
-                tkMessageBox.showerror('File error', 'Could not create file to save data.')
-                self.gui_util('stop')
-                self.gui_util('open')
-                self.gui_util('opened')
-                return
-        else:
-            if not os.path.exists('data'):
-                os.makedirs('data')
-            now = datetime.now()
-            filename = 'data/data-' + now.strftime('%y%m%d-%H%M%S') + '.h5'
-            self.data_file = h5py.File(filename, 'x')
-
-        self.behav_grp = self.data_file.create_group('behavior')
-        self.behav_grp.create_dataset(name='trials', dtype='uint32',
-            shape=(1000, ), chunks=(1, ))
-        self.behav_grp.create_dataset(name='trial_manual', dtype=bool,
-            shape=(1000, ), chunks=(1, ))
-        self.behav_grp.create_dataset(name='rail_leave', dtype='uint32',
-            shape=(1000, ), chunks=(1, ))
-        self.behav_grp.create_dataset(name='rail_home', dtype='uint32',
-            shape=(1000, ), chunks=(1, ))
-        self.behav_grp.create_dataset(name='steps', dtype='int32',
-            shape=(2, int(nstepframes) * 1.1), chunks=(2, 1))
-        self.behav_grp.create_dataset(name='track', dtype='int32',
-            shape=(2, int(nstepframes) * 1.1), chunks=(2, 1))
-
-        # Store session parameters into behavior group
-        for key, value in self.parameters.iteritems():
-            self.behav_grp.attrs[key] = value
-
-        # Create thread to scan serial
-        thread_scan = threading.Thread(
-            target=scan_serial,
-            args=(self.q, self.ser, self.var_print_arduino.get())
-        )
-
-        # Run session
-        start_time = datetime.now()
-        self.start_time = start_time.strftime('%H:%M:%S')
-        print('Session start ~ {}'.format(self.start_time))
-        self.behav_grp.attrs['start_time'] = self.start_time
-
-        self.ser.flushInput()                                   # Remove data from serial input
-        self.ser.write('E')                                     # Start signal for Arduino
-        thread_scan.start()
+        try:
+            self.session.start(self.entry_save.get())
+        except IOError:
+            tkMessageBox.showerror('File error', 'Could not create file to save data.')
+            self.gui_util('stop')
+            self.gui_util('open')
+            self.gui_util('opened')
+            return
 
         # Update GUI
         self.update_session()
 
     def update_session(self):
-        # Checks Queue for incoming data from arduino. Data arrives as comma-separated values with the first element
-        # ('code') defining the type of data.
+        # Handle events from Arduino (see Session.handle)
 
         refresh_rate = 10  # Rate to update GUI. Should be faster than data coming in, eg tracking rate
 
         # End on 'Stop' button (by user)
         if self.var_stop.get():
             self.var_stop.set(False)
-            self.ser.write('0')
-            print('User triggered stop.')
+            self.session.request_stop()
 
-        # Incoming queue has format:
-        #   [code, ts [, extra values...]]
-        while not self.q.empty():
-            q_in = self.q.get()
-            code = q_in[0]
-            ts = q_in[1]
-
-            # stop_session is called only when Arduino sends stop code
-            if code == code_end:
-                arduino_end = ts
-                print('Stopping session.')
-                self.stop_session(arduino_end)
-                return
-
-            elif code == code_trial_start:
-                manual = bool(q_in[2])
-
-                self.behav_grp['trials'][self.counter['trial']] = ts
-                self.behav_grp['trial_manual'][self.counter['trial']] = manual
-
-            elif code == code_rail_leave:
-                self.behav_grp['rail_leave'][self.counter['trial']] = ts
-
-            elif code == code_rail_home:
-                self.behav_grp['rail_home'][self.counter['trial']] = ts
-                self.counter['trial'] += 1
-
-            elif code == code_steps:
-                dist = int(q_in[2])
-
-                # Record tracking
-                self.behav_grp['steps'][:, self.counter['steps']] = [ts, dist]
-                self.counter['steps'] += 1
-
-            elif code == code_track:
-                dist = int(q_in[2])
-
-                # Record tracking
-                self.behav_grp['track'][:, self.counter['track']] = [ts, dist]
+        # stop_session is called only when Arduino sends stop code
+        if not self.session.poll():
+            self.stop_session()
+            return
 
-                # Increment counter
-                self.counter['track'] += 1
+        # Live latency and serial loss readouts, once a second
+        if time.time() - self.last_readout >= 1:
+            self.last_readout = time.time()
+            if self.session.latency:
+                self.var_latency_readout.set(self.session.latency.readout())
+            self.var_loss_readout.set('Serial events ' + self.session.loss.readout(STREAMS))
 
         self.parent.after(refresh_rate, self.update_session)
 
-    def stop_session(self, frame_cutoff=None, arduino_end=None):
-        end_time = datetime.now().strftime('%H:%M:%S')
-        print('Session ended at ' + end_time)
+    def stop_session(self):
         self.gui_util('stop')
-        self.close_serial()
-
-        if self.data_file:
-            print('Writing behavioral data')
-            self.behav_grp.attrs['end_time'] = end_time
-            self.behav_grp['trials'].resize((self.counter['trial'], ))
-            self.behav_grp['trial_manual'].resize((self.counter['trial'], ))
-            self.behav_grp['rail_leave'].resize((self.counter['trial'], ))
-            self.behav_grp['rail_home'].resize((self.counter['trial'], ))
-            self.behav_grp['steps'].resize((2, self.counter['steps']))
-            self.behav_grp['track'].resize((2, self.counter['track']))
-            self.behav_grp.attrs['notes'] = self.scrolled_notes.get(1.0, 'end')
-            self.behav_grp.attrs['arduino_end'] = arduino_end
-
-            # Close HDF5 file object
-            print('Closing file')
-            self.data_file.close()
-        
-        # Clear self.parameters
-        self.parameters = collections.OrderedDict()
-
-        print('All done!')
+        if self.session.latency:
+            self.var_latency_readout.set(self.session.latency.readout())
+        self.var_loss_readout.set('Serial events ' + self.session.loss.readout(STREAMS))
+        try:
+            self.session.stop(notes=self.scrolled_notes.get(1.0, 'end'))
+        except StorageError as err:
+            tkMessageBox.showerror('File error', 'Some data could not be saved:\n{}'.format(err))
+        self.gui_util('close')
 
         # Slack that session is done.
         if (self.entry_slack.get() and \
             slack):
             slack_msg(self.entry_slack.get(), 'Session ended.')
 
+    def slack_test(self):
+        message = slack_msg(self.entry_slack.get(), 'Test')
+        if message:
+            self.after(100, self.slack_test_check, message)
+
+    def slack_test_check(self, message):
+        # Poll test message so the Tk loop never waits on the network
+        if not message.done.is_set():
+            self.after(100, self.slack_test_check, message)
+        elif message.status != 'sent':
+            tkMessageBox.showerror('Slack error', message.error)
 
-def slack_msg(slack_recipient, msg, test=False, verbose=False):
+
+def slack_msg(slack_recipient, msg):
     '''Sends message through Slack
-    Creates Slack message `msg` to `slack_recipient` from Bot.
+    Queues Slack message `msg` to `slack_recipient` from Bot and returns
+    immediately with a Message whose status can be polled.
     '''
 
     if not slack:
         print('No Slack client defined. Check environment variables.')
-    else:
-        bot_username = 'Conveyor bot'
-        bot_icon = ':squirrel:'
-        if test: msg='Test'
-
-        try:
-            slack.api_call(
-              'chat.postMessage',
-              username=bot_username,
-              icon_emoji=bot_icon,
-              channel=slack_recipient,
-              text=msg
-            )
-        except:
-            print('Unable to send Slack message')
-
-
-def scan_serial(q_serial, ser, print_arduino=False, suppress=[]):
-    #  Continually check serial connection for data sent from Arduino. Stop when '0 code' is received.
-
-    code_end = 0
-
-    if print_arduino: print('  Scanning Arduino outputs.')
-    while 1:
-        input_arduino = ser.readline()
-        if not input_arduino: continue
-
-        try:
-            input_split = [int(x) for x in input_arduino.split(',')]
-        except ValueError:
-            # If not all comma-separated values are int castable
-            if print_arduino: sys.stdout.write(arduino_head + input_arduino)
-        else:
-            if print_arduino and input_split[0] not in suppress:
-                sys.stdout.write(arduino_head + input_arduino)
-            if input_arduino: q_serial.put(input_split)
-            if input_split[0] == code_end:
-                if print_arduino: print("  Scan complete.")
-                return
+        return None
+    return slack.send(slack_recipient, msg)
 
 
 def main():
@@ -695,8 +557,13 @@ def main():
     root.wm_title('Conveyor')
     InputManager(root)
     root.grid()
+    root.after_idle(startup.report)
     root.mainloop()
 
+    # Give queued Slack messages a chance to go out
+    if slack:
+        slack.close()
+
 
 if __name__ == '__main__':
     main()
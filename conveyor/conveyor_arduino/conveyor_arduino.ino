@@ -14,12 +14,21 @@ GUI for recording and calculations.
 #define CODEEND 48
 #define STARTCODE 69
 #define CODETRIAL 70
+#define CODESYNC 83       // 'S': clock sync ping (see rig/clock.py)
 #define DELIM ","         // Delimiter used for serial outputs
 #define STEPSHIFT 1       // Scale factor to convert tracking to stepper
 #define CODESTOP 48
 #define CODEFORWARD 49
 #define CODEBACKWARD 50
 #define STEPMAX 127       // Maximum number of steps by stepper
+#define BINARYOUT 0       // 1: send events as binary records (see rig/protocol.py)
+#define FRAMEFLAG 0x80    // Marks first byte of a binary record
+#define SEQDELIM ";"      // Precedes sequence number in serial outputs
+#define CODEBAUD 66       // 'B': baud rate proposal (see rig/baud.py)
+#define BAUDMAX 1000000   // Fastest baud rate offered to the computer
+#define BAUDWAIT 500      // ms to wait for the computer at a new baud rate
+#define CODEPARAMS 80     // 'P': binary parameter block (see rig/protocol.py)
+#define PARAMVERSION 1    // Parameter block layout offered to the computer
 
 
 // Pins
@@ -41,6 +50,7 @@ const int code_trial_start = 3;
 const int code_rail_leave = 5;
 const int code_rail_home = 6;
 const int code_track = 7;
+const int code_sync = 8;
 
 // Variables via serial
 // unsigned long sessionDur;
@@ -57,6 +67,7 @@ unsigned long track_steps;
 // Other variables
 unsigned long ts_next_trial;
 volatile int trackChange = 0;   // Rotations within tracking epochs
+byte seqs[16];                  // Next sequence number of each event code
 
 
 void track() {
@@ -66,11 +77,35 @@ void track() {
 }
 
 
+void sendEvent(byte code, unsigned long ts, long value, boolean hasValue) {
+  // Send event to computer as "code,ts[,value];seq" line or as binary record
+  byte seq = seqs[code & 15]++;   // Per-code sequence number, lets computer count lost events
+#if BINARYOUT
+  byte frame[11];
+  frame[0] = code | FRAMEFLAG;
+  memcpy(frame + 1, &ts, 4);      // AVR/ARM are little-endian
+  memcpy(frame + 5, &value, 4);
+  frame[9] = seq;
+  frame[10] = 0;
+  for (int i = 0; i < 10; i++) frame[10] ^= frame[i];
+  Serial.write(frame, 11);
+#else
+  Serial.print(code);
+  Serial.print(DELIM);
+  Serial.print(ts);
+  if (hasValue) {
+    Serial.print(DELIM);
+    Serial.print(value);
+  }
+  Serial.print(SEQDELIM);
+  Serial.println(seq);
+#endif
+}
+
+
 void endSession(unsigned long ts) {
   // Send "end" signal
-  Serial.print(code_end);
-  Serial.print(DELIM);
-  Serial.println(ts);
+  sendEvent(code_end, ts, 0, false);
   digitalWrite(imgStopPin, HIGH);
 
   // Reset pins
@@ -82,13 +117,69 @@ void endSession(unsigned long ts) {
 }
 
 
+uint16_t crc16(uint16_t crc, const byte *data, int n) {
+  // CRC-16/CCITT, as binascii.crc_hqx() on the computer
+  while (n--) {
+    crc ^= (uint16_t)*data++ << 8;
+    for (int i = 0; i < 8; i++) crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+
+long readParamBlock(unsigned long *values, int count) {
+  // Binary parameter block: 'P', version, count, count x uint32 and the
+  // CRC-16 of everything before it. Returns the CRC, or -1 if the block is
+  // incomplete, has the wrong layout or fails the check.
+  byte header[3];
+  byte check[2];
+  uint16_t crc;
+
+  if (Serial.readBytes(header, 3) < 3) return -1;
+  if (header[0] != CODEPARAMS || header[1] != PARAMVERSION || header[2] != count) return -1;
+  if (Serial.readBytes((byte *)values, 4 * count) < 4 * count) return -1;  // AVR/ARM are little-endian
+  if (Serial.readBytes(check, 2) < 2) return -1;
+
+  crc = crc16(0xFFFF, header, 3);
+  crc = crc16(crc, (byte *)values, 4 * count);
+  if (crc != (check[0] | (uint16_t)check[1] << 8)) return -1;
+  return crc;
+}
+
+
+void discardInput() {
+  // Drop incoming bytes until the line has been quiet for 20 ms
+  unsigned long t = millis();
+  while (millis() - t < 20) {
+    if (Serial.available() > 0) {
+      Serial.read();
+      t = millis();
+    }
+  }
+}
+
+
 // Retrieve parameters from serial
 void getParams() {
   const int paramNum = 9;
   unsigned long parameters[paramNum];
-
-  for (int p = 0; p < paramNum; p++) {
-    parameters[p] = Serial.parseInt();
+  long crc;
+
+  if (Serial.peek() == CODEPARAMS) {
+    // Binary block; ask for it again until it arrives intact
+    while ((crc = readParamBlock(parameters, paramNum)) < 0) {
+      discardInput();
+      Serial.println("P!");
+      while (Serial.available() <= 0);
+    }
+    Serial.print("P");
+    Serial.println(crc);
+  }
+  else {
+    // '+'-joined text from older computer-side code
+    for (int p = 0; p < paramNum; p++) {
+      parameters[p] = Serial.parseInt();
+    }
   }
 
   pre_session = parameters[0];
@@ -119,6 +210,41 @@ void waitForStart() {
 }
 
 
+void negotiateBaud() {
+  // Switch to a faster baud rate if the computer proposes one (see rig/baud.py).
+  // Returns once the next byte isn't a proposal, i.e. parameters are coming.
+  unsigned long rate;
+  unsigned long t0;
+
+  while (1) {
+    while (Serial.available() <= 0);
+    if (Serial.peek() != CODEBAUD) return;
+    Serial.read();
+    rate = Serial.parseInt();
+    Serial.read();              // '\n'
+    if (rate == 0 || rate > BAUDMAX) {
+      Serial.println("B0");
+      continue;
+    }
+
+    // Acknowledge at the old rate, then wait for the computer at the new one
+    Serial.print("B");
+    Serial.println(rate);
+    Serial.flush();
+    Serial.begin(rate);
+    t0 = millis();
+    while (millis() - t0 < BAUDWAIT) {
+      if (Serial.read() == CODEBAUD) {
+        Serial.print("B");
+        Serial.println(rate);
+        return;
+      }
+    }
+    Serial.begin(9600);         // Not confirmed: back to the default rate
+  }
+}
+
+
 void setup() {
   Serial.begin(9600);         // used to communicate with computer
   Serial1.begin(9600);        // used to communicate with conveyor motor
@@ -135,7 +261,12 @@ void setup() {
   // Wait for parameters from serial
   Serial.println("Conveyor\n"
                  "Waiting for parameters...");
-  while (Serial.available() <= 0);
+  Serial.print("Baud: ");
+  Serial.println(BAUDMAX);
+  Serial.print("Params: ");
+  Serial.println(PARAMVERSION);
+  Serial.println("Seq: 1");
+  negotiateBaud();
   getParams();
   Serial.println("Paremeters processed.");
 
@@ -163,6 +294,7 @@ void loop() {
   static unsigned long ts_next_trial = pre_session + iti;
   static unsigned int trial_ix;
 
+  static unsigned long syncCount;       // Clock sync pings answered
   static boolean manual;       // indicates if trial was started manually
   static boolean in_trial;
   static boolean move2mouse;
@@ -190,6 +322,10 @@ void loop() {
       case CODEEND:
         endSession(ts);
         break;
+      case CODESYNC:
+        // Reply right away with a fresh timestamp and the ping's number
+        sendEvent(code_sync, millis() - start, syncCount++, true);
+        break;
     }
   }
 
@@ -199,11 +335,9 @@ void loop() {
     in_trial = true;
     move2mouse = true;
 
-    Serial.print(code_rail_leave);
-    Serial.print(DELIM);
-    Serial.println(ts);
+    sendEvent(code_rail_leave, ts, 0, false);
 
-    Serial1.write((byte)CODEFORWARD)
+    Serial1.write((byte)CODEFORWARD);
 
     trial_ix++;
     if (trial_ix < trial_num) ts_next_trial += iti;
@@ -219,11 +353,7 @@ void loop() {
         actualTrial = true;
         trialStart = ts;
 
-        Serial.print(code_trial_start);
-        Serial.print(DELIM);
-        Serial.print(ts);
-        Serial.print(DELIM);
-        Serial.println(manual);
+        sendEvent(code_trial_start, ts, manual, true);
 
         Serial1.write((byte)CODESTOP);
       }
@@ -248,20 +378,15 @@ void loop() {
         in_trial = false;
         manual = false;
 
-        Serial.print(code_rail_home);
-        Serial.print(DELIM);
-        Serial.println(ts);
+        sendEvent(code_rail_home, ts, 0, false);
 
-        Serial1.write((byte)CODESTOP)
+        Serial1.write((byte)CODESTOP);
       }
     }
   }
 
   // End session
   else if (trial_ix >= trial_num && ! in_trial && ts >= ts_next_trial + post_session) {
-    Serial.println(trial_num);
-    Serial.println(trial_ix);
-    Serial.println(in_trial);
     endSession(ts);
   }
 
@@ -272,11 +397,7 @@ void loop() {
     trackChange = 0;
     
     if (trackOutVal != 0) {
-      Serial.print(code_track);
-      Serial.print(DELIM);
-      Serial.print(ts);
-      Serial.print(DELIM);
-      Serial.println(trackOutVal);
+      sendEvent(code_track, ts, trackOutVal, true);
     }
     
     // Increment nextTractTS for next track stamp
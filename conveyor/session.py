@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+
+'''
+Conveyor session engine
+
+Runs a conveyor session without Tk: uploads parameters to the Arduino,
+starts it, records its events to HDF5 and closes the file when the Arduino
+sends the end code. conveyor.py drives a Session from the Tk loop; run this
+file to run sessions headless from parameter files:
+
+    python session.py params.json --port /dev/ttyACM0
+    python session.py day1.json day2.json --port COM3 --save data/{name}.h5
+
+A parameter file is a JSON object with any of the keys in
+DEFAULT_PARAMETERS; missing keys take the default value.
+
+Under Python 3 the serial port is read by the shared asyncio SerialHub
+(rig/aio.py), which waits on the port without polling and can be cancelled;
+Python 2 falls back to a scan_serial thread.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import collections
+from datetime import datetime
+import serial
+
+is_py2 = sys.version[0] == '2'
+
+# Shared rig modules live at the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from rig import startup
+from rig.baud import BAUD_DEFAULT
+from rig.clock import ClockSync, code_sync, host_time
+from rig.dispatch import EventBatch, EventDispatcher, EventQueue
+from rig.handshake import Handshake
+from rig.latency import LatencyMonitor, now_ns
+from rig.protocol import FrameDecoder, LineDecoder, LossCounter, offered_seq
+from rig.storage import BehaviorWriter, StorageWorker
+if is_py2:
+    SerialHub = None
+else:
+    from rig.aio import SerialHub
+
+h5py = startup.lazy_import('h5py')
+
+
+# Header to print with Arduino outputs
+arduino_head = '  [a]: '
+
+# Serial codes
+code_end = 0
+code_steps = 1
+code_trial_start = 3
+code_trial_man = 4
+code_rail_leave = 5
+code_rail_home = 6
+code_track = 7
+
+# Names of the event streams in loss counts
+STREAMS = {
+    code_end: 'end',
+    code_steps: 'steps',
+    code_trial_start: 'trial',
+    code_trial_man: 'trial_manual',
+    code_rail_leave: 'rail_leave',
+    code_rail_home: 'rail_home',
+    code_track: 'track',
+    code_sync: 'sync',
+}
+
+# NOTE: Order is important here since this order is preserved when sending via serial.
+DEFAULT_PARAMETERS = collections.OrderedDict([
+    ('pre_session', 30000),
+    ('post_session', 30000),
+    ('trial_num', 15),
+    ('trial_duration', 10000),
+    ('iti', 60000),
+    ('img_all', 0),
+    ('img_ttl_dur', 100),
+    ('track_period', 50),
+    ('track_steps', 5),
+])
+
+
+def load_parameters(filename):
+    ''' Read parameters from JSON file, filling in defaults '''
+    with open(filename) as f:
+        values = json.load(f)
+    unknown = set(values) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise ValueError('Unknown parameters in {}: {}'.format(filename, ', '.join(sorted(unknown))))
+
+    parameters = collections.OrderedDict()
+    for key, default in DEFAULT_PARAMETERS.items():
+        parameters[key] = int(values.get(key, default))
+    return parameters
+
+
+def session_duration(parameters):
+    ''' Nominal session length (ms) '''
+    return parameters['pre_session'] + parameters['post_session'] + \
+        parameters['trial_num'] * (parameters['trial_duration'] + parameters['iti'])
+
+
+def simulated_arduino(parameters, binary=False):
+    '''SimulatedArduino (rig/simulator.py) pacing events like `parameters`.
+
+    Trials start after the pre-session period, one every trial_duration + iti.
+    '''
+    from rig.simulator import SimulatedArduino
+    trial_period = parameters['trial_duration'] + parameters['iti']
+    return SimulatedArduino(track_rate=1000. / parameters['track_period'],
+                            trial_rate=1000. / trial_period if trial_period else 0,
+                            trial_start=parameters['pre_session'],
+                            trial_num=parameters['trial_num'],
+                            duration=session_duration(parameters),
+                            binary=binary)
+
+
+class Session(object):
+    '''One Arduino connection and the session(s) run over it.
+
+    Typical use:
+        session.open(port, parameters)
+        session.start(filename)
+        while session.poll(timeout):
+            ...
+        session.stop()
+    '''
+
+    def __init__(self, verbose=False, print_arduino=False, binary=False, stop_timeout=5,
+                 latency=False):
+        self.verbose = verbose
+        self.print_arduino = print_arduino
+        self.binary = binary
+        self.stop_timeout = stop_timeout    # s to wait for the end code after a stop request
+        self.latency = LatencyMonitor() if latency else None    # Per-stage timing (rig/latency.py)
+
+        self.ser = serial.Serial(timeout=1, baudrate=BAUD_DEFAULT)
+        self.baudrate = BAUD_DEFAULT
+        self.connect_time = None
+        self.seq = False                    # Events carry sequence numbers (rig/protocol.py)
+        self.loss = LossCounter()
+        self.parameters = collections.OrderedDict()
+        self.counter = {}
+        self.q = EventQueue()
+        self.dispatcher = EventDispatcher(self.q, latency=self.latency)
+        self.data_file = None
+        self.storage = None
+        self.start_time = ''
+        self.arduino_end = None
+        self.running = False
+        self.reader = None
+        self.stop_requested = None
+        self.clock = ClockSync()
+
+    def open(self, port, parameters, timeout=5):
+        '''Open serial connection and upload `parameters`.
+
+        Waits for the Arduino to boot, negotiates the baud rate and uploads
+        the parameters (see rig/handshake.py); `timeout` (s) applies to each
+        step. Raises serial.SerialException if the port can't be opened.
+        Returns False (with the port closed) if the Arduino didn't respond.
+        '''
+
+        self.ser.port = port
+        self.ser.baudrate = BAUD_DEFAULT         # Arduino resets on open
+        self.ser.open()
+        if self.verbose: print('Connection to Arduino opened')
+
+        # Send parameters and make sure they're processed
+        self.parameters = collections.OrderedDict(parameters)
+        values = list(self.parameters.values())
+        if self.verbose: print('Sending parameters: {}'.format(values))
+        handshake = Handshake(self.ser, values, timeout,
+                              on_text=print_arduino_text if self.print_arduino else None)
+        if not handshake.run():
+            print('Error sending parameters to Arduino')
+            print('Connection failed at {}: {}'.format(handshake.state, handshake.error))
+            self.close()
+            return False
+
+        self.baudrate = handshake.baudrate
+        self.connect_time = handshake.elapsed
+        self.seq = offered_seq(handshake.banner)
+        if self.verbose:
+            print('Connect steps (s): ' + ', '.join(
+                '{} {:.2f}'.format(state, handshake.times[state]) for state in Handshake.STATES[:-1]))
+        print('Parameters uploaded to Arduino ({} baud, connected in {:.2f} s)'.format(
+            self.baudrate, self.connect_time))
+        print('Ready to start')
+        return True
+
+    def close(self):
+        ''' Close serial connection to Arduino '''
+        self.ser.close()
+        print('Connection to Arduino closed.')
+
+    def start(self, filename=None):
+        '''Create data file and start session.
+
+        `filename` defaults to data/data-<date>-<time>.h5. Raises IOError if
+        the file can't be created (e.g. it already exists).
+        '''
+
+        # Clear Queues
+        self.q.clear()
+
+        # Create data file
+        if not filename:
+            if not os.path.exists('data'):
+                os.makedirs('data')
+            now = datetime.now()
+            filename = 'data/data-' + now.strftime('%y%m%d-%H%M%S') + '.h5'
+        # Create file if it doesn't already exist ('x' parameter)
+        self.data_file = h5py.File(filename, 'x')
+
+        self.behav_grp = self.data_file.create_group('behavior')
+        self.writer = BehaviorWriter(self.behav_grp)
+        self.writer.create('trials', 'uint32')
+        self.writer.create('trial_manual', bool)
+        self.writer.create('rail_leave', 'uint32')
+        self.writer.create('rail_home', 'uint32')
+        self.writer.create('steps', 'int32', rows=2)
+        self.writer.create('track', 'int32', rows=2)
+        self.writer.create('sync', 'float64', rows=3)
+
+        # Store session parameters into behavior group
+        for key, value in self.parameters.items():
+            self.behav_grp.attrs[key] = value
+
+        # Initialize counters
+        self.counter = {'trial': 0, 'steps': 0, 'track': 0, 'sync': 0}
+        self.arduino_end = None
+        self.stop_requested = None
+        self.clock.reset()
+
+        # Run session
+        start_time = datetime.now()
+        self.start_time = start_time.strftime('%H:%M:%S')
+        print('Session start ~ {}'.format(self.start_time))
+        self.behav_grp.attrs['start_time'] = self.start_time
+        self.behav_grp.attrs['baudrate'] = self.baudrate
+        self.behav_grp.attrs['connect_time'] = self.connect_time
+
+        self.ser.reset_input_buffer()                           # Remove data from serial input
+        self.ser.write(b'E')                                    # Start signal for Arduino
+        self.dispatcher.reset()
+        self.loss.reset()
+        if self.latency:
+            self.latency.reset()
+        self.storage = StorageWorker(self.data_file, self.writer, self.latency)  # owns data_file from here on
+        self.storage.start()
+        self.start_reader()
+        self.running = True
+
+    def start_reader(self):
+        # Read serial on the asyncio hub if available, otherwise on a thread
+        if SerialHub:
+            on_text = print_arduino_text if self.print_arduino else None
+            self.reader = SerialHub.shared().add(self.ser, self.q, self.binary, on_text, self.latency,
+                                                 self.seq, self.loss)
+        else:
+            thread_scan = threading.Thread(
+                target=scan_serial,
+                args=(self.q, self.ser, self.print_arduino),
+                kwargs={'binary': self.binary, 'latency': self.latency,
+                        'seq': self.seq, 'loss': self.loss}
+            )
+            thread_scan.daemon = True
+            thread_scan.start()
+
+    def request_stop(self):
+        ''' Ask Arduino to end the session; it replies with the end code '''
+        self.ser.write(b'0')
+        self.stop_requested = time.time()
+        if self.latency:
+            self.latency.stop_requested()
+        print('User triggered stop.')
+
+    def poll(self, timeout=None):
+        '''Handle pending events (waiting up to `timeout` s for the first).
+
+        Returns False once the Arduino has sent the end code.
+        '''
+
+        # Periodic clock sync ping (answered with code_sync)
+        if self.running and not self.stop_requested:
+            self.clock.poll(self.ser)
+
+        # Incoming queue has format:
+        #   [code, ts [, extra values...]]
+        for q_in in self.dispatcher.drain(timeout):
+            if not self.handle(q_in):
+                return False
+
+        # Don't hang if the Arduino never acknowledges the stop
+        if self.stop_requested and time.time() - self.stop_requested > self.stop_timeout:
+            print('No end code from Arduino after {} s; stopping session.'.format(self.stop_timeout))
+            self.running = False
+            return False
+        return True
+
+    def handle(self, q_in):
+        code = q_in[0]
+        ts = q_in[1]
+
+        # Session ends only when Arduino sends stop code
+        if code == code_end:
+            if self.latency:
+                self.latency.stop_handled()
+            self.arduino_end = ts
+            self.running = False
+            print('Stopping session.')
+            return False
+
+        elif code == code_trial_start:
+            manual = bool(q_in[2])
+
+            self.storage.write('trials', self.counter['trial'], ts)
+            self.storage.write('trial_manual', self.counter['trial'], manual)
+
+        elif code == code_rail_leave:
+            self.storage.write('rail_leave', self.counter['trial'], ts)
+
+        elif code == code_rail_home:
+            self.storage.write('rail_home', self.counter['trial'], ts)
+            self.counter['trial'] += 1
+
+        elif code == code_steps:
+            dist = int(q_in[2])
+
+            # Record tracking
+            self.storage.write('steps', self.counter['steps'], (ts, dist))
+            self.counter['steps'] += 1
+
+        elif code == code_track:
+            dist = int(q_in[2])
+
+            # Record tracking
+            self.storage.write('track', self.counter['track'], (ts, dist))
+            self.counter['track'] += 1
+
+        elif code == code_sync:
+            sample = self.clock.echo(q_in)
+            if sample:
+                self.storage.write('sync', self.counter['sync'], sample)
+                self.counter['sync'] += 1
+
+        return True
+
+    def stop(self, notes=''):
+        '''Close serial connection and finish writing data file.
+
+        Raises StorageError (rig/storage.py) if data was lost while writing.
+        '''
+        end_time = datetime.now().strftime('%H:%M:%S')
+        print('Session ended at ' + end_time)
+        self.running = False
+        if self.reader:
+            # Release the port before closing it
+            self.reader.cancel()
+            self.reader = None
+        self.close()
+
+        if self.data_file:
+            # Finish writing on storage thread: flush, trim to counters, attrs, close
+            print('Writing behavioral data')
+            behav_attrs = {
+                'end_time': end_time,
+                'notes': notes,
+                'arduino_end': self.arduino_end if self.arduino_end is not None else -1,
+            }
+            behav_attrs.update(self.dispatcher.stats())
+            behav_attrs.update(self.clock.fit())
+            behav_attrs.update(self.loss.summary(STREAMS))
+            if self.loss.totals() != (0, 0, 0):
+                print('Serial events ' + self.loss.readout(STREAMS))
+            if self.latency:
+                behav_attrs.update(self.latency.summary())
+            try:
+                self.storage.close(
+                    resize={
+                        'behavior/trials': (self.counter['trial'], ),
+                        'behavior/trial_manual': (self.counter['trial'], ),
+                        'behavior/rail_leave': (self.counter['trial'], ),
+                        'behavior/rail_home': (self.counter['trial'], ),
+                        'behavior/steps': (2, self.counter['steps']),
+                        'behavior/track': (2, self.counter['track']),
+                        'behavior/sync': (3, self.counter['sync']),
+                    },
+                    attrs={'behavior': behav_attrs}
+                )
+            finally:
+                self.data_file = None
+
+        # Clear parameters
+        self.parameters = collections.OrderedDict()
+        print('All done!')
+
+    def run(self, timeout=0.1, notes=''):
+        '''Block until the session ends, handling events as they arrive, then stop() it.
+
+        Returns early (after asking the Arduino to stop) on KeyboardInterrupt.
+        The session is stopped and its data file finished on any exception.
+        '''
+        stopping = False
+        try:
+            while 1:
+                try:
+                    if not self.poll(timeout):
+                        return
+                except KeyboardInterrupt:
+                    if stopping:
+                        return
+                    stopping = True
+                    self.request_stop()
+        finally:
+            self.stop(notes)
+
+
+def print_arduino_text(text):
+    sys.stdout.write(''.join(arduino_head + line + '\n' for line in text.splitlines()))
+
+
+def scan_serial(q_serial, ser, print_arduino=False, suppress=[], binary=False, latency=None,
+                seq=False, loss=None):
+    #  Continually check serial connection for data sent from Arduino. Stop when '0 code' is received.
+    #  Reads whatever the port has buffered (text lines or binary records, see rig/protocol.py) and
+    #  queues the events parsed from each read as one EventBatch. Lost events are counted in `loss`.
+
+    if print_arduino: print('  Scanning Arduino outputs.')
+    decoder = FrameDecoder(seq, loss) if binary else LineDecoder(loss)
+
+    while 1:
+        try:
+            data = ser.read(ser.in_waiting or 1)
+        except (serial.SerialException, TypeError):
+            # Port closed under us (session stopped without an end code)
+            return
+        if not data: continue
+        t_read = now_ns() if latency else 0
+
+        events, text = decoder.decode(data)
+        if binary: events = events.tolist()
+        if print_arduino:
+            for event in events:
+                if event[0] not in suppress:
+                    sys.stdout.write(arduino_head + ','.join(str(x) for x in event) + '\n')
+            if text: sys.stdout.write(arduino_head + text)
+        if not events: continue
+
+        batch = EventBatch()
+        for event in events:
+            if event[0] == code_sync: event = list(event) + [host_time()]
+            batch.append(event)
+            if event[0] == code_end: break
+        if latency:
+            latency.stamp(batch, t_read)
+            latency.add('parse', now_ns() - t_read)
+        q_serial.put(batch)
+
+        if batch[-1][0] == code_end:
+            if print_arduino: print('  Scan complete.')
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run conveyor sessions without the GUI')
+    parser.add_argument('params', nargs='+', help='JSON parameter file(s); run in order')
+    parser.add_argument('--port', help='Arduino serial port')
+    parser.add_argument('--save', help="data file; '{name}' is replaced by the parameter file's name "
+                                       "(default: data/data-<date>-<time>.h5)")
+    parser.add_argument('--notes', default='', help='notes stored with each session')
+    parser.add_argument('--binary', action='store_true', help='binary serial protocol')
+    parser.add_argument('--print-arduino', action='store_true', help='print Arduino output')
+    parser.add_argument('--latency', action='store_true', help='time each stage of event handling')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--simulate', action='store_true', help='use a simulated Arduino (rig.simulator)')
+    args = parser.parse_args()
+
+    if not (args.port or args.simulate):
+        parser.error('--port is required unless --simulate is given')
+
+    # Check all files before running anything
+    batch = []
+    for filename in args.params:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        batch.append((name, load_parameters(filename), args.save.format(name=name) if args.save else None))
+    saves = [save for _, _, save in batch if save]
+    if len(set(saves)) < len(saves):
+        parser.error("--save gives the same file for several parameter files; include '{name}'")
+
+    for name, parameters, save in batch:
+        print('=== {} ==='.format(name))
+
+        sim = None
+        port = args.port
+        if args.simulate:
+            sim = simulated_arduino(parameters, args.binary)
+            sim.start()
+            port = sim.port
+
+        session = Session(verbose=args.verbose, print_arduino=args.print_arduino, binary=args.binary,
+                          latency=args.latency)
+        try:
+            if not session.open(port, parameters):
+                sys.exit(1)
+            session.start(save)
+            session.run(notes=args.notes)
+            if session.latency:
+                print('Latency ' + session.latency.readout())
+        finally:
+            if sim:
+                sim.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+'''
+Multi-rig supervisor
+
+Runs conveyor sessions on several rigs from one process, with one dashboard
+for all of them. Each rig is a Session (session.py) with its own serial port
+and HDF5 file; under Python 3 all ports are read by the shared asyncio
+SerialHub, so a rig adds a queue and a storage thread rather than a whole
+GUI and interpreter.
+
+Rigs are listed in a JSON file:
+
+    {
+        "rigs": [
+            {"name": "box1", "port": "COM3", "params": "day1.json"},
+            {"name": "box2", "port": "COM4", "params": {"trial_num": 20}},
+        ],
+        "save": "data/{name}-{date}.h5"
+    }
+
+`params` is a parameter file (see session.py) or the parameters themselves.
+`save` may also be given per rig; '{name}' and '{date}' are filled in.
+
+    python supervisor.py rigs.json              # dashboard
+    python supervisor.py rigs.json --headless   # print status instead
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import collections
+from datetime import datetime
+import serial
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    import Tkinter as tk
+    import ttk
+else:
+    import tkinter as tk
+    import tkinter.ttk as ttk
+
+# Shared rig modules live at the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from session import Session, DEFAULT_PARAMETERS, load_parameters, simulated_arduino
+
+
+default_save = 'data/{name}-{date}.h5'
+
+# Columns of the dashboard / headless status table
+columns = collections.OrderedDict([
+    ('port', 'Port'),
+    ('state', 'State'),
+    ('trial', 'Trial'),
+    ('steps', 'Steps'),
+    ('track', 'Track'),
+    ('queue', 'Queue'),
+    ('lag', 'Lag (ms)'),
+    ('lost', 'Lost'),
+    ('file', 'File'),
+])
+
+
+class Rig(object):
+    '''One behavior box: a Session plus its port, parameters and data file.
+
+    States: closed -> opening -> ready -> running -> stopping -> done,
+    or error (see `message`).
+    '''
+
+    def __init__(self, name, port, parameters, save=default_save,
+                 binary=False, print_arduino=False, simulate=False):
+        self.name = name
+        self.port = port
+        self.parameters = parameters
+        self.save = save
+        self.simulate = simulate
+        self.session = Session(print_arduino=print_arduino, binary=binary)
+        self.sim = None
+        self.filename = ''
+        self.state = 'closed'
+        self.message = ''
+
+    def open(self):
+        ''' Open port and upload parameters (blocks for a few s) '''
+        self.state = 'opening'
+        port = self.port
+        if self.simulate:
+            self.sim = simulated_arduino(self.parameters, self.session.binary)
+            self.sim.start()
+            port = self.sim.port
+
+        try:
+            opened = self.session.open(port, self.parameters)
+        except serial.SerialException as err:
+            self.fail('Serial error: {}'.format(err))
+            return
+        if opened:
+            self.state = 'ready'
+        else:
+            self.fail('No response to parameters')
+
+    def start(self):
+        if self.state != 'ready':
+            return
+        date = datetime.now().strftime('%y%m%d-%H%M%S')
+        self.filename = self.save.format(name=self.name, date=date)
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        try:
+            self.session.start(self.filename)
+        except IOError as err:
+            self.session.close()
+            self.fail('File error: {}'.format(err))
+            return
+        self.state = 'running'
+
+    def request_stop(self):
+        if self.state == 'running':
+            self.state = 'stopping'
+            self.session.request_stop()
+
+    def poll(self):
+        ''' Handle pending events; finishes the session on the end code '''
+        if self.state not in ('running', 'stopping'):
+            return
+        if not self.session.poll():
+            try:
+                self.session.stop()
+            except IOError as err:
+                self.fail('Storage error: {}'.format(err))
+                return
+            self.state = 'done'
+            self.release()
+
+    def fail(self, message):
+        print('[{}] {}'.format(self.name, message))
+        self.state = 'error'
+        self.message = message
+        self.release()
+
+    def release(self):
+        if self.sim:
+            self.sim.close()
+            self.sim = None
+
+    def status(self):
+        dispatcher = self.session.dispatcher
+        active = self.state in ('running', 'stopping')
+        counter = self.session.counter
+        return {
+            'port': self.port if not self.simulate else '(simulated)',
+            'state': self.message if self.state == 'error' else self.state,
+            'trial': counter.get('trial', ''),
+            'steps': counter.get('steps', ''),
+            'track': counter.get('track', ''),
+            'queue': dispatcher.depth if active else '',
+            'lag': int(dispatcher.lag) if active else '',
+            'lost': sum(self.session.loss.totals()),
+            'file': self.filename,
+        }
+
+
+class Supervisor(object):
+    ''' A set of rigs driven from one loop '''
+
+    def __init__(self, rigs):
+        self.rigs = collections.OrderedDict((rig.name, rig) for rig in rigs)
+        self.cpu = CpuMeter()
+
+    def open_all(self):
+        # Opening waits on each Arduino's reset, so open in parallel
+        threads = []
+        for rig in self.rigs.values():
+            if rig.state in ('closed', 'done', 'error'):
+                thread = threading.Thread(target=rig.open)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        return threads
+
+    def start_all(self):
+        for rig in self.rigs.values():
+            rig.start()
+
+    def stop_all(self):
+        for rig in self.rigs.values():
+            rig.request_stop()
+
+    def poll(self):
+        for rig in self.rigs.values():
+            rig.poll()
+
+    def busy(self):
+        return any(rig.state in ('opening', 'running', 'stopping') for rig in self.rigs.values())
+
+    def close(self):
+        for rig in self.rigs.values():
+            if rig.state == 'ready':
+                rig.session.close()
+            rig.release()
+
+    def run(self, interval=0.01, report=5):
+        ''' Run all rigs without a GUI, printing status every `report` s '''
+        for thread in self.open_all():
+            thread.join()
+        self.start_all()
+
+        last_report = time.time()
+        stopping = False
+        while self.busy():
+            try:
+                self.poll()
+                if time.time() - last_report > report:
+                    last_report = time.time()
+                    self.print_status()
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                if stopping:
+                    break
+                stopping = True
+                self.stop_all()
+        self.print_status()
+        self.close()
+
+    def print_status(self):
+        header = '{:<10}'.format('Rig') + ''.join('{:>12}'.format(c) for c in list(columns.values())[:-1])
+        print(header)
+        for name, rig in self.rigs.items():
+            status = rig.status()
+            print('{:<10}'.format(name) + ''.join('{:>12}'.format(status[c]) for c in list(columns)[:-1]))
+        print('CPU {:.0f}%'.format(self.cpu.percent()))
+
+
+class CpuMeter(object):
+    ''' Process CPU usage (% of one core) since the previous call '''
+
+    def __init__(self):
+        self.last = (time.time(), self.cpu_time())
+
+    @staticmethod
+    def cpu_time():
+        times = os.times()
+        return times[0] + times[1]
+
+    def percent(self):
+        now, cpu = time.time(), self.cpu_time()
+        elapsed = now - self.last[0]
+        usage = 100 * (cpu - self.last[1]) / elapsed if elapsed > 0 else 0
+        self.last = (now, cpu)
+        return usage
+
+
+class Dashboard(tk.Frame):
+    ''' One row per rig with its state and counters '''
+
+    refresh_rate = 10       # ms between polls of the rigs
+    status_rate = 500       # ms between table updates
+
+    def __init__(self, parent, supervisor):
+        tk.Frame.__init__(self, parent)
+        self.parent = parent
+        self.supervisor = supervisor
+        parent.columnconfigure(0, weight=1)
+        parent.rowconfigure(0, weight=1)
+
+        self.table = ttk.Treeview(parent, columns=list(columns), height=max(len(supervisor.rigs), 4))
+        self.table.heading('#0', text='Rig')
+        self.table.column('#0', width=80)
+        for key, title in columns.items():
+            self.table.heading(key, text=title)
+            self.table.column(key, width=240 if key == 'file' else 80, anchor='e' if key != 'file' else 'w')
+        for name in supervisor.rigs:
+            self.table.insert('', 'end', iid=name, text=name)
+        self.table.grid(row=0, column=0, sticky='wens', padx=15, pady=5)
+
+        frame_buttons = tk.Frame(parent)
+        frame_buttons.grid(row=1, column=0, sticky='we', padx=15, pady=5)
+        self.button_open = ttk.Button(frame_buttons, text='Open all', command=self.supervisor.open_all)
+        self.button_start = ttk.Button(frame_buttons, text='Start all', command=self.supervisor.start_all)
+        self.button_stop = ttk.Button(frame_buttons, text='Stop selected', command=self.stop_selected)
+        self.button_stop_all = ttk.Button(frame_buttons, text='Stop all', command=self.supervisor.stop_all)
+        self.button_open.grid(row=0, column=0, sticky='we')
+        self.button_start.grid(row=0, column=1, sticky='we')
+        self.button_stop.grid(row=0, column=2, sticky='we')
+        self.button_stop_all.grid(row=0, column=3, sticky='we')
+        self.var_cpu = tk.StringVar()
+        tk.Label(frame_buttons, textvariable=self.var_cpu).grid(row=0, column=4, padx=15)
+
+        self.last_status = 0
+        self.update_rigs()
+
+    def stop_selected(self):
+        for name in self.table.selection():
+            self.supervisor.rigs[name].request_stop()
+
+    def update_rigs(self):
+        self.supervisor.poll()
+
+        now = time.time()
+        if (now - self.last_status) * 1000 >= self.status_rate:
+            self.last_status = now
+            for name, rig in self.supervisor.rigs.items():
+                status = rig.status()
+                self.table.item(name, values=[status[key] for key in columns])
+            self.var_cpu.set('CPU: {:.0f}%'.format(self.supervisor.cpu.percent()))
+
+        self.parent.after(self.refresh_rate, self.update_rigs)
+
+
+def load_rigs(filename, binary=False, print_arduino=False, simulate=False):
+    ''' Rigs from a supervisor configuration file (see module docstring) '''
+    with open(filename) as f:
+        config = json.load(f)
+    folder = os.path.dirname(os.path.abspath(filename))
+
+    rigs = []
+    for entry in config['rigs']:
+        params = entry.get('params', {})
+        if isinstance(params, dict):
+            parameters = collections.OrderedDict(
+                (key, int(params.get(key, default))) for key, default in DEFAULT_PARAMETERS.items())
+        else:
+            parameters = load_parameters(os.path.join(folder, params))
+        if not (entry.get('port') or simulate):
+            raise ValueError('No port given for rig {}'.format(entry['name']))
+        rigs.append(Rig(entry['name'], entry.get('port'), parameters,
+                        save=entry.get('save', config.get('save', default_save)),
+                        binary=entry.get('binary', binary),
+                        print_arduino=print_arduino, simulate=simulate))
+
+    names = [rig.name for rig in rigs]
+    if len(set(names)) != len(names):
+        raise ValueError('Rig names must be unique')
+    return rigs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run conveyor sessions on several rigs')
+    parser.add_argument('config', help='JSON file listing rigs')
+    parser.add_argument('--headless', action='store_true', help='no dashboard; start all rigs and print status')
+    parser.add_argument('--binary', action='store_true', help='binary serial protocol (unless set per rig)')
+    parser.add_argument('--print-arduino', action='store_true', help='print Arduino output')
+    parser.add_argument('--simulate', action='store_true', help='use simulated Arduinos (rig.simulator)')
+    args = parser.parse_args()
+
+    supervisor = Supervisor(load_rigs(args.config, args.binary, args.print_arduino, args.simulate))
+    if args.headless:
+        supervisor.run()
+        return
+
+    root = tk.Tk()
+    root.wm_title('Conveyor supervisor')
+    Dashboard(root, supervisor)
+    root.mainloop()
+
+    # Window closed: end running sessions so their files are complete
+    supervisor.stop_all()
+    while supervisor.busy():
+        supervisor.poll()
+        time.sleep(0.01)
+    supervisor.close()
+
+
+if __name__ == '__main__':
+    main()
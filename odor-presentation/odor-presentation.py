@@ -6,8 +6,14 @@ Odor presentation
 Creates GUI to control behavioral and imaging devices for in vivo calcium
 imaging. Script interfaces with Arduino microcontroller and imaging devices.
 """
-# import os
-# if os.name == 'nt':
+import os
+import sys
+
+# Shared rig modules live at the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from rig import startup
+startup.install()     # Time imports until the window is up
+
 import matplotlib
 matplotlib.use('TKAgg')
 import Tkinter as tk
@@ -19,13 +25,10 @@ import serial
 import serial.tools.list_ports
 import threading
 from Queue import Queue
-from slacker import Slacker
 import time
 from datetime import datetime
 from datetime import timedelta
-import os
-import sys
-import h5py
+h5py = startup.lazy_import('h5py')
 import numpy as np
 # import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
@@ -33,64 +36,88 @@ import matplotlib.animation as animation
 from matplotlib.colors import LinearSegmentedColormap
 from matplotlib import style
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
-import seaborn as sns
-# from PIL import Image, ImageTk
-from instrumental import instrument, list_instruments
-import pdb
+from PIL import Image, ImageTk
+instrumental = startup.lazy_import('instrumental')
+pdb = startup.lazy_import('pdb')
+
+# Shared rig modules
+from rig.baud import BAUD_DEFAULT
+from rig.clock import ClockSync, code_sync, host_time
+from rig.dispatch import EventBatch, EventDispatcher, EventQueue
+from rig.handshake import Handshake
+from rig.latency import LatencyMonitor, now_ns
+from rig.protocol import FrameDecoder, LineDecoder, LossCounter, offered_seq
+from rig.storage import BehaviorWriter, StorageError, StorageWorker
+from rig.camera import FrameWriter, available_codecs, create_frame_dataset, DEFAULT_LEVEL
+from rig.simulator import SimulatedArduino, SimulatedCamera
+from rig.notify import SlackNotifier, SlackerBackend
+from rig.plotting import RollingTrace
+from rig.preview import PreviewGrabber
 
 
 # Setup Slack
 # Token is stored in text file defined by 'key_file'
+# Messages are sent from a background thread (see rig.notify)
 key_file = os.path.join(os.path.expanduser('~'), '.slack')
 if os.path.isfile(key_file):
-    with open(key_file, 'r') as kf:
-        slack = Slacker(kf.read())
+    def slack_backend():
+        from slacker import Slacker
+        with open(key_file, 'r') as kf:
+            return SlackerBackend(Slacker(kf.read()))
+    slack = SlackNotifier(slack_backend, username="Odor conveyor bot")
 else:
     slack = None
 
 history = 10000
+
+# Names of the event streams in loss counts (codes as in update_session)
+STREAMS = {0: 'end', 1: 'steps', 3: 'trial', 4: 'trial_manual', 5: 'rail_leave',
+           6: 'rail_home', 7: 'track', code_sync: 'sync'}
 # subsamp = {1: 1,
 #            2: 2,
 #            3: 4,
 #            4: 8}
 
 
-def record(q_in, q_out, ts,
-           cam, frames,
+def record(q_in, q_out,
+           cam, ring, writer,
            frame_dur, session_length):
     
-    # Grabs frames from `cam` object.
+    # Grabs frames from `cam` object into `ring`. Frames are written to disk
+    # by `writer` on a separate thread. Number written and host time of the
+    # start (frame timestamps are ms from it) are returned via q_out.
 
     print("Recording...")
-    start_time = time.clock()
-    nframes = len(ts)
+    start_time = host_time()
+    last_frame = None
 
-    f = 0
-    while (time.clock() - start_time < session_length and
-           f < nframes):
+    writer.start()
+    while host_time() - start_time < session_length:
 
         # Look for stop signal
         if not q_in.empty():
             if q_in.get() == 0:
-                print("Camera recording stopped: {}".format(time.clock() - start_time))
-                q_out.put(f)
-                return
+                print("Camera recording stopped: {}".format(host_time() - start_time))
+                break
 
         # Wait for start of next frame
-        # while time.clock() < next_frame:
-        #     pass
         cam.wait_for_frame()
 
         # Record frame and timestamp
-        ts[f] = (time.clock() - start_time) * 1000
-        frames[f, ...] = cam.latest_frame()
-        
-        # Increment timer/counter
-        # next_frame += frame_dur
-        f += 1
+        now = host_time()
+        if last_frame is not None and now - last_frame > 1.5 * frame_dur:
+            ring.late += 1
+        last_frame = now
+        ring.push(cam.latest_frame(), (now - start_time) * 1000)
+    else:
+        print("Recording limit reached: {}".format(host_time() - start_time))
 
-    print("Recording limit reached: {}".format(time.clock() - start_time))
-    q_out.put(f)
+    # Let writer drain remaining frames
+    ring.close()
+    writer.join()
+    if ring.dropped or ring.late:
+        print("Camera: {} frames dropped, {} late".format(ring.dropped, ring.late))
+    q_out.put((writer.written, start_time))
 
 
 class InputManager(tk.Frame):
@@ -143,19 +170,16 @@ class InputManager(tk.Frame):
         self.frame_preview = tk.Frame(session_frame)
         self.frame_preview.grid(row=0, column=0, sticky='wens')
 
-        # self.fig_preview, self.ax_preview = plt.subplots(figsize=(1280./1024 * 2.5, 2.5))
-        self.fig_preview = Figure(figsize=(1280./1024 * 2.5, 2.5))
-        self.ax_preview = self.fig_preview.add_axes([0, 0, 1, 1])
-        self.fig_preview.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
-        self.im = self.ax_preview.imshow(np.zeros((1024, 1280)), vmin=1, vmax=254, cmap='gray', interpolation='none')
-        self.im.cmap.set_under('b')
-        self.im.cmap.set_over('r')
-        self.ax_preview.axis('image')
-        self.ax_preview.axis('off')
-        self.canvas_preview = FigureCanvasTkAgg(self.fig_preview, self.frame_preview)
-        self.canvas_preview.show()
-        self.canvas_preview.draw()
-        self.canvas_preview.get_tk_widget().grid(row=0, column=0, sticky='wens')
+        # Frames are downsampled on a grabber thread and pasted into a PhotoImage
+        # Saturated pixels are shown red, zeros blue
+        self.preview_size = (256, 320)
+        self.photo_preview = ImageTk.PhotoImage('RGB', self.preview_size[::-1])
+        self.label_preview = tk.Label(self.frame_preview, image=self.photo_preview, bg='black',
+            width=self.preview_size[1], height=self.preview_size[0])
+        self.label_preview.grid(row=0, column=0, sticky='wens')
+        self.var_preview_fps = tk.StringVar()
+        tk.Label(self.frame_preview, textvariable=self.var_preview_fps, anchor='e')\
+            .grid(row=1, column=0, sticky='we')
 
         ## UI for trial control
         session_prop_frame = tk.Frame(session_frame)
@@ -207,6 +231,8 @@ class InputManager(tk.Frame):
         self.var_gain = tk.IntVar()
         self.var_expo = tk.IntVar()
         self.var_instr = tk.StringVar()
+        self.var_codec = tk.StringVar()
+        self.var_level = tk.IntVar()
 
         self.option_instr = tk.OptionMenu(self.frame_cam,
             self.var_instr, [])
@@ -222,6 +248,16 @@ class InputManager(tk.Frame):
         self.button_refresh_instr.grid(row=2, column=0, padx=px1, pady=py1, sticky='we')
         self.button_preview.grid(row=2, column=1, padx=px1, pady=py1, sticky='we')
         self.button_settings.grid(row=2, column=2, padx=px1, pady=py1, sticky='we')
+
+        frame_codec = tk.Frame(self.frame_cam)
+        frame_codec.grid(row=3, column=0, columnspan=3, sticky='we')
+        tk.Label(frame_codec, text="Compression:").grid(row=0, column=0, sticky='e', padx=px1)
+        self.option_codec = tk.OptionMenu(frame_codec, self.var_codec, *available_codecs())
+        self.option_codec.grid(row=0, column=1, sticky='we', padx=px1)
+        tk.Label(frame_codec, text="Level:").grid(row=0, column=2, sticky='e', padx=px1)
+        self.spin_level = tk.Spinbox(frame_codec, from_=0, to=9, width=3,
+            textvariable=self.var_level)
+        self.spin_level.grid(row=0, column=3, sticky='w', padx=px1)
         self.instrument_panels = [
             self.option_instr,
             self.button_refresh_instr,
@@ -268,16 +304,28 @@ class InputManager(tk.Frame):
         self.print_var = tk.BooleanVar()
         self.var_sim_cam = tk.BooleanVar()
         self.var_sim_arduino = tk.BooleanVar()
+        self.var_binary = tk.BooleanVar()
+        self.var_latency = tk.BooleanVar()
+        self.var_latency_readout = tk.StringVar()
+        self.var_loss_readout = tk.StringVar()
 
         self.check_print = tk.Checkbutton(debug_frame, text=" Print Arduino output", variable=self.print_var)
         self.check_sim_cam = tk.Checkbutton(debug_frame, text=" Simulate camera", variable=self.var_sim_cam)
         self.check_sim_arduino = tk.Checkbutton(debug_frame, text=" Simulate Arduino", variable=self.var_sim_arduino)
-        self.pdb = tk.Button(debug_frame, text="pdb", command=pdb.set_trace)
+        self.check_binary = tk.Checkbutton(debug_frame, text=" Binary serial protocol", variable=self.var_binary)
+        self.check_latency = tk.Checkbutton(debug_frame, text=" Latency stats", variable=self.var_latency)
+        self.label_latency = tk.Label(debug_frame, textvariable=self.var_latency_readout, anchor='w')
+        self.label_loss = tk.Label(debug_frame, textvariable=self.var_loss_readout, anchor='w')
+        self.pdb = tk.Button(debug_frame, text="pdb", command=lambda: pdb.set_trace())
 
         self.check_print.grid(row=0, column=0, padx=px1, sticky='w')
         self.check_sim_cam.grid(row=1, column=0, padx=px1, sticky='w')
         self.check_sim_arduino.grid(row=2, column=0, padx=px1, sticky='w')
-        self.pdb.grid(row=3, column=0, padx=px1, sticky='w')
+        self.check_binary.grid(row=3, column=0, padx=px1, sticky='w')
+        self.check_latency.grid(row=4, column=0, padx=px1, sticky='w')
+        self.label_latency.grid(row=5, column=0, padx=px1, sticky='w')
+        self.label_loss.grid(row=6, column=0, padx=px1, sticky='w')
+        self.pdb.grid(row=7, column=0, padx=px1, sticky='w')
 
         # Frame for file
         frame_file = tk.Frame(frame_parameter)
@@ -302,7 +350,7 @@ class InputManager(tk.Frame):
 
         tk.Label(frame_slack, text="Slack address: ", anchor='w').grid(row=0, column=0, sticky='we')
         self.entry_slack = tk.Entry(frame_slack)
-        self.button_slack = tk.Button(frame_slack, text="", command=lambda: slack_msg(self.entry_slack.get(), "Test", test=True))
+        self.button_slack = tk.Button(frame_slack, text="", command=self.slack_test)
 
         self.entry_slack.grid(row=1, column=0, sticky='wens')
         self.button_slack.grid(row=1, column=1, sticky='e')
@@ -340,15 +388,14 @@ class InputManager(tk.Frame):
         self.num_rail_segments = 10  # Number of segments to split rail--for plotting
         trial_window = 30000
 
-        sns.set_style('dark')
+        startup.set_plot_style('dark')
         self.color_vel = 'darkslategray'
 
         # self.fig, self.ax = plt.subplots(figsize=(8, 2))
         self.fig = Figure(figsize=(8, 2))
         self.ax = self.fig.add_subplot(1, 1, 1)
-        self.ax.set_xlabel("Trial time (ms)")
+        self.ax.set_xlabel("Time (ms)")
         self.ax.set_ylabel("Relative velocity")
-        self.ax.set_xlim(0, history)
         self.ax.set_ylim(-50, 50)
         self.vel_trace, = self.ax.plot([], [], c=self.color_vel)
         self.ax.axhline(y=0, linestyle='--', linewidth=1, color='0.5')
@@ -358,6 +405,7 @@ class InputManager(tk.Frame):
         self.plot_canvas.show()
         self.plot_canvas.draw()
         self.plot_canvas.get_tk_widget().grid(row=0, column=0, rowspan=2, sticky=tk.W+tk.E+tk.N+tk.S)
+        self.vel_plot = RollingTrace(self.plot_canvas, self.ax, self.vel_trace, history=history)
 
         ##### SCOREBOARD #####
         scoreboard_frame = tk.Frame(monitor_frame, bg='white')
@@ -388,7 +436,10 @@ class InputManager(tk.Frame):
             self.entry_trial_dur,
             self.entry_track_period,
             self.entry_track_steps,
-            self.check_print
+            self.check_print,
+            self.check_binary,
+            self.check_latency,
+            self.check_sim_arduino
         ]
         # Boolean of objects in list above that should be enabled when time...
         self.obj_enabled_at_open = [False] * len(self.obj_to_disable_at_open)
@@ -402,7 +453,9 @@ class InputManager(tk.Frame):
             self.entry_save,
             self.button_save_file,
             self.button_start,
-            self.button_slack
+            self.button_slack,
+            self.option_codec,
+            self.spin_level
         ]
         self.obj_to_enable_at_start = [
             self.button_stop
@@ -426,22 +479,57 @@ class InputManager(tk.Frame):
         self.var_hsub.set(50)
         self.var_gain.set(15)
         self.var_expo.set(40)
+        self.var_codec.set('gzip')
+        self.var_level.set(DEFAULT_LEVEL['gzip'])
 
         ###### SESSION VARIABLES ######
         self.cam = None
+        self.preview = None
+        self.sim_arduino = None
         self.scale_fps = None
         self.parameters = collections.OrderedDict()
-        self.ser = serial.Serial(timeout=1, baudrate=9600)
+        self.ser = serial.Serial(timeout=1, baudrate=BAUD_DEFAULT)
+        self.seq = False            # Events carry sequence numbers (rig/protocol.py)
+        self.connect_time = None    # s taken by the connect handshake (rig/handshake.py)
+        self.loss = LossCounter()
+        self.latency = None         # LatencyMonitor while 'Latency stats' is on (rig/latency.py)
+        self.last_readout = 0       # Time the loss and latency readouts were last refreshed
         self.start_time = ""
         self.counter = {}
-        self.q = Queue()
+        self.q = EventQueue()
+        self.dispatcher = EventDispatcher(self.q)
+        self.clock = ClockSync()
         self.q_to_thread_rec = Queue()
         self.q_from_thread_rec = Queue()
         self.gui_update_ct = 0  # count number of times GUI has been updated
 
     def update_instruments(self):
+        # Enumerating cameras (and importing instrumental) is slow, so it runs
+        # on a background thread and the menu is filled in when it finishes
+        self.var_instr.set("Searching...")
+        self.button_refresh_instr['state'] = 'disabled'
+        q_instrs = Queue()
+
+        def enumerate_instruments():
+            try:
+                q_instrs.put(instrumental.list_instruments())
+            except Exception as err:
+                print("Unable to list instruments: {}".format(err))
+                q_instrs.put([])
+
+        thread_instrs = threading.Thread(target=enumerate_instruments)
+        thread_instrs.daemon = True
+        thread_instrs.start()
+        self.after(100, self.update_instruments_done, q_instrs)
+
+    def update_instruments_done(self, q_instrs):
+        if q_instrs.empty():
+            self.after(100, self.update_instruments_done, q_instrs)
+            return
+
+        self.button_refresh_instr['state'] = 'normal'
         self.instrs = {}
-        instrs = list_instruments()
+        instrs = q_instrs.get()
         menu = self.option_instr['menu']
         menu.delete(0, tk.END)
         if instrs:
@@ -464,8 +552,10 @@ class InputManager(tk.Frame):
 
         if not self.cam:
             cam_name = self.var_instr.get()
-            if cam_name:
-                self.cam = instrument(self.instrs[cam_name])
+            if self.var_sim_cam.get():
+                self.cam = SimulatedCamera()
+            elif cam_name:
+                self.cam = instrumental.instrument(self.instrs[cam_name])
             else:
                 print("No camera selected.")
                 return 1
@@ -505,6 +595,9 @@ class InputManager(tk.Frame):
         #     return 1
 
     def cam_close(self):
+        if self.preview:
+            self.preview.stop()
+            self.preview = None
         if self.cam:
             print("Closing camera")
             self.cam.close()
@@ -606,32 +699,29 @@ class InputManager(tk.Frame):
                 print("Unable to start camera")
                 return
 
-        # Get frame
-        im = self.cam.latest_frame()
-        self.im.set_data(im)
-        self.canvas_preview.draw_idle()
-
-        # if not self.var_cam_state.get():
-        #     state = self.cam_start()
-        #     if state:
-        #         print("Unable to start camera")
-        #         return
-
-        # start_time = time.clock()
-        # frame_dur = 1000. / self.var_fps.get()
-
-        # exposure_time = frame_dur * self.var_expo.get()/100.
-        # im = self.cam.grab_image(
-        #     vsub=subsamp[self.var_vsub.get()],
-        #     hsub=subsamp[self.var_hsub.get()],
-        #     gain=self.var_gain.get(),
-        #     exposure_time='{}ms'.format(exposure_time))
-        # too_fast = True if time.clock() - start_time > frame_dur / 1000. else False
-        # self.im.set_data(im)
-        # # self.ax_preview.set_ylim(0, self.cam.height)
-        # # self.ax_preview.set_xlim(0, self.cam.width)
-        # self.ax_preview.draw_artist(self.im)
-        # self.fig_preview.canvas.blit(self.ax_preview.bbox)
+        # Downsampling happens on grabber thread
+        if not self.preview:
+            self.preview = PreviewGrabber(self.cam, self.preview_size)
+            self.preview.start()
+            self.preview_shown = 0
+            self.preview_start = time.time()
+
+        # Show newest preview, if any (older ones are skipped)
+        rgb = self.preview.take()
+        if rgb is not None:
+            if rgb.shape[:2] != (self.photo_preview.height(), self.photo_preview.width()):
+                self.photo_preview = ImageTk.PhotoImage('RGB', rgb.shape[1::-1])
+                self.label_preview.configure(image=self.photo_preview)
+            self.photo_preview.paste(Image.fromarray(rgb))
+            self.preview_shown += 1
+
+        # Achieved preview rate, updated every second
+        elapsed = time.time() - self.preview_start
+        if elapsed >= 1:
+            self.var_preview_fps.set("Preview: {:.1f} fps ({} skipped)".format(
+                self.preview_shown / elapsed, self.preview.skipped))
+            self.preview_shown = 0
+            self.preview_start = time.time()
 
         self.parent.after(20, self.cam_preview_update)
 
@@ -693,7 +783,7 @@ class InputManager(tk.Frame):
 
             self.entry_serial_status.config(state='normal', fg='black')
             self.entry_serial_status.delete(0, tk.END)
-            self.entry_serial_status.insert(0, 'Opened')
+            self.entry_serial_status.insert(0, 'Opened ({})'.format(self.ser.baudrate))
             self.entry_serial_status['state'] = 'readonly'
 
         elif option == 'close':
@@ -740,9 +830,7 @@ class InputManager(tk.Frame):
         self.parameters['track_steps'] = int(self.entry_track_steps.get())
 
         # Clear old data
-        self.vel_trace.set_data([[], []])
-        # self.ax.set_xlim(0, self.parameters['trial_duration'])
-        self.plot_canvas.draw()
+        self.vel_plot.reset()
         for obj in self.scoreboard_objs:
             obj.delete(0, tk.END)
 
@@ -750,12 +838,22 @@ class InputManager(tk.Frame):
         self.counter = {
             'trial': 0,
             'track': 0,
-            'steps': 0
+            'steps': 0,
+            'sync': 0
         }
 
         # Open serial and upload to Arduino
-        self.ser.port = self.port_var.get()
-        ser_return = start_arduino(self.ser, self.parameters)
+        if self.var_sim_arduino.get():
+            # Simulated Arduino on a pseudo-terminal
+            self.sim_arduino = SimulatedArduino(
+                track_rate=1000. / self.parameters['track_period'],
+                duration=self.parameters['session_duration'],
+                binary=self.var_binary.get())
+            self.sim_arduino.start()
+            self.ser.port = self.sim_arduino.port
+        else:
+            self.ser.port = self.port_var.get()
+        ser_return, self.seq, self.connect_time = start_arduino(self.ser, self.parameters)
 
         if ser_return:
             tkMessageBox.showerror("Serial error",
@@ -774,6 +872,9 @@ class InputManager(tk.Frame):
         ''' Close serial connection to Arduino '''
 
         self.ser.close()
+        if self.sim_arduino:
+            self.sim_arduino.close()
+            self.sim_arduino = None
         self.gui_util('close')
         print "Connection to Arduino closed."
     
@@ -781,17 +882,17 @@ class InputManager(tk.Frame):
         self.gui_util('start')
 
         # Clear Queues
-        for q in [self.q, self.q_to_thread_rec, self.q_from_thread_rec]:
+        self.q.clear()
+        for q in [self.q_to_thread_rec, self.q_from_thread_rec]:
             with q.mutex:
                 q.queue.clear()
 
         session_length = self.parameters['session_duration']
-        nstepframes = session_length / float(self.entry_track_period.get())
 
         # Start camera
         self.cam_start()
-        dy = self.cam.height
-        dx = self.cam.width
+        dy = self.cam_dy = self.cam.height
+        dx = self.cam_dx = self.cam.width
         fps = self.cam.framerate
         nframes = fps * session_length / 1000.
         frame_dur_s = 1. / fps
@@ -817,9 +918,11 @@ class InputManager(tk.Frame):
 
         self.grp_cam = self.data_file.create_group('cam')
         self.dset_ts = self.grp_cam.create_dataset('timestamps', dtype=float,
-            shape=(int(nframes * 1.1), ), chunks=(1, ))
-        self.dset_cam = self.grp_cam.create_dataset('frames', dtype='uint8',
-            shape=(int(nframes * 1.1), dy, dx), chunks=(1, dy, dx))
+            shape=(int(nframes * 1.1), ), chunks=(1024, ), maxshape=(None, ))
+        codec = self.var_codec.get()
+        level = self.var_level.get() if codec in DEFAULT_LEVEL else None
+        self.dset_cam = create_frame_dataset(self.grp_cam, 'frames', (dy, dx),
+            nframes * 1.1, codec, level)
         self.grp_cam.attrs['fps'] = fps
         self.grp_cam.attrs['exposure'] = exposure_time
         self.grp_cam.attrs['gain'] = self.var_gain.get()
@@ -827,35 +930,40 @@ class InputManager(tk.Frame):
         self.grp_cam.attrs['hsub'] = self.var_hsub.get()
 
         self.behav_grp = self.data_file.create_group('behavior')
-        self.behav_grp.create_dataset(name='trials', dtype='uint32',
-            shape=(1000, ), chunks=(1, ))
-        self.behav_grp.create_dataset(name='trial_manual', dtype=bool,
-            shape=(1000, ), chunks=(1, ))
-        self.behav_grp.create_dataset(name='rail_leave', dtype='uint32',
-            shape=(1000, ), chunks=(1, ))
-        self.behav_grp.create_dataset(name='rail_home', dtype='uint32',
-            shape=(1000, ), chunks=(1, ))
-        self.behav_grp.create_dataset(name='steps', dtype='int32',
-            shape=(2, int(nstepframes) * 1.1), chunks=(2, 1))
-        self.behav_grp.create_dataset(name='track', dtype='int32',
-            shape=(2, int(nstepframes) * 1.1), chunks=(2, 1))
+        self.writer = BehaviorWriter(self.behav_grp)
+        self.writer.create('trials', 'uint32')
+        self.writer.create('trial_manual', bool)
+        self.writer.create('rail_leave', 'uint32')
+        self.writer.create('rail_home', 'uint32')
+        self.writer.create('steps', 'int32', rows=2)
+        self.writer.create('track', 'int32', rows=2)
+        self.writer.create('sync', 'float64', rows=3)
 
         # Store session parameters into behavior group
         for key, value in self.parameters.iteritems():
             self.behav_grp.attrs[key] = value
 
+        # Per-stage timing of events, serial to disk (rig/latency.py)
+        self.latency = LatencyMonitor() if self.var_latency.get() else None
+        self.dispatcher.latency = self.latency
+
         # Create thread to scan serial
         thread_scan = threading.Thread(
             target=scan_serial,
-            args=(self.q, self.q_to_thread_rec, self.ser, self.parameters, self.print_var.get()))
+            args=(self.q, self.q_to_thread_rec, self.ser, self.parameters, self.print_var.get()),
+            kwargs={'binary': self.var_binary.get(), 'latency': self.latency,
+                    'seq': self.seq, 'loss': self.loss})
 
         # Create thread to record from camera
+        # Frames are buffered in a ring (~2 s) and written by a separate thread
+        frame_writer = FrameWriter(self.dset_cam, self.dset_ts, buffer_frames=2 * fps)
+        self.ring = frame_writer.ring
         thread_rec = threading.Thread(
             target=record,
             args=(
-                self.q_to_thread_rec, self.q_from_thread_rec, self.dset_ts,
-                self.cam, self.dset_cam,
-                frame_dur_s, session_length)
+                self.q_to_thread_rec, self.q_from_thread_rec,
+                self.cam, self.ring, frame_writer,
+                frame_dur_s, session_length / 1000.)
         )
 
         # frame_dur_s = 1. / fps
@@ -878,9 +986,16 @@ class InputManager(tk.Frame):
         self.entry_start.insert(0, self.start_time)
         self.entry_end.insert(0, '~' + approx_end.strftime("%H:%M:%S"))
         self.behav_grp.attrs['start_time'] = self.start_time
+        self.behav_grp.attrs['baudrate'] = self.ser.baudrate
+        self.behav_grp.attrs['connect_time'] = self.connect_time
 
         self.ser.flushInput()                                   # Remove data from serial input
         self.ser.write('E')                                     # Start signal for Arduino
+        self.dispatcher.reset()
+        self.clock.reset()
+        self.loss.reset()
+        self.storage = StorageWorker(self.data_file, self.writer, self.latency)  # owns data_file from here on
+        self.storage.start()
         thread_scan.start()
         thread_rec.start()
 
@@ -901,120 +1016,147 @@ class InputManager(tk.Frame):
         code_rail_leave = 5
         code_rail_home = 6
         code_track = 7
+        code_sync = 8
 
         # End on "Stop" button (by user)
         if self.stop.get():
             self.stop.set(False)
             self.ser.write("0")
+            if self.latency:
+                self.latency.stop_requested()
             print("User triggered stop.")
         elif self.manual.get():
             self.manual.set(False)
             self.ser.write("F")
             print("Manual trial triggered")
 
+        # Periodic clock sync ping (see rig/clock.py)
+        self.clock.poll(self.ser)
+
         # Incoming queue has format:
         #   [code, ts [, extra values...]]
-        if not self.q.empty():
-            q_in = self.q.get()
+        # Handle all pending events (within time budget of dispatcher)
+        for q_in in self.dispatcher.drain():
             code = q_in[0]
             ts = q_in[1]
 
             # stop_session is called only when Arduino sends stop code
             if code == code_end:
+                if self.latency:
+                    self.latency.stop_handled()
                 arduino_end = ts
                 self.q_to_thread_rec.put(0)
                 # while self.q_from_thread_rec.empty():
                 #     pass
                 print("Stopping session.")
-                self.stop_session(self.q_from_thread_rec.get(), arduino_end)
+                frame_cutoff, cam_start = self.q_from_thread_rec.get()
+                self.stop_session(frame_cutoff, arduino_end, cam_start)
                 return
 
             elif code == code_trial_start:
                 manual = bool(q_in[2])
 
-                self.behav_grp['trials'][self.counter['trial']] = ts
-                self.behav_grp['trial_manual'][self.counter['trial']] = manual
+                self.storage.write('trials', self.counter['trial'], ts)
+                self.storage.write('trial_manual', self.counter['trial'], manual)
 
             elif code == code_rail_leave:
-                self.behav_grp['rail_leave'][self.counter['trial']] = ts
+                self.storage.write('rail_leave', self.counter['trial'], ts)
 
             elif code == code_rail_home:
-                self.behav_grp['rail_home'][self.counter['trial']] = ts
+                self.storage.write('rail_home', self.counter['trial'], ts)
                 self.counter['trial'] += 1
 
             elif code == code_steps:
                 dist = int(q_in[2])
 
                 # Record tracking
-                self.behav_grp['steps'][:, self.counter['steps']] = [ts, dist]
+                self.storage.write('steps', self.counter['steps'], (ts, dist))
                 self.counter['steps'] += 1
 
             elif code == code_track:
                 dist = int(q_in[2])
 
                 # Record tracking
-                self.behav_grp['track'][:, self.counter['track']] = [ts, dist]
-
-                # # Update plot
-                # x0 = ts - history
-                # X, Y = self.vel_trace.get_data()
-                # X = np.append(X, ts)
-                # Y = np.append(Y, dist)
-                # recent_pts = X >= x0
-
-                # if any(recent_pts):
-                #     X = X[recent_pts]
-                #     Y = Y[recent_pts]
+                self.storage.write('track', self.counter['track'], (ts, dist))
 
-                #     self.vel_trace.set_data(X, Y)
-                #     self.ax.set_xlim(x0, ts)
-
-                #     # self.ax.draw_artist(self.vel_trace)
-                #     # self.fig.canvas.blit(self.ax.bbox)
-                #     # self.fig.canvas.show()
-                #     self.fig.canvas.draw_idle()
+                # Update plot
+                self.vel_plot.append(ts, dist)
 
                 # Increment counter
                 self.counter['track'] += 1
 
-        # # Increment GUI update counter
-        # self.gui_update_ct += 1
-        
-        # # Update plot every 0.5 s
-        # if self.gui_update_ct % 5 == 0:
-        #     self.plot_canvas.draw()
+            elif code == code_sync:
+                sample = self.clock.echo(q_in)
+                if sample:
+                    self.storage.write('sync', self.counter['sync'], sample)
+                    self.counter['sync'] += 1
+
+        # Redraw velocity (rate limited by RollingTrace)
+        self.vel_plot.redraw()
+
+        # Live latency and serial loss readouts, once a second
+        if time.time() - self.last_readout >= 1:
+            self.last_readout = time.time()
+            if self.latency:
+                self.var_latency_readout.set(self.latency.readout())
+            self.var_loss_readout.set("Serial events " + self.loss.readout(STREAMS))
 
         self.parent.after(refresh_rate, self.update_session)
 
-    def stop_session(self, frame_cutoff=None, arduino_end=None):
+    def stop_session(self, frame_cutoff=0, arduino_end=None, cam_start=None):
         end_time = datetime.now().strftime("%H:%M:%S")
         print "Session ended at " + end_time
         self.gui_util('stop')
         self.close_serial()
         self.cam_close()
+        if self.latency:
+            self.var_latency_readout.set(self.latency.readout())
+        self.var_loss_readout.set("Serial events " + self.loss.readout(STREAMS))
 
         if self.data_file:
+            # Finish writing on storage thread: flush, trim to counters, attrs, close
             print("Writing behavioral data")
-            self.behav_grp.attrs['end_time'] = end_time
-            self.behav_grp['trials'].resize((self.counter['trial'], ))
-            self.behav_grp['trial_manual'].resize((self.counter['trial'], ))
-            self.behav_grp['rail_leave'].resize((self.counter['trial'], ))
-            self.behav_grp['rail_home'].resize((self.counter['trial'], ))
-            self.behav_grp['steps'].resize((2, self.counter['steps']))
-            self.behav_grp['track'].resize((2, self.counter['track']))
-            self.behav_grp.attrs['notes'] = self.scrolled_notes.get(1.0, tk.END)
-            self.behav_grp.attrs['arduino_end'] = arduino_end
-
-            self.grp_cam.attrs['end_time'] = end_time
-            if frame_cutoff:
-                print("Trimming recording")
-                self.grp_cam['timestamps'].resize((frame_cutoff, ))
-                _, dy, dx = self.grp_cam['frames'].shape
-                self.grp_cam['frames'].resize((frame_cutoff, dy, dx))
-
-            # Close HDF5 file object
-            print("Closing file")
-            self.data_file.close()
+            behav_attrs = {
+                'end_time': end_time,
+                'notes': self.scrolled_notes.get(1.0, tk.END),
+                'arduino_end': arduino_end,
+            }
+            behav_attrs.update(self.dispatcher.stats())
+            behav_attrs.update(self.clock.fit())
+            behav_attrs.update(self.loss.summary(STREAMS))
+            if self.latency:
+                behav_attrs.update(self.latency.summary())
+            if self.loss.totals() != (0, 0, 0):
+                print("Serial events " + self.loss.readout(STREAMS))
+            resize = {
+                'behavior/trials': (self.counter['trial'], ),
+                'behavior/trial_manual': (self.counter['trial'], ),
+                'behavior/rail_leave': (self.counter['trial'], ),
+                'behavior/rail_home': (self.counter['trial'], ),
+                'behavior/steps': (2, self.counter['steps']),
+                'behavior/track': (2, self.counter['track']),
+                'behavior/sync': (3, self.counter['sync']),
+            }
+            # Trim preallocated frames to those recorded (possibly none)
+            print("Trimming recording")
+            resize['cam/timestamps'] = (frame_cutoff, )
+            resize['cam/frames'] = (frame_cutoff, self.cam_dy, self.cam_dx)
+
+            try:
+                self.storage.close(
+                    resize=resize,
+                    attrs={
+                        'behavior': behav_attrs,
+                        'cam': {
+                            'end_time': end_time,
+                            'dropped_frames': self.ring.dropped,
+                            'late_frames': self.ring.late,
+                            'start_host_time': cam_start if cam_start is not None else -1,
+                        },
+                    }
+                )
+            except StorageError as err:
+                tkMessageBox.showerror("File error", "Some data could not be saved:\n{}".format(err))
         
         # Clear self.parameters
         self.parameters = collections.OrderedDict()
@@ -1026,109 +1168,92 @@ class InputManager(tk.Frame):
             slack):
             slack_msg(self.entry_slack.get(), "Session ended.")
 
+    def slack_test(self):
+        message = slack_msg(self.entry_slack.get(), "Test")
+        if message:
+            self.after(100, self.slack_test_check, message)
 
-def slack_msg(slack_recipient, msg, test=False):
-    # Creates Slack message to slack_recipient from Bot. Message is string msg.
-    bot_username = "Odor conveyor bot"
-    bot_icon = ":squirrel:"
-
-    # Verify Slack recipient
-    if not slack_recipient:
-        return
-    slack_code = slack_recipient[0]
-    slack_name = slack_recipient[1::]
-    if slack_code is '@':
-        slack_users = slack.users.list().body['members']
-        slack_user_names = [user['name'] for user in slack_users]
-        if slack_name not in slack_user_names:
-            if test:
-                tkMessageBox.showerror("Slack error", "Slack user does not exist")
-            else:
-                print "Slack user does not exist. Message failed to send."
-    elif slack_code is '#':
-        slack_channels = slack.channels.list().body['members']
-        slack_channel_names = [channel['name'] for channel in slack_channels]
-        if slack_name not in slack_channel_names:
-            if test:
-                tkMessageBox.showerror("Slack error", "Slack channel does not exist")
-            else:
-                print "Slack channel does not exist. Message failed to send."
-    else:
-        if test:
-            tkMessageBox.showerror("Slack error", "Slack recipient is invalid.")
-        else:
-            print "Slack recipient invalid. Message failed to send."
-        return
+    def slack_test_check(self, message):
+        # Poll test message so the Tk loop never waits on the network
+        if not message.done.is_set():
+            self.after(100, self.slack_test_check, message)
+        elif message.status != 'sent':
+            tkMessageBox.showerror("Slack error", message.error)
 
-    if msg:
-        slack.chat.post_message(slack_recipient, msg,
-                                username=bot_username,
-                                icon_emoji=bot_icon)
+
+def slack_msg(slack_recipient, msg):
+    # Queues Slack message `msg` to slack_recipient from Bot. Returns
+    # immediately with a Message whose status can be polled.
+    if not slack:
+        print "No Slack client defined. Message not sent."
+        return None
+    return slack.send(slack_recipient, msg)
 
 
 def start_arduino(ser, parameters):
+    # Returns (error or 0, whether events carry sequence numbers, connect time in s)
 
     values = parameters.values()
     sys.stdout.write("Uploading parameters to Arduino: {}".format(values))
     sys.stdout.flush()
     
     try:
+        ser.baudrate = BAUD_DEFAULT             # Arduino resets on open
         ser.open()
     except serial.SerialException as err:
         sys.stdout.write("\nFailed to open connection.\n")
-        return err
+        return err, False, None
 
-    # Wait for connection to Arduino
-    timeout = 5
-    timeout_count = 0
-    while 1:
-        if timeout_count >= timeout:
-            sys.stdout.write(" Startup prompt not found.\n")
-            sys.stdout.flush()
-            return serial.SerialException("Startup prompt not found.")
-        sys.stdout.write(".")
-        sys.stdout.flush()
-        if ser.read(): break
-        timeout_count += 1
-
-    # Write parameters to Arduino
-    ser.flushInput()            # Remove opening message from serial
-    ser.write('+'.join(str(s) for s in values))
-    while 1:
-        if timeout_count >= timeout:
-            sys.stdout.write(" Start signal from Arduino timed out.\n")
-            sys.stdout.flush()
-            return serial.SerialException("Start signal from Arduino timed out.")
-        sys.stdout.write(".")
+    # Wait for the Arduino to boot, then upload (see rig/handshake.py)
+    handshake = Handshake(ser, values)
+    if not handshake.run():
+        sys.stdout.write("\n{}\n".format(handshake.error))
         sys.stdout.flush()
-        if ser.read(): break
-    print "\nArduino updated."
+        return serial.SerialException(handshake.error), False, None
+    print "\nArduino updated ({} baud, connected in {:.2f} s).".format(ser.baudrate, handshake.elapsed)
 
-    return 0
+    return 0, offered_seq(handshake.banner), handshake.elapsed
 
 
-def scan_serial(q, q_to_rec_thread, ser, parameters, print_arduino=False):
+def scan_serial(q, q_to_rec_thread, ser, parameters, print_arduino=False, binary=False,
+                latency=None, seq=False, loss=None):
     #  Continually check serial connection for data sent from Arduino. Stop when "0 code" is received.
+    #  Reads whatever the port has buffered (text lines or binary records, see rig/protocol.py) and
+    #  queues the events parsed from each read as one EventBatch. Lost events are counted in `loss`,
+    #  and with a LatencyMonitor (`latency`) each batch is stamped.
 
     code_end = 0
 
     if print_arduino: print "  Scanning Arduino outputs."
+    decoder = FrameDecoder(seq, loss) if binary else LineDecoder(loss)
+
     while 1:
-        input_arduino = ser.readline()
-        if input_arduino == '': continue
-        if print_arduino: sys.stdout.write('  [a]: ' + input_arduino)
-
-        try:
-            input_split = map(int, input_arduino.split(','))
-        except ValueError:
-            # If not all comma-separated values are int castable
-            pass
-        else:
-            if input_arduino: q.put(input_split)
-            if input_split[0] == code_end:
-                q_to_rec_thread.put(0)
-                if print_arduino: print "  Scan complete."
-                return
+        data = ser.read(ser.in_waiting or 1)
+        if not data: continue
+        t_read = now_ns() if latency else 0
+
+        events, text = decoder.decode(data)
+        if binary: events = events.tolist()
+        if print_arduino:
+            for event in events:
+                sys.stdout.write('  [a]: ' + ','.join(map(str, event)) + '\n')
+            if text: sys.stdout.write('  [a]: ' + text)
+        if not events: continue
+
+        batch = EventBatch()
+        for event in events:
+            if event[0] == code_sync: event = list(event) + [host_time()]
+            batch.append(event)
+            if event[0] == code_end: break
+        if latency:
+            latency.stamp(batch, t_read)
+            latency.add('parse', now_ns() - t_read)
+        q.put(batch)
+
+        if batch[-1][0] == code_end:
+            q_to_rec_thread.put(0)
+            if print_arduino: print "  Scan complete."
+            return
 
 
 def main():
@@ -1139,8 +1264,13 @@ def main():
     #     root.iconbitmap(os.path.join(os.getcwd(), 'neuron.ico'))
     InputManager(root)
     root.grid()
+    root.after_idle(startup.report)
     root.mainloop()
 
+    # Give queued Slack messages a chance to go out
+    if slack:
+        slack.close()
+
 
 if __name__ == '__main__':
     main()
@@ -14,11 +14,18 @@ GUI for recording and calculations.
 #define CODEEND 48
 #define STARTCODE 69
 #define CODETRIAL 70
+#define CODESYNC 83       // 'S': clock sync ping (see rig/clock.py)
 #define DELIM ","         // Delimiter used for serial outputs
 #define STEPSHIFT 1       // Scale factor to convert tracking to stepper
 #define CODEFORWARD 53
 #define CODEBACKWARD 54
 #define STEPMAX 127       // Maximum number of steps by stepper
+#define BINARYOUT 0       // 1: send events as binary records (see rig/protocol.py)
+#define FRAMEFLAG 0x80    // Marks first byte of a binary record
+#define SEQDELIM ";"      // Precedes sequence number in serial outputs
+#define CODEBAUD 66       // 'B': baud rate proposal (see rig/baud.py)
+#define BAUDMAX 1000000   // Fastest baud rate offered to the computer
+#define BAUDWAIT 500      // ms to wait for the computer at a new baud rate
 
 
 // Pins
@@ -40,6 +47,7 @@ const int code_trial_start = 3;
 const int code_rail_leave = 5;
 const int code_rail_home = 6;
 const int code_track = 7;
+const int code_sync = 8;
 
 // Variables via serial
 unsigned long sessionDur;
@@ -49,6 +57,7 @@ unsigned int trackSteps;
 
 // Other variables
 volatile int trackChange = 0;   // Rotations within tracking epochs
+byte seqs[16];                  // Next sequence number of each event code
 
 
 void track() {
@@ -58,11 +67,35 @@ void track() {
 }
 
 
+void sendEvent(byte code, unsigned long ts, long value, boolean hasValue) {
+  // Send event to computer as "code,ts[,value];seq" line or as binary record
+  byte seq = seqs[code & 15]++;   // Per-code sequence number, lets computer count lost events
+#if BINARYOUT
+  byte frame[11];
+  frame[0] = code | FRAMEFLAG;
+  memcpy(frame + 1, &ts, 4);      // AVR/ARM are little-endian
+  memcpy(frame + 5, &value, 4);
+  frame[9] = seq;
+  frame[10] = 0;
+  for (int i = 0; i < 10; i++) frame[10] ^= frame[i];
+  Serial.write(frame, 11);
+#else
+  Serial.print(code);
+  Serial.print(DELIM);
+  Serial.print(ts);
+  if (hasValue) {
+    Serial.print(DELIM);
+    Serial.print(value);
+  }
+  Serial.print(SEQDELIM);
+  Serial.println(seq);
+#endif
+}
+
+
 void endSession(unsigned long ts) {
   // Send "end" signal
-  Serial.print(code_end);
-  Serial.print(DELIM);
-  Serial.println(ts);
+  sendEvent(code_end, ts, 0, false);
   digitalWrite(imgStopPin, HIGH);
 
   // Reset pins
@@ -104,6 +137,41 @@ void waitForStart() {
 }
 
 
+void negotiateBaud() {
+  // Switch to a faster baud rate if the computer proposes one (see rig/baud.py).
+  // Returns once the next byte isn't a proposal, i.e. parameters are coming.
+  unsigned long rate;
+  unsigned long t0;
+
+  while (1) {
+    while (Serial.available() <= 0);
+    if (Serial.peek() != CODEBAUD) return;
+    Serial.read();
+    rate = Serial.parseInt();
+    Serial.read();              // '\n'
+    if (rate == 0 || rate > BAUDMAX) {
+      Serial.println("B0");
+      continue;
+    }
+
+    // Acknowledge at the old rate, then wait for the computer at the new one
+    Serial.print("B");
+    Serial.println(rate);
+    Serial.flush();
+    Serial.begin(rate);
+    t0 = millis();
+    while (millis() - t0 < BAUDWAIT) {
+      if (Serial.read() == CODEBAUD) {
+        Serial.print("B");
+        Serial.println(rate);
+        return;
+      }
+    }
+    Serial.begin(9600);         // Not confirmed: back to the default rate
+  }
+}
+
+
 void setup() {
   Serial.begin(9600);         // used to communicate with computer
   Serial1.begin(9600);        // used to communicate with conveyor motor
@@ -120,7 +188,10 @@ void setup() {
   // Wait for parameters from serial
   Serial.println("odor-presentation\n"
                  "Waiting for parameters...");
-  while (Serial.available() <= 0);
+  Serial.print("Baud: ");
+  Serial.println(BAUDMAX);
+  Serial.println("Seq: 1");
+  negotiateBaud();
   getParams();
   Serial.println("Paremeters processed.");
 
@@ -144,6 +215,7 @@ void loop() {
   static boolean conveyorSet;
   static unsigned long nextTrackTS = trackPeriod;  // Timer used for motion tracking and conveyor movement
 
+  static unsigned long syncCount;       // Clock sync pings answered
   static boolean manual;       // indicates if trial was started manually
   static boolean trialState;
   static boolean move2mouse;
@@ -171,6 +243,10 @@ void loop() {
       case CODEEND:
         endSession(ts);
         break;
+      case CODESYNC:
+        // Reply right away with a fresh timestamp and the ping's number
+        sendEvent(code_sync, millis() - start, syncCount++, true);
+        break;
       case CODETRIAL:
         // Only works if not already in trial
         if (! trialState) {
@@ -178,9 +254,7 @@ void loop() {
           move2mouse = true;
           manual = true;
 
-          Serial.print(code_rail_leave);
-          Serial.print(DELIM);
-          Serial.println(ts);
+          sendEvent(code_rail_leave, ts, 0, false);
         }
         break;
 //      case 56:
@@ -231,11 +305,7 @@ void loop() {
         actualTrial = true;
         trialStart = ts;
 
-        Serial.print(code_trial_start);
-        Serial.print(DELIM);
-        Serial.print(ts);
-        Serial.print(DELIM);
-        Serial.println(manual);
+        sendEvent(code_trial_start, ts, manual, true);
       }
       else {
         if (ts >= nextTrackTS) {
@@ -264,9 +334,7 @@ void loop() {
         trialState = false;
         manual = false;
 
-        Serial.print(code_rail_home);
-        Serial.print(DELIM);
-        Serial.println(ts);
+        sendEvent(code_rail_home, ts, 0, false);
       }
       else {
         if (ts >= nextTrackTS) {
@@ -291,11 +359,7 @@ void loop() {
     trackChange = 0;
     
     if (trackOutVal != 0) {
-      Serial.print(code_track);
-      Serial.print(DELIM);
-      Serial.print(ts);
-      Serial.print(DELIM);
-      Serial.println(trackOutVal);
+      sendEvent(code_track, ts, trackOutVal, true);
     }
     
     // Increment nextTractTS for next track stamp
@@ -0,0 +1,7 @@
+'''
+Shared rig components
+
+Serial, storage and plotting helpers used by the conveyor, odor-presentation
+and social-run GUIs. Scripts add the repository root to `sys.path` and import
+from here, e.g. `from rig.dispatch import EventDispatcher`.
+'''
@@ -0,0 +1,244 @@
+'''
+asyncio serial ingestion (Python 3 only)
+
+SerialStream reads an Arduino's serial port from an asyncio event loop and
+hands out decoded events ([code, ts [, value]]) through an asyncio.Queue.
+On POSIX the port's file descriptor is registered with `loop.add_reader`, so
+nothing polls and a single loop can read many rigs at once. Where ports
+aren't selectable (Windows), reads run in the loop's executor with a short
+serial timeout, which still lets the stream be cancelled promptly.
+
+    stream = SerialStream(ser, binary=True)
+    stream.start()
+    async for event in stream.events(timeout=5):
+        ...
+
+The queue holds one EventBatch per read; batches() hands them out whole.
+
+A stream ends when the end code arrives, the port fails, `close()` is
+called or (with `timeout`) no event arrives in time.
+
+SerialHub runs one loop on a background thread for the Tk and threaded code:
+each added port forwards its events to a regular Queue in EventBatches, like
+scan_serial.
+'''
+
+import os
+import sys
+import asyncio
+import threading
+
+from rig.clock import code_sync, host_time
+from rig.dispatch import EventBatch
+from rig.latency import now_ns
+from rig.protocol import FrameDecoder, LineDecoder
+
+code_end = 0
+
+
+class SerialStream(object):
+    '''Events from one serial port, read without blocking the event loop.
+
+    `on_text(str)` receives non-event output (e.g. for printing). With a
+    LatencyMonitor (`latency`), each read's batch is stamped. `seq` and
+    `loss` are passed to the decoder (see rig/protocol.py). Use either
+    get()/events() or batches(), not both.
+    '''
+
+    def __init__(self, ser, binary=False, on_text=None, latency=None, seq=False, loss=None):
+        self.ser = ser
+        self.decoder = FrameDecoder(seq, loss) if binary else LineDecoder(loss)
+        self.on_text = on_text
+        self.latency = latency
+        self.loop = None
+        self.queue = None
+        self.batch = ()         # Batch get() is handing out, and its next index
+        self.ix = 0
+        self.fd = None
+        self.task = None
+        self.done = False
+        self.error = None
+
+    def start(self):
+        ''' Start reading; call from the event loop '''
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        try:
+            self.fd = self.ser.fileno()
+            self.loop.add_reader(self.fd, self._readable)
+        except (AttributeError, NotImplementedError, ValueError):
+            # Port not selectable (or loop can't watch fds): read in executor
+            self.fd = None
+            self.ser.timeout = 0.1
+            self.task = self.loop.create_task(self._read_executor())
+
+    def _readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            self._finish(err)
+            return
+        if not data:
+            # EOF: device disconnected
+            self._finish(IOError('Serial port closed'))
+            return
+        self._feed(data)
+
+    async def _read_executor(self):
+        try:
+            while not self.done:
+                data = await self.loop.run_in_executor(None, self._read_blocking)
+                if data:
+                    self._feed(data)
+        except asyncio.CancelledError:
+            pass
+        except Exception as err:
+            self._finish(err)
+
+    def _read_blocking(self):
+        return self.ser.read(self.ser.in_waiting or 1)
+
+    def _feed(self, data):
+        t_read = now_ns() if self.latency else 0
+        events, text = self.decoder.decode(data)
+        if text and self.on_text:
+            self.on_text(text)
+        if not len(events):
+            return
+
+        batch = EventBatch()
+        for event in (events.tolist() if hasattr(events, 'tolist') else events):
+            if event[0] == code_sync:
+                # Arrival time for the clock fit (see rig/clock.py)
+                event = list(event) + [host_time()]
+            batch.append(event)
+            if event[0] == code_end:
+                break
+        if self.latency:
+            self.latency.stamp(batch, t_read)
+            self.latency.add('parse', now_ns() - t_read)
+        self.queue.put_nowait(batch)
+        if batch[-1][0] == code_end:
+            self._finish()
+
+    def _finish(self, error=None):
+        if self.done:
+            return
+        self.done = True
+        self.error = error
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        self.queue.put_nowait(None)     # Wakes up readers
+
+    def close(self):
+        ''' Stop reading (events already queued can still be read) '''
+        self._finish()
+        if self.task:
+            self.task.cancel()
+
+    async def get(self, timeout=None):
+        '''Next event; None once the stream has ended.
+
+        Raises asyncio.TimeoutError if nothing arrives within `timeout` s.
+        '''
+        while self.ix >= len(self.batch):
+            batch = await self.get_batch(timeout)
+            if batch is None:
+                return None
+            self.batch, self.ix = batch, 0
+        self.ix += 1
+        return self.batch[self.ix - 1]
+
+    async def get_batch(self, timeout=None):
+        ''' EventBatch of the next read; None once the stream has ended '''
+        batch = await asyncio.wait_for(self.queue.get(), timeout)
+        if batch is None:
+            self.queue.put_nowait(None)     # Keep returning None
+        return batch
+
+    async def events(self, timeout=None):
+        ''' Async iterator over events until the stream ends '''
+        while 1:
+            event = await self.get(timeout)
+            if event is None:
+                return
+            yield event
+
+    async def batches(self, timeout=None):
+        ''' Async iterator over EventBatches until the stream ends '''
+        while 1:
+            batch = await self.get_batch(timeout)
+            if batch is None:
+                return
+            yield batch
+
+
+class Subscription(object):
+    ''' Handle for a port added to a SerialHub '''
+
+    def __init__(self, future, done):
+        self.future = future
+        self.done = done        # threading.Event, set once reading has stopped
+
+    def cancel(self, timeout=1):
+        ''' Stop reading and wait (up to `timeout` s) until the port is released '''
+        self.future.cancel()
+        return self.done.wait(timeout)
+
+
+class SerialHub(object):
+    '''Background event loop that reads any number of serial ports.
+
+    `add()` forwards a port's events to a Queue until the end code arrives
+    or the returned Subscription is cancelled. Each read's events are
+    forwarded together as one EventBatch.
+    '''
+
+    _shared = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        ''' Process-wide hub, created on first use '''
+        with cls._lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def __init__(self):
+        if os.name == 'nt':
+            # Proactor loops can't watch fds; serial reads use the executor anyway
+            self.loop = asyncio.SelectorEventLoop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def add(self, ser, q, binary=False, on_text=None, latency=None, seq=False, loss=None):
+        done = threading.Event()
+        future = asyncio.run_coroutine_threadsafe(
+            self._forward(ser, q, done, binary, on_text, latency, seq, loss), self.loop)
+        return Subscription(future, done)
+
+    async def _forward(self, ser, q, done, *args):
+        stream = SerialStream(ser, *args)
+        try:
+            stream.start()
+            async for batch in stream.batches():
+                q.put(batch)
+            if stream.error:
+                sys.stdout.write('Serial read stopped: {}\n'.format(stream.error))
+        finally:
+            stream.close()
+            done.set()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(1)
@@ -0,0 +1,71 @@
+'''
+Serial baud rate negotiation
+
+All sketches boot at 9600 baud. At 9600 a "7,123456,-12" line takes ~15 ms
+on the wire, so sketches that can go faster announce it with a
+"Baud: <max>" line in their startup banner. Before uploading parameters the
+host then proposes rates, fastest first:
+
+    host  "B<rate>\\n"     at 9600
+    board "B<rate>"       at 9600, then switches to <rate>
+    host  "B"             at <rate>
+    board "B<rate>"       at <rate>: link confirmed
+
+If the confirmation doesn't arrive (e.g. the USB-serial bridge can't do the
+rate), both sides go back to 9600 and the next rate is tried. Boards without
+the banner line (older sketches) stay at 9600 and are never sent a 'B',
+which their parameter parsing would mistake for a value.
+'''
+
+import re
+import time
+
+BAUD_DEFAULT = 9600
+BAUD_RATES = (1000000, 500000, 250000, 115200)     # Exact or <1% error on 16 MHz boards
+
+REPLY_TIMEOUT = 0.25    # s to wait for each reply
+FALLBACK_DELAY = 0.5    # Sketches return to 9600 after waiting this long (BAUDWAIT)
+
+
+def offered_baud(banner):
+    ''' Highest rate announced in a sketch's startup banner (None if none) '''
+    match = re.search(r'Baud: (\d+)', banner)
+    return int(match.group(1)) if match else None
+
+
+def negotiate_baud(ser, banner, rates=BAUD_RATES):
+    '''Switch `ser` (open at BAUD_DEFAULT) to the fastest rate the board takes.
+
+    `banner` is the text the board printed on startup. Call before sending
+    parameters; returns the baud rate in use.
+    '''
+
+    offered = offered_baud(banner)
+    if not offered:
+        return ser.baudrate
+
+    timeout = ser.timeout
+    ser.timeout = REPLY_TIMEOUT
+    try:
+        for rate in rates:
+            if rate > offered:
+                continue
+            expected = 'B{}'.format(rate).encode('ascii')
+
+            ser.reset_input_buffer()
+            ser.write(expected + b'\n')
+            if ser.readline().strip() != expected:
+                continue
+
+            # Board has switched; confirm at the new rate
+            ser.baudrate = rate
+            ser.reset_input_buffer()
+            ser.write(b'B')
+            if ser.readline().strip() == expected:
+                return rate
+
+            ser.baudrate = BAUD_DEFAULT
+            time.sleep(FALLBACK_DELAY)
+        return BAUD_DEFAULT
+    finally:
+        ser.timeout = timeout
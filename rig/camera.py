@@ -0,0 +1,227 @@
+'''
+Camera recording pipeline
+
+The grab loop copies each frame into a preallocated FrameRing and returns to
+waiting for the camera immediately. A FrameWriter thread drains the ring into
+HDF5 in multi-frame blocks, so disk hiccups are absorbed by the ring instead of
+causing missed frames. Frames that arrive while the ring is full are counted
+as dropped.
+
+Frames can be stored compressed (see `create_frame_dataset`). Chunks hold
+several frames (at least MIN_CHUNK_FRAMES, even for full-size frames) so
+sequential writes are large while reading a single frame only decompresses a
+small chunk. gzip chunks are compressed by a thread pool
+and written directly; other codecs go through the HDF5 filter pipeline on the
+writer thread. lz4 and blosc need the optional `hdf5plugin` package.
+'''
+
+import sys
+import zlib
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+is_py2 = sys.version[0] == '2'
+
+# hdf5plugin imports h5py, so it is only loaded when a plugin codec is used
+if is_py2:
+    import pkgutil
+    has_hdf5plugin = pkgutil.find_loader('hdf5plugin') is not None
+else:
+    import importlib.util
+    has_hdf5plugin = importlib.util.find_spec('hdf5plugin') is not None
+
+
+CODECS = ['none', 'gzip', 'lzf', 'lz4', 'blosc']
+DEFAULT_LEVEL = {'gzip': 4, 'blosc': 5}
+CHUNK_BYTES = 1 << 20       # Target chunk size for frame datasets
+MIN_CHUNK_FRAMES = 4        # Frames per chunk when one frame exceeds CHUNK_BYTES
+
+
+def available_codecs():
+    ''' Codecs usable with the installed packages '''
+    if not has_hdf5plugin:
+        return [c for c in CODECS if c not in ('lz4', 'blosc')]
+    return list(CODECS)
+
+
+def chunk_frames(shape, itemsize=1, target=CHUNK_BYTES, min_frames=MIN_CHUNK_FRAMES, max_frames=16):
+    ''' Frames per chunk for frames of `shape`, about `target` bytes but `min_frames` at least '''
+    frame_bytes = itemsize * int(np.prod(shape))
+    return int(max(min_frames, min(max_frames, target // frame_bytes)))
+
+
+def create_frame_dataset(group, name, shape, nframes, codec='none', level=None, dtype='uint8'):
+    '''Create an extendible (nframes, dy, dx) dataset with multi-frame chunks.
+
+    `level` applies to gzip (0-9) and blosc (0-9); None uses the default.
+    '''
+    if codec not in available_codecs():
+        raise ValueError("Codec '{}' is not available".format(codec))
+    if level is None:
+        level = DEFAULT_LEVEL.get(codec)
+
+    if codec in ('lz4', 'blosc'):
+        import hdf5plugin
+
+    kwargs = {}
+    if codec == 'gzip':
+        kwargs = {'compression': 'gzip', 'compression_opts': level}
+    elif codec == 'lzf':
+        kwargs = {'compression': 'lzf'}
+    elif codec == 'lz4':
+        kwargs = dict(hdf5plugin.LZ4())
+    elif codec == 'blosc':
+        kwargs = dict(hdf5plugin.Blosc(cname='lz4', clevel=level,
+                                       shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+
+    n = chunk_frames(shape, np.dtype(dtype).itemsize)
+    dset = group.create_dataset(name, dtype=dtype,
+        shape=(max(int(nframes), n), ) + tuple(shape),
+        chunks=(n, ) + tuple(shape), maxshape=(None, ) + tuple(shape), **kwargs)
+    dset.attrs['codec'] = codec
+    if level is not None:
+        dset.attrs['level'] = level
+    return dset
+
+
+class FrameRing(object):
+    ''' Fixed-capacity frame buffer shared by one producer and one consumer '''
+
+    def __init__(self, capacity, shape, dtype='uint8'):
+        self.capacity = capacity
+        self.frames = np.empty((capacity, ) + tuple(shape), dtype=dtype)
+        self.ts = np.empty(capacity, dtype=float)
+        self.head = 0               # Frames pushed
+        self.tail = 0               # Frames released by consumer
+        self.closed = False
+        self.dropped = 0            # Frames lost because ring was full
+        self.late = 0               # Frames that arrived later than expected
+        self.cond = threading.Condition()
+
+    def push(self, frame, ts):
+        with self.cond:
+            full = self.head - self.tail >= self.capacity
+        if full:
+            self.dropped += 1
+            return False
+
+        # Only the producer touches slot `head`, so copy outside the lock
+        slot = self.head % self.capacity
+        self.frames[slot] = frame
+        self.ts[slot] = ts
+        with self.cond:
+            self.head += 1
+            self.cond.notify()
+        return True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def wait(self, n, timeout=0.5):
+        '''Wait until `n` frames are pending or the ring is closed.
+
+        Returns (slot, count) of a contiguous run of pending frames, which
+        may be shorter than `n` at the wrap-around or after close.
+        '''
+        with self.cond:
+            while self.head - self.tail < n and not self.closed:
+                self.cond.wait(timeout)
+            count = min(self.head - self.tail, n)
+        slot = self.tail % self.capacity
+        return slot, min(count, self.capacity - slot)
+
+    def release(self, count):
+        with self.cond:
+            self.tail += count
+
+
+def _deflate(args):
+    # Compress one chunk; zlib releases the GIL, so pool threads run in parallel
+    block, level = args
+    return zlib.compress(block.tobytes(), level)
+
+
+class FrameWriter(threading.Thread):
+    '''Writes frames from a FrameRing to HDF5 datasets one block at a time.
+
+    The datasets must be extendible along the first axis; they grow
+    geometrically as needed and should be trimmed to `written` at the end.
+    A block is one dataset chunk, or `workers` chunks compressed in parallel
+    when the frames dataset uses gzip.
+
+    The writer allocates its `ring` with room for at least `buffer_frames`,
+    rounded to whole blocks so blocks never straddle the wrap-around.
+    '''
+
+    def __init__(self, dset_frames, dset_ts, buffer_frames=32, workers=4):
+        threading.Thread.__init__(self)
+        self.dset_frames = dset_frames
+        self.dset_ts = dset_ts
+        self.chunk = dset_frames.chunks[0] if dset_frames.chunks else 8
+        self.written = 0
+
+        self.pool = None
+        if dset_frames.compression == 'gzip' and workers and \
+           hasattr(dset_frames.id, 'write_direct_chunk'):
+            self.pool = ThreadPool(workers)
+            self.level = dset_frames.compression_opts
+            self.block = self.chunk * workers
+        else:
+            self.block = self.chunk
+
+        nblocks = max(2, -(-int(buffer_frames) // self.block))
+        self.ring = FrameRing(nblocks * self.block, dset_frames.shape[1:],
+                              dset_frames.dtype)
+
+    def run(self):
+        ring = self.ring
+        try:
+            while 1:
+                slot, count = ring.wait(self.block)
+                if not count:
+                    if ring.closed:
+                        return
+                    continue
+
+                start = self.written
+                stop = start + count
+                self.grow(stop)
+
+                frames = ring.frames[slot:slot + count]
+                if self.pool:
+                    self.write_compressed(start, frames)
+                else:
+                    self.dset_frames[start:stop] = frames
+                self.dset_ts[start:stop] = ring.ts[slot:slot + count]
+                self.written = stop
+                ring.release(count)
+        finally:
+            if self.pool:
+                self.pool.close()
+
+    def grow(self, stop):
+        # Round up to whole chunks so direct chunk writes stay in bounds
+        stop = -(-stop // self.chunk) * self.chunk
+        if stop > self.dset_frames.shape[0]:
+            length = max(stop, 2 * self.dset_frames.shape[0])
+            self.dset_frames.resize((length, ) + self.dset_frames.shape[1:])
+        if stop > self.dset_ts.shape[0]:
+            self.dset_ts.resize((max(stop, 2 * self.dset_ts.shape[0]), ))
+
+    def write_compressed(self, start, frames):
+        # `start` is chunk-aligned since every block but the last is full
+        n = self.chunk
+        blocks = [frames[i:i + n] for i in range(0, len(frames), n)]
+        if len(blocks[-1]) < n:
+            # Pad final partial chunk; the dataset is trimmed afterwards
+            last = np.zeros((n, ) + frames.shape[1:], dtype=frames.dtype)
+            last[:len(blocks[-1])] = blocks[-1]
+            blocks[-1] = last
+
+        chunks = self.pool.map(_deflate, [(b, self.level) for b in blocks])
+        for i, data in enumerate(chunks):
+            offset = (start + i * n, ) + (0, ) * (frames.ndim - 1)
+            self.dset_frames.id.write_direct_chunk(offset, data)
@@ -0,0 +1,147 @@
+'''
+Host/Arduino clock synchronization
+
+Arduino timestamps are ms of `millis()` since the session started; host
+timestamps come from `host_time()`. During a session the host sends a sync
+ping ('S') every few seconds and the Arduino answers right away with
+
+    code_sync, ts, n        (n: number of the ping being answered)
+
+The reader thread stamps each reply with the host time it arrived, so every
+ping gives an Arduino ts bracketed by host send and receive times. At the
+end of the session a line is fitted through the midpoints of the fastest
+round trips, giving the host time of ts = 0 (offset) and the rate error
+between the clocks (drift, ppm of host time per Arduino ms; negative when
+the Arduino runs fast). Both are stored as attributes of the behavior group
+next to the raw exchanges (behavior/sync), and map any Arduino ts to host
+time in one call:
+
+    with h5py.File(filename, 'r') as f:
+        track_host = arduino_to_host(f['behavior/track'][0], f['behavior'].attrs)
+
+Camera frame timestamps are ms since `cam.attrs['start_host_time']`.
+'''
+
+import os
+import sys
+import time
+import numpy as np
+
+is_py2 = sys.version[0] == '2'
+
+code_sync = 8
+SYNC_COMMAND = b'S'
+
+# High-resolution wall clock (s since epoch) shared by all threads
+if not is_py2:
+    _offset = time.time() - time.perf_counter()
+
+    def host_time():
+        return _offset + time.perf_counter()
+elif os.name == 'nt':
+    # time.time() only ticks every ~16 ms on Windows
+    _offset = time.time() - time.clock()
+
+    def host_time():
+        return _offset + time.clock()
+else:
+    host_time = time.time
+
+
+class ClockSync(object):
+    '''Ping/echo exchanges with the Arduino and the clock fit.
+
+    Call `poll(ser)` on every tick while a session runs and `echo(event)`
+    for each code_sync event. Exchanges are kept in `samples` as
+    (arduino ts, host send, host receive).
+    '''
+
+    def __init__(self, interval=2., first=1.):
+        self.interval = interval        # s between pings
+        self.first = first              # s after reset() before the first ping
+        self.reset()
+
+    def reset(self):
+        self.sent = []                  # Host send time of each ping
+        self.samples = []
+        self.next_ping = host_time() + self.first
+
+    def poll(self, ser):
+        ''' Send a ping if one is due '''
+        now = host_time()
+        if now >= self.next_ping:
+            self.next_ping = now + self.interval
+            self.sent.append(host_time())
+            ser.write(SYNC_COMMAND)
+
+    def echo(self, event):
+        '''Record a code_sync event; returns (ts, send, receive) or None.
+
+        Replies to pings the host doesn't know about (e.g. from before
+        `reset()`) are ignored.
+        '''
+        ts, n = event[1], int(event[2])
+        received = event[3] if len(event) > 3 else host_time()
+        if not 0 <= n < len(self.sent):
+            return None
+        sample = (ts, self.sent[n], received)
+        self.samples.append(sample)
+        return sample
+
+    def fit(self, quantile=0.5):
+        ''' Clock parameters to store as attributes (see `fit_clock`) '''
+        return fit_clock(self.samples, quantile)
+
+
+def fit_clock(samples, quantile=0.5):
+    '''Fit host time = offset + ts / 1000 * (1 + drift * 1e-6).
+
+    `samples` is a sequence of (arduino ts, host send, host receive). Only
+    exchanges with a round trip at or below the `quantile` of all round trips
+    are used, since delayed replies have unknown one-way latency. Returns a
+    dict of clock_offset (s), clock_drift (ppm), clock_rms (ms residual),
+    clock_rtt (median round trip, ms) and clock_syncs (exchanges used).
+    Returns {} with fewer than two exchanges.
+    '''
+    samples = np.asarray(samples, dtype=float).reshape(-1, 3)
+    if len(samples) < 2:
+        return {}
+
+    ts = samples[:, 0] / 1000.
+    mid = (samples[:, 1] + samples[:, 2]) / 2
+    rtt = samples[:, 2] - samples[:, 1]
+    good = rtt <= np.percentile(rtt, 100 * quantile)
+    if good.sum() < 2 or np.ptp(ts[good]) == 0:
+        good[:] = True
+
+    # Fit relative to the first ping to keep epoch-sized numbers out of lstsq
+    t0 = mid[0]
+    if np.ptp(ts[good]) > 0:
+        slope, intercept = np.polyfit(ts[good], mid[good] - t0, 1)
+    else:
+        slope, intercept = 1., np.mean(mid[good] - t0 - ts[good])
+    residual = mid[good] - t0 - (intercept + slope * ts[good])
+
+    return {
+        'clock_offset': float(t0 + intercept),
+        'clock_drift': float((slope - 1) * 1e6),
+        'clock_rms': float(1000 * np.sqrt(np.mean(residual ** 2))),
+        'clock_rtt': float(1000 * np.median(rtt)),
+        'clock_syncs': int(good.sum()),
+    }
+
+
+def arduino_to_host(ts, attrs):
+    '''Host time (s since epoch) of Arduino timestamps `ts` (ms).
+
+    `attrs` holds clock_offset and clock_drift, e.g. the behavior group's
+    attrs. Works on scalars and arrays.
+    '''
+    drift = attrs['clock_drift'] * 1e-6
+    return attrs['clock_offset'] + np.asarray(ts, dtype=float) / 1000. * (1 + drift)
+
+
+def host_to_arduino(t, attrs):
+    ''' Inverse of `arduino_to_host`: Arduino ts (ms) of host times `t` (s) '''
+    drift = attrs['clock_drift'] * 1e-6
+    return (np.asarray(t, dtype=float) - attrs['clock_offset']) * 1000. / (1 + drift)
@@ -0,0 +1,159 @@
+'''
+Batched event dispatch
+
+Drains the serial event queue on each GUI tick instead of handling a single
+message per `after()` call. A per-tick time budget keeps the Tk loop
+responsive, and queue depth/lag are tracked so a growing backlog is visible.
+With a LatencyMonitor, queue wait and handling time of each event of a
+stamped batch are recorded as well (see rig/latency.py).
+
+Serial readers queue an EventBatch with everything parsed from one read, so
+a busy port costs one queue operation per read instead of one per event.
+drain() yields the events of a batch one by one. Give the dispatcher an
+EventQueue so its depth counts events rather than batches.
+'''
+
+import sys
+import time
+
+from rig.latency import now_ns
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+
+class EventBatch(list):
+    ''' Several events put on the queue at once, with read/queue times (ns) if stamped '''
+    __slots__ = ('t_read', 't_put')
+
+
+class EventQueue(Queue):
+    ''' Queue that also counts the events in the batches it holds '''
+
+    def _init(self, maxsize):
+        Queue._init(self, maxsize)
+        self.events = 0
+
+    # Called with the queue's mutex held
+    def _put(self, item):
+        Queue._put(self, item)
+        self.events += len(item) if isinstance(item, EventBatch) else 1
+
+    def _get(self):
+        item = Queue._get(self)
+        self.events -= len(item) if isinstance(item, EventBatch) else 1
+        return item
+
+    def pending(self):
+        ''' Number of events queued '''
+        with self.mutex:
+            return self.events
+
+    def clear(self):
+        ''' Drop everything queued '''
+        with self.mutex:
+            self.queue.clear()
+            self.events = 0
+
+
+class EventDispatcher(object):
+    '''Pulls events from a Queue in batches.
+
+    Events have the format [code, ts [, extra values...]], with `ts` in ms
+    from the Arduino session start. Lag is the difference between host time
+    elapsed since `reset()` and the timestamp of the last event handled.
+    '''
+
+    def __init__(self, q, budget=5, warn_depth=500, warn_lag=1000, clock_codes=None, latency=None):
+        self.q = q
+        self.clock_codes = clock_codes      # Codes whose 2nd value is a timestamp (None: all)
+        self.latency = latency              # LatencyMonitor (optional)
+        self.budget = budget / 1000.        # Max time (ms) spent per tick
+        self.warn_depth = warn_depth        # Warn when this many events wait (counted with an EventQueue)
+        self.warn_lag = warn_lag            # Warn when lag (ms) exceeds this
+        self.reset()
+
+    def reset(self):
+        ''' Clear statistics; call at session start '''
+        self.start = time.time()
+        self.handled = 0
+        self.depth = 0
+        self.lag = 0
+        self.max_depth = 0
+        self.max_lag = 0
+        self.last_ts = None
+        self.last_warn = 0
+        self.batch = ()         # Batch being handled
+        self.ix = 0             # Index of its next event
+
+    def drain(self, timeout=None):
+        '''Yield pending events until the queue is empty or budget is spent.
+
+        With `timeout` (s), first wait up to that long for an event; loops
+        without a GUI use this instead of polling.
+
+        Usage:
+            for q_in in dispatcher.drain():
+                ...
+        '''
+
+        deadline = None
+        while 1:
+            if self.ix >= len(self.batch):
+                try:
+                    if deadline is None and timeout:
+                        q_in = self.q.get(timeout=timeout)
+                    else:
+                        q_in = self.q.get_nowait()
+                except Empty:
+                    break
+                self.batch = q_in if isinstance(q_in, EventBatch) else (q_in, )
+                self.ix = 0
+                continue
+            batch = self.batch
+            q_in = batch[self.ix]
+            self.ix += 1
+            if deadline is None:
+                deadline = time.time() + self.budget
+
+            self.handled += 1
+            if len(q_in) > 1 and \
+               (self.clock_codes is None or q_in[0] in self.clock_codes):
+                self.last_ts = q_in[1]
+            if self.latency and hasattr(batch, 't_put'):
+                t_get = now_ns()
+                yield q_in
+                self.latency.handled(batch, t_get)
+            else:
+                yield q_in
+
+            if time.time() >= deadline:
+                break
+
+        self.update_stats()
+
+    def update_stats(self):
+        now = time.time()
+        queued = self.q.pending() if isinstance(self.q, EventQueue) else self.q.qsize()
+        self.depth = queued + len(self.batch) - self.ix
+        if self.last_ts is not None:
+            self.lag = (now - self.start) * 1000 - self.last_ts
+        self.max_depth = max(self.max_depth, self.depth)
+        self.max_lag = max(self.max_lag, self.lag)
+
+        # Rate-limited warning when falling behind
+        if (self.depth > self.warn_depth or self.lag > self.warn_lag) and \
+           now - self.last_warn > 5:
+            self.last_warn = now
+            print('Event backlog: {} queued, {:.0f} ms lag'.format(self.depth, self.lag))
+
+    def stats(self):
+        ''' Summary to store with session data '''
+        return {
+            'events_handled': self.handled,
+            'queue_max_depth': self.max_depth,
+            'queue_max_lag': self.max_lag,
+        }
@@ -0,0 +1,155 @@
+'''
+Connect handshake
+
+Brings a freshly opened Arduino (which resets when the port opens) to the
+point where it waits for the start signal, without fixed sleeps or polling
+loops. Handshake.run() steps through these states, each with its own
+timeout:
+
+    banner  setup() prints "Waiting for parameters..." once booted; moves
+            on without it after `banner_timeout`, or once other output
+            goes quiet (boards that don't reset, other firmware)
+    baud    faster baud rate, if the banner offers one (rig/baud.py)
+    upload  parameters as a binary block checked with a CRC, if the banner
+            offers it (rig/protocol.py), otherwise as '+'-joined values
+    ack     "Waiting for start signal ('E')." once they are processed
+    ready
+
+Every wait is a blocking read on the port with the time left as its
+timeout, so connecting takes as long as the board needs and no CPU.
+'''
+
+import time
+
+from rig.baud import negotiate_baud
+from rig.protocol import PARAM_VERSION, encode_params, offered_params
+
+BANNER = b'Waiting for parameters'      # Printed by setup() once booted
+READY = b'Waiting for start signal'     # Printed once parameters are processed
+SETTLE = 0.1        # s of quiet that ends the banner
+QUIET = 0.5         # s of quiet after other output that ends the wait for the banner
+PARAM_TRIES = 3     # Times a parameter block is sent before giving up
+
+
+class Handshake(object):
+    '''Connect to the Arduino on the open port `ser` and upload `values`.
+
+    `timeout` (s) applies to each wait, except that the banner is only
+    waited for `banner_timeout` (s; reset and boot take about 1 s).
+    `on_text(str)` receives everything the sketch prints (e.g. for printing). After run(), `state` is 'ready'
+    or the step that failed (with `error` saying why), `times` holds the
+    time spent in each step and `elapsed` the total connect time.
+    '''
+
+    STATES = ('banner', 'baud', 'upload', 'ack', 'ready')
+
+    def __init__(self, ser, values, timeout=5, banner_timeout=2, on_text=None):
+        self.ser = ser
+        self.values = list(values)
+        self.timeout = timeout
+        self.banner_timeout = banner_timeout
+        self.on_text = on_text
+        self.state = None
+        self.error = None
+        self.banner = ''
+        self.baudrate = ser.baudrate
+        self.times = {}
+        self.elapsed = 0.
+
+    def run(self):
+        ''' Returns True once the sketch waits for the start signal '''
+        t_start = time.time()
+        timeout = self.ser.timeout
+        try:
+            for state in self.STATES[:-1]:
+                self.state = state
+                t = time.time()
+                done = getattr(self, '_' + state)()
+                self.times[state] = time.time() - t
+                if not done:
+                    return False
+            self.state = 'ready'
+            return True
+        finally:
+            self.ser.timeout = timeout
+            self.elapsed = time.time() - t_start
+
+    def _readline(self, timeout):
+        self.ser.timeout = max(timeout, 0)
+        line = self.ser.readline()
+        if line and self.on_text:
+            self.on_text(line.decode('ascii', 'replace'))
+        return line
+
+    def _wait_for(self, marker):
+        # Lines up to the one containing `marker`; None on timeout
+        deadline = time.time() + self.timeout
+        lines = []
+        while time.time() < deadline:
+            line = self._readline(deadline - time.time())
+            lines.append(line)
+            if marker in line:
+                return lines
+        return None
+
+    def _banner(self):
+        # Boards that don't reset on open printed it before we connected, and
+        # other firmware may not print it; go on at the default rate and let
+        # the ack decide
+        deadline = time.time() + min(self.banner_timeout, self.timeout)
+        lines = []
+        while 1:
+            wait = deadline - time.time()
+            if lines:
+                wait = min(wait, QUIET)
+            if wait <= 0:
+                return True
+            line = self._readline(wait)
+            if not line:
+                if lines:
+                    return True
+                continue
+            lines.append(line)
+            if BANNER in line:
+                break
+
+        # Lines sent right after it (e.g. "Baud: ...") are part of the banner
+        line = self._readline(SETTLE)
+        while line:
+            lines.append(line)
+            line = self._readline(SETTLE)
+        self.banner = b''.join(lines).decode('ascii', 'replace')
+        return True
+
+    def _baud(self):
+        self.baudrate = negotiate_baud(self.ser, self.banner)
+        return True
+
+    def _upload(self):
+        self.ser.reset_input_buffer()
+        if offered_params(self.banner) == PARAM_VERSION:
+            return self._upload_block()
+
+        # The newline ends the sketch's last parseInt() instead of its 1 s timeout
+        self.ser.write(('+'.join(str(v) for v in self.values) + '\n').encode('ascii'))
+        return True
+
+    def _upload_block(self):
+        # Sketch echoes the block's CRC, or asks for it again with "P!"
+        block, crc = encode_params(self.values)
+        expected = 'P{}'.format(crc).encode('ascii')
+        for _ in range(PARAM_TRIES):
+            self.ser.write(block)
+            reply = self._readline(self.timeout).strip()
+            if reply == expected:
+                return True
+            if reply != b'P!':
+                break
+        self.error = 'Parameter block not acknowledged (reply {!r}).'.format(reply)
+        return False
+
+    def _ack(self):
+        if self._wait_for(READY) is None:
+            self.error = 'Start prompt not found; parameters may not have been processed.'
+            return False
+        return True
@@ -0,0 +1,160 @@
+'''
+Event latency instrumentation
+
+Optional timing of each stage an Arduino event passes through:
+
+    parse       serial bytes read -> event parsed and queued (per read)
+    queue       waiting in the event queue
+    dispatch    handling by the GUI / session loop
+    event       serial read -> handled (end to end)
+    storage     waiting in the StorageWorker queue
+    flush       HDF5 write of one block of samples
+    stop        stop command sent -> end code handled
+
+Readers stamp each EventBatch (everything parsed from one serial read, see
+rig/dispatch.py) with its read and queue times, so events stay ordinary
+[code, ts, value] lists and tracking adds no allocation per event.
+Each stage feeds a LatencyHistogram with fixed log-spaced buckets, so
+recording a sample is a bisect and an increment with no allocation.
+`summary()` flattens the histograms into attributes for the data file and
+`readout()` gives a one-line live display.
+'''
+
+import sys
+import time
+import bisect
+
+is_py2 = sys.version[0] == '2'
+
+# Nanosecond monotonic clock
+if hasattr(time, 'perf_counter_ns'):
+    now_ns = time.perf_counter_ns
+elif not is_py2:
+    def now_ns():
+        return int(time.perf_counter() * 1e9)
+elif sys.platform == 'win32':
+    def now_ns():
+        return int(time.clock() * 1e9)
+else:
+    def now_ns():
+        return int(time.time() * 1e9)
+
+# Bucket upper edges (us): 1-2-5 series from 10 us to 10 s
+EDGES_US = [m * 10 ** e for e in range(1, 7) for m in (1, 2, 5)] + [10 ** 7]
+
+STAGES = ['parse', 'queue', 'dispatch', 'event', 'storage', 'flush', 'stop']
+
+# Default budgets (ms) for stages with a requirement
+DEFAULT_BUDGET = {'event': 50, 'stop': 250}
+
+
+class LatencyHistogram(object):
+    ''' Counts of durations in fixed buckets, plus count, total, max and over-budget count '''
+
+    def __init__(self, budget_us=None):
+        self.budget_us = budget_us
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(EDGES_US) + 1)     # Last bucket: > 10 s
+        self.n = 0
+        self.total = 0
+        self.max = 0
+        self.over = 0
+
+    def add(self, ns):
+        us = ns // 1000
+        self.counts[bisect.bisect_left(EDGES_US, us)] += 1
+        self.n += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+        if self.budget_us is not None and us > self.budget_us:
+            self.over += 1
+
+    def percentile(self, q):
+        ''' Upper bucket edge (us) below which `q` % of samples fall '''
+        if not self.n:
+            return 0
+        target = self.n * q / 100.
+        cumulative = 0
+        for ix, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(EDGES_US[ix], self.max) if ix < len(EDGES_US) else self.max
+        return self.max
+
+    def mean(self):
+        return self.total / float(self.n) if self.n else 0
+
+
+class LatencyMonitor(object):
+    '''Histograms for every stage in STAGES.
+
+    `budget` maps stages to a limit (ms); samples above it are counted and
+    reported as latency_<stage>_over_budget.
+    '''
+
+    def __init__(self, budget=None):
+        self.budget = dict(DEFAULT_BUDGET if budget is None else budget)
+        self.stages = dict(
+            (stage, LatencyHistogram(self.budget[stage] * 1000 if stage in self.budget else None))
+            for stage in STAGES)
+        self.stop_sent = None
+
+    def reset(self):
+        for hist in self.stages.values():
+            hist.reset()
+        self.stop_sent = None
+
+    def add(self, stage, ns):
+        self.stages[stage].add(ns)
+
+    def stamp(self, batch, t_read):
+        ''' Mark `batch` (an EventBatch) as read at `t_read`; call right before queueing it '''
+        batch.t_read = t_read
+        batch.t_put = now_ns()
+        return batch
+
+    def handled(self, batch, t_get):
+        ''' Record queue, dispatch and end-to-end latency of an event of a stamped `batch` '''
+        t = now_ns()
+        self.stages['queue'].add(t_get - batch.t_put)
+        self.stages['dispatch'].add(t - t_get)
+        self.stages['event'].add(t - batch.t_read)
+
+    def stop_requested(self):
+        self.stop_sent = now_ns()
+
+    def stop_handled(self):
+        if self.stop_sent is not None:
+            self.stages['stop'].add(now_ns() - self.stop_sent)
+            self.stop_sent = None
+
+    def summary(self):
+        ''' Flat attributes: count, mean/p50/p99/max (us) and histogram per stage '''
+        attrs = {'latency_edges_us': EDGES_US}
+        for stage in STAGES:
+            hist = self.stages[stage]
+            prefix = 'latency_{}_'.format(stage)
+            attrs[prefix + 'count'] = hist.n
+            if not hist.n:
+                continue
+            attrs[prefix + 'mean_us'] = hist.mean()
+            attrs[prefix + 'p50_us'] = hist.percentile(50)
+            attrs[prefix + 'p99_us'] = hist.percentile(99)
+            attrs[prefix + 'max_us'] = hist.max
+            attrs[prefix + 'hist'] = hist.counts
+            if hist.budget_us is not None:
+                attrs[prefix + 'over_budget'] = hist.over
+        return attrs
+
+    def readout(self, stages=('event', 'queue', 'flush', 'stop')):
+        ''' Short live display: p99/max (ms) per stage '''
+        parts = []
+        for stage in stages:
+            hist = self.stages[stage]
+            if hist.n:
+                parts.append('{} {:.1f}/{:.1f}'.format(
+                    stage, hist.percentile(99) / 1000., hist.max / 1000.))
+        return 'p99/max ms: ' + ', '.join(parts) if parts else 'No events yet'
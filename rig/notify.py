@@ -0,0 +1,224 @@
+'''
+Slack notifications
+
+SlackNotifier sends messages from a background thread so the Tk loop never
+waits on the network. Recipients ('@user' or '#channel') are validated
+against user/channel lists that are cached for `cache_ttl` seconds instead of
+being fetched for every message. Network errors are retried a few times with
+exponential backoff before the message is dropped.
+
+Backends wrap the client libraries used by the GUIs (Slacker, SlackClient);
+LocalBackend stands in for Slack when testing without a network.
+'''
+
+import sys
+import time
+import threading
+import traceback
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    from Queue import Queue
+else:
+    from queue import Queue
+
+
+class SlackerBackend(object):
+    ''' Backend for a `slacker.Slacker` client '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def users(self):
+        return [user['name'] for user in self.client.users.list().body['members']]
+
+    def channels(self):
+        return [channel['name'] for channel in self.client.channels.list().body['channels']]
+
+    def post(self, recipient, msg, username, icon):
+        self.client.chat.post_message(recipient, msg, username=username, icon_emoji=icon)
+
+
+class SlackClientBackend(object):
+    ''' Backend for a `slackclient.SlackClient` client '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def call(self, method, **kwargs):
+        response = self.client.api_call(method, **kwargs)
+        if not response.get('ok'):
+            raise IOError('Slack {} failed: {}'.format(method, response.get('error')))
+        return response
+
+    def users(self):
+        return [user['name'] for user in self.call('users.list')['members']]
+
+    def channels(self):
+        return [channel['name'] for channel in self.call('channels.list')['channels']]
+
+    def post(self, recipient, msg, username, icon):
+        self.call('chat.postMessage', channel=recipient, text=msg,
+                  username=username, icon_emoji=icon)
+
+
+class LocalBackend(object):
+    '''Stand-in for Slack that keeps posted messages in `sent`.
+
+    The first `fail` API calls raise IOError and each call takes `delay`
+    seconds, to exercise the retry path and show that callers don't block.
+    '''
+
+    def __init__(self, users=(), channels=(), fail=0, delay=0):
+        self.user_names = list(users)
+        self.channel_names = list(channels)
+        self.fail = fail
+        self.delay = delay
+        self.calls = 0
+        self.sent = []
+
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            self.fail -= 1
+            raise IOError('Simulated network error')
+
+    def users(self):
+        self._call()
+        return self.user_names
+
+    def channels(self):
+        self._call()
+        return self.channel_names
+
+    def post(self, recipient, msg, username, icon):
+        self._call()
+        self.sent.append((recipient, msg))
+
+
+class Message(object):
+    '''A queued message; poll `done` from the GUI.
+
+    status: 'pending', 'sent', 'invalid' (bad recipient) or 'failed'
+    '''
+
+    def __init__(self, recipient, msg):
+        self.recipient = recipient
+        self.msg = msg
+        self.status = 'pending'
+        self.error = ''
+        self.done = threading.Event()
+
+    def finish(self, status, error=''):
+        self.status = status
+        self.error = error
+        self.done.set()
+
+
+class SlackNotifier(threading.Thread):
+    '''Sends Slack messages from a daemon thread.
+
+    `send()` returns a Message immediately. Call `close()` before exiting to
+    give queued messages (e.g. "Session ended.") a chance to go out.
+
+    `backend` may also be a function returning one; it is called on the
+    notifier thread when the first message is sent, so slow client imports
+    don't delay startup.
+    '''
+
+    def __init__(self, backend, username='Rig bot', icon=':squirrel:',
+                 cache_ttl=600, retries=3, backoff=1.):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.backend = backend
+        self.username = username
+        self.icon = icon
+        self.cache_ttl = cache_ttl      # Seconds before user/channel lists are refetched
+        self.retries = retries          # Attempts after the first failure
+        self.backoff = backoff          # Delay (s) before first retry, doubled each time
+
+        self.q = Queue()
+        self.cache = {}                 # {'users'/'channels': (fetch time, set of names)}
+        self.closing = threading.Event()
+        self.lock = threading.Lock()
+
+    def send(self, recipient, msg):
+        message = Message(recipient, msg)
+        with self.lock:
+            if not self.is_alive() and not self.closing.is_set():
+                self.start()
+        self.q.put(message)
+        return message
+
+    def close(self, timeout=5):
+        ''' Wait up to `timeout` s for queued messages, then stop '''
+        self.closing.set()
+        if self.is_alive():
+            self.q.put(None)
+            self.join(timeout)
+
+    def run(self):
+        if not hasattr(self.backend, 'post'):
+            try:
+                self.backend = self.backend()
+            except Exception:
+                print('Unable to set up Slack client')
+                traceback.print_exc()
+                self.backend = None
+
+        while 1:
+            message = self.q.get()
+            if message is None:
+                return
+            try:
+                self.deliver(message)
+            except Exception as err:
+                traceback.print_exc()
+                message.finish('failed', str(err))
+
+    def deliver(self, message):
+        if self.backend is None:
+            message.finish('failed', 'No Slack client available.')
+            return
+
+        recipient = message.recipient
+        if not recipient or recipient[0] not in '@#' or len(recipient) < 2:
+            print('Slack recipient invalid: {}'.format(recipient))
+            message.finish('invalid', 'Slack recipient is invalid.')
+            return
+
+        kind = 'users' if recipient[0] == '@' else 'channels'
+        try:
+            found = self.retry(self.lookup, kind, recipient[1:])
+            if not found:
+                print('Slack {} does not exist: {}'.format(kind[:-1], recipient[1:]))
+                message.finish('invalid', 'Slack {} does not exist: {}'.format(kind[:-1], recipient[1:]))
+                return
+            if message.msg:
+                self.retry(self.backend.post, recipient, message.msg, self.username, self.icon)
+        except (IOError, OSError) as err:
+            print('Unable to send Slack message: {}'.format(err))
+            message.finish('failed', str(err))
+            return
+        message.finish('sent')
+
+    def lookup(self, kind, name):
+        fetched, names = self.cache.get(kind, (None, None))
+        expired = fetched is None or time.time() - fetched > self.cache_ttl
+        if expired:
+            names = set(getattr(self.backend, kind)())
+            self.cache[kind] = (time.time(), names)
+        return name in names
+
+    def retry(self, func, *args):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except Exception as err:
+                if attempt == self.retries:
+                    raise IOError(str(err))
+                # Cut the wait short when the app is closing
+                self.closing.wait(delay)
+                delay *= 2
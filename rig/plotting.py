@@ -0,0 +1,255 @@
+'''
+Live plots
+
+RollingTrace shows the most recent `history` ms of a signal. Samples go into
+a fixed-size numpy ring buffer (O(1) per sample, no reallocation), and the
+line is redrawn at most `max_fps` times per second by blitting it over a
+cached background instead of redrawing the whole figure. Before drawing, the
+visible window is decimated to min/max pairs per pixel column, so the cost
+per frame depends on the axes width rather than the sample rate.
+
+The x-axis is time relative to the newest sample (-history..0), so axis
+limits and tick labels stay fixed and never force a full redraw.
+
+MilestoneRaster and TickRaster draw per-trial rasters from vertex arrays
+allocated once per session and updated in place, so handling an event costs
+the same on trial 100 as on trial 1. DrawScheduler coalesces the resulting
+redraw requests into at most one canvas draw per interval.
+
+SpanBar keeps all trial spans of a session progression strip in a single
+PolyCollection and blits it, instead of adding one axvspan patch per trial.
+'''
+
+import time
+import numpy as np
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import to_rgba_array
+
+
+class RollingTrace(object):
+    '''Blitted, decimated line of recent samples.
+
+    `line` should belong to `ax` on `canvas`; it is made animated so full
+    canvas draws only render the static background.
+    '''
+
+    def __init__(self, canvas, ax, line, history=10000, capacity=65536, max_fps=20):
+        self.canvas = canvas
+        self.ax = ax
+        self.line = line
+        self.history = history          # Window length (ms)
+        self.capacity = capacity        # Samples kept; older ones are overwritten
+        self.min_interval = 1. / max_fps
+
+        self.ts = np.zeros(capacity)
+        self.values = np.zeros(capacity)
+        self.head = 0                   # Next slot to write
+        self.count = 0
+        self.dirty = False
+        self.last_draw = 0
+        self.background = None
+
+        self.line.set_animated(True)
+        self.ax.set_xlim(-history, 0)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def reset(self):
+        self.head = 0
+        self.count = 0
+        self.line.set_data([], [])
+        self.canvas.draw()
+
+    def append(self, ts, value):
+        self.ts[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.dirty = True
+
+    def window(self):
+        ''' Samples within `history` of the newest one, oldest first '''
+        if self.count < self.capacity:
+            ts = self.ts[:self.count]
+            values = self.values[:self.count]
+        else:
+            ts = np.roll(self.ts, -self.head)
+            values = np.roll(self.values, -self.head)
+        if not len(ts):
+            return ts, values
+        start = np.searchsorted(ts, ts[-1] - self.history)
+        return ts[start:] - ts[-1], values[start:]
+
+    def decimate(self, x, y):
+        # Keep min and max of each pixel column when there are more samples
+        # than pixels; draws the same envelope with far fewer vertices
+        columns = max(int(self.ax.bbox.width), 1)
+        if len(x) <= 2 * columns:
+            return x, y
+
+        bins = ((x + self.history) * (columns / float(self.history))).astype(int)
+        starts = np.flatnonzero(np.diff(bins)) + 1
+        starts = np.concatenate(([0], starts))
+        y_min = np.minimum.reduceat(y, starts)
+        y_max = np.maximum.reduceat(y, starts)
+
+        x_dec = np.repeat(x[starts], 2)
+        y_dec = np.empty(2 * len(starts))
+        y_dec[0::2] = y_min
+        y_dec[1::2] = y_max
+        return x_dec, y_dec
+
+    def redraw(self, force=False):
+        ''' Blit the line if data changed and the frame interval has passed '''
+        now = time.time()
+        if not (self.dirty or force) or now - self.last_draw < self.min_interval:
+            return
+        if self.background is None:
+            self.canvas.draw()
+            return
+
+        self.last_draw = now
+        self.dirty = False
+        self.line.set_data(*self.decimate(*self.window()))
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.line)
+        self.canvas.blit(self.ax.bbox)
+
+    def on_draw(self, event):
+        # Full draw (first show, resize): cache background, then add line
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.line)
+
+
+class MilestoneRaster(object):
+    '''Vertical ticks marking when each trial passes a set of milestones.
+
+    One segment per (trial, milestone) is allocated up front in `collection`
+    (a LineCollection), hidden with NaN x values; segments are revealed by
+    writing their x values into the existing paths.
+    '''
+
+    def __init__(self, collection, n_trials, milestones):
+        self.collection = collection
+        self.milestones = np.asarray(milestones, dtype=float)
+        n = len(self.milestones)
+
+        segments = np.full((n_trials * n, 2, 2), np.nan)
+        segments[:, 0, 1] = np.repeat(np.arange(n_trials), n)
+        segments[:, 1, 1] = segments[:, 0, 1] + 1
+        collection.set_segments(segments)
+        self.paths = collection.get_paths()
+        self.passed = np.zeros((n_trials, n), dtype=bool)
+
+    def update(self, trial, progress, x):
+        '''Mark milestones of `trial` first exceeded by `progress` at `x`.
+
+        Returns True if anything changed (i.e. a redraw is needed); trials
+        outside the raster are ignored.
+        '''
+        if not 0 <= trial < len(self.passed):
+            return False
+        new = (progress > self.milestones) & ~self.passed[trial]
+        if not new.any():
+            return False
+
+        self.passed[trial] |= new
+        for ix in np.flatnonzero(new) + trial * len(self.milestones):
+            self.paths[ix].vertices[:, 0] = x
+        self.collection.stale = True
+        return True
+
+
+class TickRaster(object):
+    ''' One vertical tick per trial on `line` (a Line2D), NaN-separated '''
+
+    def __init__(self, line, n_trials):
+        self.line = line
+        self.x = np.full(3 * n_trials, np.nan)
+        self.y = np.full(3 * n_trials, np.nan)
+        self.y[0::3] = np.arange(n_trials)
+        self.y[1::3] = np.arange(n_trials) + 1
+        self.line.set_data(self.x, self.y)
+
+    def mark(self, trial, x):
+        ''' Returns False (nothing drawn) for trials outside the raster '''
+        if not 0 <= trial < len(self.x) // 3:
+            return False
+        self.x[3 * trial:3 * trial + 2] = x
+        # Line2D caches its data; have it re-read the arrays on next draw
+        self.line.set_data(self.x, self.y)
+        return True
+
+
+class DrawScheduler(object):
+    ''' Coalesces redraw requests into at most one `canvas.draw()` per `interval` s '''
+
+    def __init__(self, canvas, interval=0.2):
+        self.canvas = canvas
+        self.interval = interval
+        self.pending = False
+        self.last_draw = 0
+
+    def request(self):
+        self.pending = True
+
+    def poll(self, force=False):
+        ''' Draw if requested and due; call on every GUI tick '''
+        now = time.time()
+        if self.pending and (force or now - self.last_draw >= self.interval):
+            self.pending = False
+            self.last_draw = now
+            self.canvas.draw()
+
+
+class SpanBar(object):
+    '''Colored spans (e.g. one per trial) spanning the full height of `ax`.
+
+    Spans live in one animated PolyCollection with a polygon per trial
+    allocated by `reset()`; `add()` fills one in place and `blit()` redraws
+    just this axes over a cached background.
+    '''
+
+    def __init__(self, canvas, ax):
+        self.canvas = canvas
+        self.ax = ax
+        self.collection = PolyCollection([], closed=False, edgecolors='none',
+                                         transform=ax.get_xaxis_transform(),
+                                         animated=True)
+        ax.add_collection(self.collection)
+        self.paths = []
+        self.colors = np.zeros((0, 4))
+        self.dirty = False
+        self.background = None
+        canvas.mpl_connect('draw_event', self.on_draw)
+
+    def reset(self, n):
+        ''' Allocate `n` empty spans '''
+        # Zero-width polygons at x=0 are invisible until filled in
+        verts = np.zeros((n, 4, 2))
+        verts[:, :, 1] = [0, 1, 1, 0]
+        self.collection.set_verts(verts, closed=False)
+        self.paths = self.collection.get_paths()
+        self.colors = np.zeros((n, 4))
+        self.collection.set_facecolor(self.colors)
+        self.dirty = True
+
+    def add(self, ix, x0, x1, color):
+        self.paths[ix].vertices[:, 0] = [x0, x0, x1, x1]
+        self.colors[ix] = to_rgba_array(color)[0]
+        self.collection.set_facecolor(self.colors)
+        self.dirty = True
+
+    def blit(self):
+        ''' Redraw the strip if spans changed since the last draw '''
+        if not self.dirty or self.background is None:
+            return
+        self.dirty = False
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.collection)
+        self.canvas.blit(self.ax.bbox)
+
+    def on_draw(self, event):
+        # Full draw: cache the axes without the spans, then draw them on top
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.collection)
+        self.dirty = False
@@ -0,0 +1,100 @@
+'''
+Camera preview
+
+PreviewGrabber polls the camera on its own thread, shrinks each frame to the
+preview size with numpy block averaging and converts it to RGB, marking
+saturated blocks red and black (zero) blocks blue. The Tk loop only pastes
+the latest finished image into a PhotoImage. If the UI falls behind, older
+previews are overwritten and counted as skipped rather than queued.
+
+The grabber only calls `latest_frame()`, never `wait_for_frame()`, so it
+doesn't compete with the recording thread for frames.
+'''
+
+import time
+import threading
+import numpy as np
+
+
+def block_reduce(frame, factor, mode='mean'):
+    '''Block mean, min and max of `frame` over `factor` x `factor` blocks.
+
+    mode 'stride' just takes every `factor`-th pixel (fastest; used for all
+    three). Edges that don't fill a whole block are cropped.
+    '''
+    if mode == 'stride' or factor == 1:
+        sub = frame[::factor, ::factor]
+        return sub, sub, sub
+
+    h = frame.shape[0] // factor
+    w = frame.shape[1] // factor
+    blocks = frame[:h * factor, :w * factor].reshape(h, factor, w, factor)
+
+    # Reduce over rows first so the second pass runs on contiguous data
+    total = np.add.reduce(np.add.reduce(blocks, axis=1, dtype=np.uint32), axis=2)
+    low = np.minimum.reduce(np.minimum.reduce(blocks, axis=1), axis=2)
+    high = np.maximum.reduce(np.maximum.reduce(blocks, axis=1), axis=2)
+    return (total // (factor * factor)).astype(np.uint8), low, high
+
+
+def to_rgb(gray, low, high, under=(0, 0, 255), over=(255, 0, 0)):
+    ''' Gray image as RGB, blocks touching 0 / 255 colored `under` / `over` '''
+    rgb = np.repeat(gray[:, :, None], 3, axis=2)
+    rgb[low == 0] = under
+    rgb[high == 255] = over
+    return rgb
+
+
+class PreviewGrabber(threading.Thread):
+    '''Background producer of downsampled RGB previews.
+
+    Frames are reduced by the smallest integer factor that fits `size`
+    (height, width), by area averaging or striding (`mode`). Call `take()`
+    from the Tk loop; it returns the newest preview once, or None if
+    nothing new is ready.
+    '''
+
+    def __init__(self, cam, size=(256, 320), max_fps=30, mode='mean'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cam = cam
+        self.size = size
+        self.mode = mode            # 'mean' (area average) or 'stride'
+        self.interval = 1. / max_fps
+        self.stop_event = threading.Event()
+
+        self.lock = threading.Lock()
+        self.latest = None
+        self.grabbed = 0            # Previews produced
+        self.skipped = 0            # Previews replaced before being shown
+
+    def run(self):
+        while not self.stop_event.is_set():
+            t0 = time.time()
+            try:
+                frame = np.asarray(self.cam.latest_frame())
+            except Exception as err:
+                print("Preview stopped: {}".format(err))
+                return
+
+            factor = max(1, -(-frame.shape[0] // self.size[0]),
+                         -(-frame.shape[1] // self.size[1]))
+            rgb = to_rgb(*block_reduce(frame, factor, self.mode))
+
+            with self.lock:
+                if self.latest is not None:
+                    self.skipped += 1
+                self.latest = rgb
+                self.grabbed += 1
+
+            self.stop_event.wait(max(0, self.interval - (time.time() - t0)))
+
+    def take(self):
+        with self.lock:
+            rgb, self.latest = self.latest, None
+        return rgb
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(1)
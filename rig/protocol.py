@@ -0,0 +1,364 @@
+'''
+Binary serial protocol
+
+Optional fixed-width event records sent by the Arduino sketches in place of
+"code,ts[,value]" text lines. Each record is 10 bytes (little-endian):
+
+    byte 0      code | 0x80   (high bit marks the start of a record)
+    bytes 1-4   ts            uint32, ms from session start
+    bytes 5-8   value         int32 (0 for events without a value)
+    byte 9      checksum      XOR of bytes 0-8
+
+Plain text printed by the sketches (status messages) is 7-bit ASCII, so it
+can be interleaved with records and is returned separately by the decoder.
+
+LineDecoder does the same for the default text protocol, so readers can
+pull whole buffers with `ser.read(ser.in_waiting or 1)` instead of calling
+`ser.readline()` (one system call per byte) for every event.
+
+Sketches that print "Seq: 1" in their startup banner number the events of
+each code 0-255 (wrapping around), so the host can count lost, repeated
+and malformed events (LossCounter). Text lines carry the number as a
+suffix, "code,ts[,value];seq". Binary records grow to 11 bytes, with the
+number in byte 9 and the checksum (XOR of bytes 0-9) in byte 10; pass
+`seq=True` to FrameDecoder for these.
+
+Sketches that print "Params: 1" in their startup banner take session
+parameters as one binary block instead of '+'-joined text:
+
+    byte 0      'P'
+    byte 1      version (PARAM_VERSION)
+    byte 2      n, number of values
+    4n bytes    values, uint32 little-endian, in upload order
+    2 bytes     CRC-16/CCITT (binascii.crc_hqx, init 0xFFFF) of the above
+
+and answer "P<crc>" once the block checks out, or "P!" if it doesn't.
+'''
+
+import re
+import struct
+import binascii
+import threading
+import numpy as np
+
+
+FRAME_SIZE = 10
+FRAME_SEQ_SIZE = 11
+FRAME_FLAG = 0x80
+FRAME_DTYPE = np.dtype([
+    ('code', 'u1'),
+    ('ts', '<u4'),
+    ('value', '<i4'),
+    ('check', 'u1'),
+])
+FRAME_SEQ_DTYPE = np.dtype([
+    ('code', 'u1'),
+    ('ts', '<u4'),
+    ('value', '<i4'),
+    ('seq', 'u1'),
+    ('check', 'u1'),
+])
+EVENT_DTYPE = np.dtype([
+    ('code', 'u1'),
+    ('ts', '<u4'),
+    ('value', '<i4'),
+])
+
+_frame_struct = struct.Struct('<BIi')
+
+PARAM_FLAG = b'P'
+PARAM_VERSION = 1
+
+_event_start = set(b'-0123456789'[i:i + 1] for i in range(11))     # First byte of a text event
+
+
+def encode(code, ts, value=0, seq=None):
+    ''' Pack one event into a binary record (used by simulators/tests) '''
+    body = bytearray(_frame_struct.pack(code | FRAME_FLAG, ts, value))
+    if seq is not None:
+        body.append(seq & 0xFF)
+    check = 0
+    for b in body:
+        check ^= b
+    body.append(check)
+    return bytes(body)
+
+
+def offered_seq(banner):
+    ''' True if a sketch's startup banner says its events carry sequence numbers '''
+    return re.search(r'Seq: 1\b', banner) is not None
+
+
+def _checksum(rows):
+    return np.bitwise_xor.reduce(rows[:, :-1], axis=1)
+
+
+class LossCounter(object):
+    '''Counts gaps and repeats in each code's sequence numbers.
+
+    Decoders call `add()` with the codes and numbers of the events they
+    decode and `add_malformed()` for lines/records that don't parse. A gap
+    of 128 or more events in one code looks like a repeat (numbers wrap at
+    256). Counts are updated and read under a lock, so totals(), summary()
+    and readout() can be called from other threads while a reader adds.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.last = {}          # Last sequence number per code
+            self.received = {}      # Numbered events per code
+            self.lost = {}
+            self.duplicates = {}
+            self.malformed = 0
+
+    def add(self, codes, seqs):
+        codes = np.asarray(codes)
+        seqs = np.asarray(seqs, dtype=np.int64)
+        with self.lock:
+            for code in np.unique(codes).tolist():
+                new = seqs[codes == code]
+                if code in self.last:
+                    seq = np.concatenate(([self.last[code]], new))
+                else:
+                    seq = new
+                    self.received[code] = self.lost[code] = self.duplicates[code] = 0
+                self.last[code] = int(new[-1])
+
+                # Numbers skipped since the previous event; >= 128 means it went back
+                skipped = (np.diff(seq) - 1) & 0xFF
+                repeats = skipped >= 128
+                self.received[code] += len(new)
+                self.lost[code] += int(skipped[~repeats].sum())
+                self.duplicates[code] += int(np.count_nonzero(repeats))
+
+    def add_malformed(self, n=1):
+        with self.lock:
+            self.malformed += n
+
+    def snapshot(self):
+        ''' Copies of (received, lost, duplicates) per code and malformed '''
+        with self.lock:
+            return dict(self.received), dict(self.lost), dict(self.duplicates), self.malformed
+
+    def totals(self):
+        ''' (lost, duplicates, malformed) over all codes '''
+        _, lost, duplicates, malformed = self.snapshot()
+        return sum(lost.values()), sum(duplicates.values()), malformed
+
+    def summary(self, names=None):
+        '''Counts to store with session data.
+
+        `names` maps codes to stream names used in the per-stream keys.
+        '''
+        names = names or {}
+        received, lost, duplicates, malformed = self.snapshot()
+        stats = {
+            'serial_numbered': sum(received.values()),
+            'serial_lost': sum(lost.values()),
+            'serial_duplicates': sum(duplicates.values()),
+            'serial_malformed': malformed,
+        }
+        for code, count in lost.items():
+            name = names.get(code, str(code))
+            stats['serial_lost_' + name] = count
+            stats['serial_duplicates_' + name] = duplicates[code]
+        return stats
+
+    def readout(self, names=None):
+        ''' One-line summary for display '''
+        names = names or {}
+        _, lost_by_code, duplicates, malformed = self.snapshot()
+        lost = sum(lost_by_code.values())
+        duplicates = sum(duplicates.values())
+        streams = ', '.join('{} {}'.format(names.get(code, code), count)
+                            for code, count in sorted(lost_by_code.items()) if count)
+        return 'lost {}{}, repeated {}, malformed {}'.format(
+            lost, ' ({})'.format(streams) if streams else '', duplicates, malformed)
+
+
+class FrameDecoder(object):
+    '''Decodes whole `ser.read(n)` buffers into structured arrays.
+
+    Partial records at the end of a buffer are carried over to the next
+    call. Returns (events, text) where `events` has fields code, ts, value.
+    With `seq`, records carry sequence numbers, which are passed to `loss`
+    (a LossCounter) along with the number of corrupt records.
+    '''
+
+    def __init__(self, seq=False, loss=None):
+        self.size = FRAME_SEQ_SIZE if seq else FRAME_SIZE
+        self.dtype = FRAME_SEQ_DTYPE if seq else FRAME_DTYPE
+        self.offsets = np.arange(self.size)
+        self.loss = loss
+        self.pending = b''
+        self.bad_frames = 0     # Candidate records that failed checksum
+
+    def decode(self, data):
+        buf = np.frombuffer(self.pending + bytes(data), dtype=np.uint8)
+        n = len(buf)
+        size = self.size
+        self.pending = b''
+        if n == 0:
+            return np.empty(0, dtype=EVENT_DTYPE), ''
+
+        # Fast path: buffer is nothing but back-to-back records
+        nfull = n // size
+        if nfull and buf[0] & FRAME_FLAG:
+            rows = buf[:nfull * size].reshape(nfull, size)
+            if np.all(rows[:, 0] & FRAME_FLAG) and \
+               np.array_equal(_checksum(rows), rows[:, -1]):
+                self.pending = buf[nfull * size:].tobytes()
+                return self._to_events(rows), ''
+
+        # General path: records mixed with text; validate every candidate
+        starts = np.flatnonzero(buf[:max(n - size + 1, 0)] & FRAME_FLAG)
+        rows = buf[starts[:, None] + self.offsets]
+        valid = _checksum(rows) == rows[:, -1]
+        self.bad_frames += int(np.count_nonzero(~valid))
+        starts = starts[valid]
+        rows = rows[valid]
+
+        # Drop candidates overlapping the last record kept (a check byte with
+        # the flag set can start a candidate that passes by chance)
+        keep = []
+        last = -size
+        for i, start in enumerate(starts.tolist()):
+            if start - last >= size:
+                keep.append(i)
+                last = start
+        starts = starts[keep]
+        rows = rows[keep]
+
+        covered = np.zeros(n, dtype=bool)
+        covered[(starts[:, None] + self.offsets).ravel()] = True
+
+        # Keep a possible partial record at the end for the next read
+        end = starts[-1] + size if len(starts) else 0
+        tail = max(end, n - size + 1)
+        flagged = np.flatnonzero(buf[tail:] & FRAME_FLAG)
+        cut = tail + flagged[0] if len(flagged) else n
+        self.pending = buf[cut:].tobytes()
+
+        if self.loss is not None:
+            # Record starts outside any valid record: one per corrupt record
+            corrupt = np.flatnonzero(~covered[:cut] & (buf[:cut] >= FRAME_FLAG)).tolist()
+            last = -size
+            malformed = 0
+            for i in corrupt:
+                if i - last >= size:
+                    malformed += 1
+                    last = i
+            if malformed:
+                self.loss.add_malformed(malformed)
+
+        text = buf[:cut][~covered[:cut] & (buf[:cut] < FRAME_FLAG)]
+        return self._to_events(rows), text.tobytes().decode('ascii', 'replace')
+
+    def _to_events(self, rows):
+        events = np.empty(len(rows), dtype=EVENT_DTYPE)
+        frames = np.ascontiguousarray(rows).view(self.dtype).ravel()
+        events['code'] = frames['code'] & (FRAME_FLAG - 1)
+        events['ts'] = frames['ts']
+        events['value'] = frames['value']
+        if self.loss is not None and 'seq' in self.dtype.names and len(frames):
+            self.loss.add(events['code'], frames['seq'])
+        return events
+
+
+class LineDecoder(object):
+    '''Decodes whole `ser.read(n)` buffers of "code,ts[,value]" lines.
+
+    Bytes after the last newline are kept in a reusable buffer until the
+    rest of the line arrives. Returns (events, text) like FrameDecoder, with
+    `events` a list of int lists; lines that aren't events (status messages)
+    are returned as text. Sequence numbers (";seq" suffix) are stripped and
+    passed to `loss` (a LossCounter), which also counts lines that start
+    like an event but don't parse as one.
+    '''
+
+    def __init__(self, loss=None):
+        self.pending = bytearray()
+        self.loss = loss
+
+    def decode(self, data):
+        pending = self.pending
+        pending += data
+        end = pending.rfind(b'\n') + 1
+        if not end:
+            return [], ''
+        lines = bytes(pending[:end]).split(b'\n')
+        del pending[:end]
+        lines.pop()         # Empty remainder after the last newline
+
+        events = []
+        text = []
+        codes = []
+        seqs = []
+        malformed = 0
+        for line in lines:
+            body, numbered, seq = line.partition(b';')
+            try:
+                event = [int(x) for x in body.split(b',')]
+                if numbered:
+                    seq = int(seq)
+                if len(event) < 2:
+                    raise ValueError
+            except ValueError:
+                line = line.strip()
+                if not line:
+                    continue
+                if line[:1] in _event_start:
+                    malformed += 1
+                text.append(line.decode('ascii', 'replace') + '\n')
+                continue
+            events.append(event)
+            if numbered:
+                codes.append(event[0])
+                seqs.append(seq)
+
+        if self.loss is not None:
+            if seqs:
+                self.loss.add(codes, seqs)
+            if malformed:
+                self.loss.add_malformed(malformed)
+        return events, ''.join(text)
+
+
+def offered_params(banner):
+    ''' Parameter block version announced in a sketch's startup banner (None if none) '''
+    match = re.search(r'Params: (\d+)', banner)
+    return int(match.group(1)) if match else None
+
+
+def encode_params(values):
+    '''Binary parameter block for `values` (ints, 0 to 2**32 - 1).
+
+    Returns (block, crc); the sketch echoes `crc` once it has the block.
+    '''
+    values = [int(v) for v in values]
+    if len(values) > 255:
+        raise ValueError('Too many parameters: {}'.format(len(values)))
+    for value in values:
+        if not 0 <= value < 2 ** 32:
+            raise ValueError('Parameter out of range: {}'.format(value))
+    block = PARAM_FLAG + struct.pack('<BB{}I'.format(len(values)), PARAM_VERSION, len(values), *values)
+    crc = binascii.crc_hqx(block, 0xFFFF)
+    return block + struct.pack('<H', crc), crc
+
+
+def decode_params(block):
+    ''' (values, crc) from a parameter block; None if it is incomplete or corrupt '''
+    block = bytes(block)
+    if len(block) < 5 or block[:1] != PARAM_FLAG:
+        return None
+    version, n = struct.unpack('<BB', block[1:3])
+    if version != PARAM_VERSION or len(block) != 5 + 4 * n:
+        return None
+    crc = binascii.crc_hqx(block[:-2], 0xFFFF)
+    if struct.unpack('<H', block[-2:])[0] != crc:
+        return None
+    return list(struct.unpack('<{}I'.format(n), block[3:-2])), crc
@@ -0,0 +1,323 @@
+'''
+Simulated hardware
+
+SimulatedArduino opens a pseudo-terminal and speaks the same serial protocol
+as the rig sketches, so the GUIs and `scan_serial` can be driven without an
+Arduino attached:
+
+    1. Prints a startup banner (after a short "reset" delay), offering
+       sequence-numbered events unless `seq` is False.
+    2. Answers baud rate proposals (rig/baud.py); a pty has no baud rate,
+       so every rate up to `max_baud` is accepted.
+    3. Reads parameters as a binary block (rig/protocol.py, answered with
+       "P<crc>" or "P!"), or as '+'-joined text once the upload goes quiet.
+    4. Waits for the start signal 'E' ('0' ends the session).
+    5. Streams code_track/code_steps/trial events at configurable rates,
+       handling '0' (stop), 'F' (manual trial) and 'S' (clock sync) while
+       running. `drift` (ppm) makes the simulated clock run fast or slow,
+       `drop` is the fraction of events lost on the way (their sequence
+       numbers are still used, so the host can count them).
+
+SimulatedCamera stands in for an `instrumental` camera.
+
+Run standalone to get a port for any of the GUIs:
+
+    python -m rig.simulator --track-rate 2000 --binary
+'''
+
+import os
+import sys
+import time
+import select
+import random
+import argparse
+import threading
+import numpy as np
+
+from rig.protocol import PARAM_FLAG, PARAM_VERSION, decode_params, encode
+
+if os.name != 'nt':
+    import pty
+    import tty
+
+
+# Serial codes (shared by conveyor and odor-presentation sketches)
+code_end = 0
+code_steps = 1
+code_trial_start = 3
+code_rail_leave = 5
+code_rail_home = 6
+code_track = 7
+code_sync = 8
+
+
+class SimulatedArduino(threading.Thread):
+    '''Arduino stand-in on a pty; connect to `self.port`.
+
+    Rates are in events/s (0 disables a stream). Trials start `trial_start`
+    (ms) into the session and stop after `trial_num` (None: no limit).
+    `duration` (ms) ends the session like the sketches do; None runs until
+    '0' is received.
+    '''
+
+    def __init__(self, track_rate=20, steps_rate=0, trial_rate=0., trial_start=0, trial_num=None,
+                 duration=None, binary=False, reset_delay=0.5, drift=0., max_baud=1000000,
+                 param_block=True, seq=True, drop=0.,
+                 banner='Simulated Arduino\nWaiting for parameters...'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.rates = {
+            code_track: track_rate,
+            code_steps: steps_rate,
+            code_trial_start: trial_rate,
+        }
+        self.trial_start = trial_start
+        self.trial_num = trial_num
+        self.duration = duration
+        self.binary = binary
+        self.reset_delay = reset_delay
+        self.drift = drift
+        self.max_baud = max_baud    # None: no negotiation, like older sketches
+        self.param_block = param_block  # False: text parameters only, like older sketches
+        self.seq = seq              # False: unnumbered events, like older sketches
+        self.drop = drop
+        self.banner = banner
+
+        self.parameters = []
+        self.baudrate = 9600
+        self.seqs = {}              # Next sequence number of each code
+        self.sent = 0               # Number of events sent
+        self.dropped = 0            # Number of events dropped
+        self.bytes_sent = 0         # Bytes of events sent
+        self.stop_event = threading.Event()
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def close(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(1)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def write_line(self, line):
+        os.write(self.master, (line.replace('\n', '\r\n') + '\r\n').encode('ascii'))
+
+    def read(self, timeout):
+        # Returns available bytes, or b'' if nothing arrived within timeout
+        ready, _, _ = select.select([self.master], [], [], timeout)
+        if not ready:
+            return b''
+        try:
+            return os.read(self.master, 1024)
+        except OSError:
+            return b''
+
+    def encode_event(self, code, ts, value=None):
+        # Returns b'' for a dropped event
+        seq = None
+        if self.seq:
+            seq = self.seqs.get(code, 0)
+            self.seqs[code] = (seq + 1) & 0xFF
+        if self.drop and code != code_end and random.random() < self.drop:
+            self.dropped += 1
+            return b''
+
+        if self.binary:
+            return encode(code, ts, value or 0, seq)
+        line = '{},{}'.format(code, ts) if value is None else '{},{},{}'.format(code, ts, value)
+        if seq is not None:
+            line += ';{}'.format(seq)
+        return (line + '\r\n').encode('ascii')
+
+    def run(self):
+        # Startup banner, as printed in setup()
+        if self.stop_event.wait(self.reset_delay):
+            return
+        self.write_line(self.banner)
+        if self.max_baud:
+            self.write_line('Baud: {}'.format(self.max_baud))
+        if self.param_block:
+            self.write_line('Params: {}'.format(PARAM_VERSION))
+        if self.seq:
+            self.write_line('Seq: 1')
+
+        # Parameters: binary block or '+'-joined ints, ended by a quiet period
+        upload = b''
+        while not self.stop_event.is_set():
+            data = self.read(0.05)
+            if self.max_baud and not upload and data.startswith(b'B'):
+                # "B<rate>\n" proposal, or "B" confirming the new rate
+                rate = int(data[1:].strip() or self.baudrate)
+                if rate <= self.max_baud:
+                    self.baudrate = rate
+                self.write_line('B{}'.format(rate if rate <= self.max_baud else 0))
+                continue
+            if data:
+                upload += data
+                continue
+            if not upload:
+                continue
+            if not (self.param_block and upload.startswith(PARAM_FLAG)):
+                self.parameters = [int(x) for x in upload.decode('ascii').split('+') if x.strip()]
+                break
+            decoded = decode_params(upload)
+            upload = b''
+            if decoded:
+                self.parameters, crc = decoded
+                self.write_line('P{}'.format(crc))
+                break
+            self.write_line('P!')
+        self.write_line("Paremeters processed.")
+        self.write_line("Waiting for start signal ('E').")
+
+        # Start signal
+        while not self.stop_event.is_set():
+            data = self.read(0.1)
+            if b'0' in data:
+                os.write(self.master, self.encode_event(code_end, 0))
+                return
+            if b'E' in data:
+                break
+
+        self.stream()
+
+    def stream(self):
+        start = time.time()
+        next_event = dict((code, 0.) for code, rate in self.rates.items() if rate)
+        if code_trial_start in next_event:
+            next_event[code_trial_start] = self.trial_start / 1000. if self.trial_num != 0 else float('inf')
+        trials = 0
+        syncs = 0
+
+        while not self.stop_event.is_set():
+            now = (time.time() - start) * (1 + self.drift * 1e-6)
+            ts = int(now * 1000)
+            out = []
+
+            # Commands from computer
+            data = self.read(0)
+            if b'F' in data:
+                out.append(self.encode_event(code_rail_leave, ts))
+                out.append(self.encode_event(code_trial_start, ts, 1))
+                out.append(self.encode_event(code_rail_home, ts))
+            for _ in range(data.count(b'S')):
+                out.append(self.encode_event(code_sync, ts, syncs))
+                syncs += 1
+            if b'0' in data or (self.duration is not None and ts >= self.duration):
+                out.append(self.encode_event(code_end, ts))
+                self.bytes_sent += os.write(self.master, b''.join(out))
+                return
+
+            # Event streams due by now
+            for code in next_event:
+                period = 1. / self.rates[code]
+                while next_event[code] <= now:
+                    event_ts = int(next_event[code] * 1000)
+                    if code == code_trial_start:
+                        out.append(self.encode_event(code_rail_leave, event_ts))
+                        out.append(self.encode_event(code_trial_start, event_ts, 0))
+                        out.append(self.encode_event(code_rail_home, event_ts))
+                        trials += 1
+                        if trials == self.trial_num:
+                            next_event[code] = float('inf')
+                            break
+                    elif code == code_steps:
+                        out.append(self.encode_event(code, event_ts, random.randint(0, 127)))
+                    else:
+                        out.append(self.encode_event(code, event_ts, random.choice([-1, 1]) * random.randint(1, 10)))
+                    next_event[code] += period
+
+            out = [event for event in out if event]
+            if out:
+                self.sent += len(out)
+                self.bytes_sent += os.write(self.master, b''.join(out))
+            time.sleep(0.001)
+
+
+class SimulatedCamera(object):
+    ''' Minimal stand-in for an `instrumental` camera '''
+
+    max_height, max_width = (1024, 1280)
+
+    def __init__(self):
+        self.framerate = 10.
+        self.height = self.max_height
+        self.width = self.max_width
+        self.next_frame = time.time()
+        self.frame_ct = 0
+        self.frames = None
+
+    def start_live_video(self, framerate='10Hz', top=0, bot=None, left=0, right=None, **kwargs):
+        self.framerate = float(str(framerate).rstrip('Hz'))
+        self.height = (bot if bot is not None else self.max_height) - top
+        self.width = (right if right is not None else self.max_width) - left
+        self.next_frame = time.time()
+
+        # A few noise frames to cycle through
+        self.frames = np.random.randint(0, 256, size=(4, self.height, self.width)).astype('uint8')
+
+    def wait_for_frame(self, timeout=None):
+        delay = self.next_frame - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame = max(self.next_frame + 1. / self.framerate, time.time())
+        self.frame_ct += 1
+        return True
+
+    def latest_frame(self, copy=True):
+        if self.frames is None:
+            self.start_live_video()
+        return self.frames[self.frame_ct % len(self.frames)]
+
+    def close(self):
+        self.frames = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Arduino on a pseudo-terminal')
+    parser.add_argument('--track-rate', type=float, default=20, help='code_track events/s')
+    parser.add_argument('--steps-rate', type=float, default=0, help='code_steps events/s')
+    parser.add_argument('--trial-rate', type=float, default=0, help='trials/s')
+    parser.add_argument('--trial-start', type=int, default=0, help='time of the first trial (ms)')
+    parser.add_argument('--trial-num', type=int, default=None, help='number of trials (default: no limit)')
+    parser.add_argument('--duration', type=int, default=None, help='session length (ms)')
+    parser.add_argument('--binary', action='store_true', help='send binary records')
+    parser.add_argument('--drift', type=float, default=0, help='clock rate error (ppm)')
+    parser.add_argument('--max-baud', type=int, default=1000000, help='fastest baud rate offered (0: none)')
+    parser.add_argument('--text-params', action='store_true', help='no binary parameter block')
+    parser.add_argument('--no-seq', action='store_true', help='events without sequence numbers')
+    parser.add_argument('--drop', type=float, default=0, help='fraction of events dropped')
+    parser.add_argument('--linger', type=float, default=2, help='seconds to keep the port open after the session')
+    args = parser.parse_args()
+
+    sim = SimulatedArduino(args.track_rate, args.steps_rate, args.trial_rate,
+                           trial_start=args.trial_start, trial_num=args.trial_num, duration=args.duration, binary=args.binary, drift=args.drift,
+                           max_baud=args.max_baud, param_block=not args.text_params,
+                           seq=not args.no_seq, drop=args.drop)
+    print('Simulated Arduino on {}'.format(sim.port))
+    sim.start()
+    try:
+        while sim.is_alive():
+            sim.join(0.5)
+    except KeyboardInterrupt:
+        pass
+    print('Events sent: {}'.format(sim.sent))
+    print('Bytes sent: {}'.format(sim.bytes_sent))
+    print('Events dropped: {}'.format(sim.dropped))
+    sys.stdout.flush()
+
+    # A board stays connected after its session ends; closing the pty right
+    # away would drop the end code before the host has read it
+    time.sleep(args.linger)
+    sim.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Startup timing and deferred imports
+
+Import this module first thing in a GUI script and call `install()` to time
+every top-level import made by the main thread. `report()` prints the slowest
+imports and the time from launch until the window is up, so startup
+regressions show up as a number:
+
+    from rig import startup
+    startup.install()
+    ...
+    root.after_idle(startup.report)
+    root.mainloop()
+
+Modules needed only for some actions are wrapped with `lazy_import()` and
+loaded on first attribute access (also timed).
+'''
+
+import sys
+import time
+import types
+import threading
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    import __builtin__ as builtins
+else:
+    import builtins
+
+start = time.time()
+timings = []                # (module, seconds) in import order
+time_to_window = None       # Seconds from launch to `report()`
+
+_original_import = builtins.__import__
+_main_thread = threading.current_thread()
+_state = {'depth': 0}
+
+
+def _timed_import(name, *args, **kwargs):
+    # Only time outermost imports of the main thread, and only the first load
+    if threading.current_thread() is not _main_thread or _state['depth'] or \
+       name in sys.modules:
+        return _original_import(name, *args, **kwargs)
+
+    _state['depth'] += 1
+    t0 = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        _state['depth'] -= 1
+        timings.append((name, time.time() - t0))
+
+
+def install():
+    ''' Start timing imports '''
+    builtins.__import__ = _timed_import
+
+
+def uninstall():
+    builtins.__import__ = _original_import
+
+
+class LazyModule(types.ModuleType):
+    ''' Module proxy that imports `name` on first attribute access '''
+
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            t0 = time.time()
+            _original_import(self.__name__)
+            self.__dict__['_module'] = sys.modules[self.__name__]
+            timings.append((self.__name__ + ' (lazy)', time.time() - t0))
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def set_plot_style(style='dark'):
+    '''Seaborn-like plot style without importing seaborn when possible.
+
+    Uses matplotlib's bundled copy of the seaborn style and falls back to
+    seaborn itself for older matplotlib versions.
+    '''
+    import matplotlib.style
+    for name in ('seaborn-v0_8-' + style, 'seaborn-' + style):
+        if name in matplotlib.style.available:
+            matplotlib.style.use(name)
+            return
+    import seaborn
+    seaborn.set_style(style)
+
+
+def report(n=10):
+    '''Print the `n` slowest imports and time to window; stops timing.
+
+    Call from the Tk loop (e.g. `root.after_idle`) once the window is drawn.
+    '''
+    global time_to_window
+    uninstall()
+    time_to_window = time.time() - start
+
+    print('Startup: window after {:.2f} s'.format(time_to_window))
+    for name, duration in sorted(timings, key=lambda x: -x[1])[:n]:
+        print('  {:<32} {:7.3f} s'.format(name, duration))
+    return time_to_window
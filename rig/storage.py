@@ -0,0 +1,238 @@
+'''
+HDF5 storage for behavior data
+
+BehaviorWriter buffers events per dataset and writes them in contiguous
+blocks, so each HDF5 write covers many samples instead of one. Datasets keep
+the layout the GUIs always used: 1-D arrays indexed by trial, and (2, N)
+arrays of [ts, value] columns for steps/track. They are extendible and grow
+geometrically, so session length is unbounded; trim them to the final
+counters when the session ends.
+
+StorageWorker runs a BehaviorWriter on its own thread and owns the behavior
+datasets from session start to close, so the Tk loop only enqueues events.
+Write errors don't stop the worker, but close() raises StorageError so lost
+data doesn't go unnoticed. Given a LatencyMonitor, it records how long writes wait in its queue and how long
+each block takes to write (see rig/latency.py).
+'''
+
+import sys
+import time
+import threading
+import traceback
+import numpy as np
+
+from rig.latency import now_ns
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+
+class GrowableArray(object):
+    '''In-memory counterpart of the extendible datasets.
+
+    Appends are amortized O(1): capacity doubles when full. `data` is a view
+    of the filled part, shape (n, ) or (rows, n).
+    '''
+
+    def __init__(self, dtype, rows=None, capacity=1024):
+        self.rows = rows
+        self.n = 0
+        shape = (rows, capacity) if rows else (capacity, )
+        self.buffer = np.zeros(shape, dtype=dtype)
+
+    def __len__(self):
+        return self.n
+
+    def append(self, value):
+        capacity = self.buffer.shape[-1]
+        if self.n == capacity:
+            shape = (self.rows, 2 * capacity) if self.rows else (2 * capacity, )
+            buffer = np.zeros(shape, dtype=self.buffer.dtype)
+            buffer[..., :capacity] = self.buffer
+            self.buffer = buffer
+        self.buffer[..., self.n] = value
+        self.n += 1
+
+    @property
+    def data(self):
+        return self.buffer[..., :self.n]
+
+
+class _Stream(object):
+    # Pending values for one dataset, starting at index `start`
+
+    def __init__(self, dset, rows):
+        self.dset = dset
+        self.rows = rows            # None for 1-D datasets, else number of rows
+        self.start = 0
+        self.pending = []
+        self.length = dset.shape[-1]    # Allocated samples on disk
+
+
+class BehaviorWriter(object):
+    '''Buffered writer for the 'behavior' group.
+
+    Values are flushed when `flush_size` are pending for a dataset or, via
+    `poll()`, when `flush_interval` seconds have passed since the last
+    flush. `chunk_size` sets the HDF5 chunk length along the sample axis.
+    '''
+
+    def __init__(self, group, chunk_size=4096, flush_size=1024, flush_interval=1.):
+        self.group = group
+        self.chunk_size = chunk_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.streams = {}
+        self.last_flush = time.time()
+        self.latency = None         # LatencyMonitor (optional)
+
+    def create(self, name, dtype, rows=None):
+        ''' Create extendible dataset `name` with shape (n, ) or (rows, n) '''
+        chunk = self.chunk_size
+        if rows:
+            shape, chunks, maxshape = (rows, chunk), (rows, chunk), (rows, None)
+        else:
+            shape, chunks, maxshape = (chunk, ), (chunk, ), (None, )
+        dset = self.group.create_dataset(name=name, dtype=dtype, shape=shape,
+                                         chunks=chunks, maxshape=maxshape)
+        self.streams[name] = _Stream(dset, rows)
+        return dset
+
+    def write(self, name, index, value):
+        ''' Set sample `index` of dataset `name` (value is a row tuple for 2-D) '''
+        stream = self.streams[name]
+        if stream.pending and index != stream.start + len(stream.pending):
+            self._flush_stream(stream)
+        if not stream.pending:
+            stream.start = index
+        stream.pending.append(value)
+
+        if len(stream.pending) >= self.flush_size:
+            self._flush_stream(stream)
+
+    def poll(self):
+        ''' Flush if `flush_interval` has elapsed; call periodically '''
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        for stream in self.streams.values():
+            self._flush_stream(stream)
+        self.last_flush = time.time()
+
+    def _flush_stream(self, stream):
+        if not stream.pending:
+            return
+        t0 = now_ns() if self.latency else 0
+        start = stream.start
+        stop = start + len(stream.pending)
+        data = np.asarray(stream.pending, dtype=stream.dset.dtype)
+
+        # Grow geometrically to keep appends amortized O(1)
+        if stop > stream.length:
+            stream.length = max(stop, 2 * stream.length)
+            if stream.rows:
+                stream.dset.resize((stream.rows, stream.length))
+            else:
+                stream.dset.resize((stream.length, ))
+        if stream.rows:
+            stream.dset[:, start:stop] = data.T
+        else:
+            stream.dset[start:stop] = data
+        stream.pending = []
+        if self.latency:
+            self.latency.add('flush', now_ns() - t0)
+
+
+class StorageError(IOError):
+    ''' Raised by StorageWorker.close() when operations failed on the storage thread '''
+
+
+class StorageWorker(threading.Thread):
+    '''Write-behind thread for a session's HDF5 file.
+
+    Create datasets through `writer` before `start()`. Afterwards the
+    writer's datasets and the file's attributes must only be touched from
+    this thread: use `write()` for samples, `call()` for anything else and
+    `close()` to finish the session. Other threads may fill datasets of
+    their own in the same file (e.g. the camera FrameWriter's cam/*), since
+    h5py serializes calls with its global lock, but must be done before
+    `close()`.
+    '''
+
+    def __init__(self, data_file, writer, latency=None):
+        threading.Thread.__init__(self)
+        self.data_file = data_file
+        self.writer = writer
+        self.writer.latency = latency
+        self.latency = latency
+        self.q = Queue()
+        self.error = None           # First failed operation
+        self.failed = 0             # Number of failed operations
+
+    def write(self, name, index, value):
+        if self.latency:
+            self.q.put(('write', name, index, value, now_ns()))
+        else:
+            self.q.put(('write', name, index, value))
+
+    def call(self, func, *args):
+        ''' Run `func(*args)` on the storage thread '''
+        self.q.put(('call', func, args))
+
+    def close(self, resize=None, attrs=None):
+        '''Flush, resize, write attributes and close the file; waits for the thread.
+
+        resize: {dataset path: final shape}
+        attrs: {group path: {key: value}}
+
+        Raises StorageError if any operation failed during the session.
+        '''
+        self.q.put(('close', resize or {}, attrs or {}))
+        self.join()
+        if self.error is not None:
+            raise StorageError('{} storage operation(s) failed, first: {!r}'.format(self.failed, self.error))
+
+    def run(self):
+        while 1:
+            try:
+                cmd = self.q.get(timeout=self.writer.flush_interval)
+            except Empty:
+                cmd = ('flush', )
+
+            try:
+                if cmd[0] == 'flush':
+                    self.writer.flush()
+                elif cmd[0] == 'write':
+                    if len(cmd) > 4:
+                        self.latency.add('storage', now_ns() - cmd[4])
+                    self.writer.write(cmd[1], cmd[2], cmd[3])
+                    self.writer.poll()
+                elif cmd[0] == 'call':
+                    cmd[1](*cmd[2])
+                elif cmd[0] == 'close':
+                    self._close(*cmd[1:])
+                    return
+            except Exception as err:
+                # Keep the session's remaining data; report now, raise at close()
+                traceback.print_exc()
+                self.failed += 1
+                if self.error is None:
+                    self.error = err
+                if cmd[0] == 'close':
+                    return
+
+    def _close(self, resize, attrs):
+        try:
+            self.writer.flush()
+            for path, shape in resize.items():
+                self.data_file[path].resize(shape)
+            for path, group_attrs in attrs.items():
+                for key, value in group_attrs.items():
+                    self.data_file[path].attrs[key] = value
+        finally:
+            print('Closing file')
+            self.data_file.close()
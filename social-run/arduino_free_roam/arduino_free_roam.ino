@@ -8,8 +8,12 @@
 #define ENDCODE 48
 #define STARTCODE 69
 #define DELIM ","         // Delimiter used for serial outputs
+#define SEQDELIM ";"      // Precedes sequence number in serial outputs
 #define STEPCODE 53
 #define STEPMAX 127       // Maximum number of steps by stepper
+#define CODEBAUD 66       // 'B': baud rate proposal (see rig/baud.py)
+#define BAUDMAX 1000000   // Fastest baud rate offered to the computer
+#define BAUDWAIT 500      // ms to wait for the computer at a new baud rate
 
 
 // Pins
@@ -45,6 +49,7 @@ unsigned int stepShift;     // Bit shift to scale track steps to stepper steps
 
 // Other variables
 volatile int trackChange = 0;   // Rotations within tracking epochs
+byte seqs[16];                  // Next sequence number of each event code
 
 
 void track() {
@@ -54,11 +59,24 @@ void track() {
 }
 
 
+void sendEvent(byte code, unsigned long ts, long value, boolean hasValue) {
+  // Send event to computer as "code,ts[,value];seq" line
+  byte seq = seqs[code & 15]++;   // Per-code sequence number, lets computer count lost events
+  Serial.print(code);
+  Serial.print(DELIM);
+  Serial.print(ts);
+  if (hasValue) {
+    Serial.print(DELIM);
+    Serial.print(value);
+  }
+  Serial.print(SEQDELIM);
+  Serial.println(seq);
+}
+
+
 void endSession(unsigned long ts) {
   // Send "end" signal
-  Serial.print(code_end);
-  Serial.print(DELIM);
-  Serial.println(ts);
+  sendEvent(code_end, ts, 0, false);
   digitalWrite(imgStopPin, HIGH);
 
   // Reset pins
@@ -109,6 +127,41 @@ void waitForStart() {
 }
 
 
+void negotiateBaud() {
+  // Switch to a faster baud rate if the computer proposes one (see rig/baud.py).
+  // Returns once the next byte isn't a proposal, i.e. parameters are coming.
+  unsigned long rate;
+  unsigned long t0;
+
+  while (1) {
+    while (Serial.available() <= 0);
+    if (Serial.peek() != CODEBAUD) return;
+    Serial.read();
+    rate = Serial.parseInt();
+    Serial.read();              // '\n'
+    if (rate == 0 || rate > BAUDMAX) {
+      Serial.println("B0");
+      continue;
+    }
+
+    // Acknowledge at the old rate, then wait for the computer at the new one
+    Serial.print("B");
+    Serial.println(rate);
+    Serial.flush();
+    Serial.begin(rate);
+    t0 = millis();
+    while (millis() - t0 < BAUDWAIT) {
+      if (Serial.read() == CODEBAUD) {
+        Serial.print("B");
+        Serial.println(rate);
+        return;
+      }
+    }
+    Serial.begin(9600);         // Not confirmed: back to the default rate
+  }
+}
+
+
 void setup() {
   Serial.begin(9600);
   Serial1.begin(9600);
@@ -126,7 +179,10 @@ void setup() {
   // Wait for parameters from serial
   Serial.println("conveyer_arduino\n"
                  "Waiting for parameters to load.");
-  while (Serial.available() <= 0);
+  Serial.print("Baud: ");
+  Serial.println(BAUDMAX);
+  Serial.println("Seq: 1");
+  negotiateBaud();
   updateParams();
   tsEnd = preSession + session + postSession;
 
@@ -138,11 +194,7 @@ void setup() {
   attachInterrupt(digitalPinToInterrupt(trackPinA), track, RISING);
 
   // Print timestamp of first trial and length of session
-  Serial.print(code_session_length);
-  Serial.print(DELIM);
-  Serial.print(0);
-  Serial.print(DELIM);
-  Serial.println(tsEnd);
+  sendEvent(code_session_length, 0, tsEnd, true);
 
   // Start imaging if whole session is imaged
   if (imageAll) digitalWrite(imgStartPin, HIGH);
@@ -180,11 +232,7 @@ void loop() {
   if (Serial1.available() > 1) {
     // Transmit step data from Arduino slave.
     if (Serial1.read() == STEPCODE) {  // Throw out first byte
-      Serial.print(code_conveyer_steps);
-      Serial.print(DELIM);
-      Serial.print(ts);
-      Serial.print(DELIM);
-      Serial.println(Serial1.read());
+      sendEvent(code_conveyer_steps, ts, Serial1.read(), true);
     }
   }
 
@@ -192,9 +240,7 @@ void loop() {
   if (ts >= preSession &&
       ts <  preSession + session) {
     if (!inSession) {
-      Serial.print(code_trial_start);
-      Serial.print(DELIM);
-      Serial.println(ts);
+      sendEvent(code_trial_start, ts, 0, false);
       inSession = true;
     }
 
@@ -223,9 +269,7 @@ void loop() {
     trialEnd = ts + intxDur;
 
     // Relay to computer
-    Serial.print(code_rail_end);
-    Serial.print(DELIM);
-    Serial.println(ts);
+    sendEvent(code_rail_end, ts, 0, false);
   }
 
   if (ts >= nextTrackTS) {
@@ -234,11 +278,7 @@ void loop() {
     
     if (trackOutVal != 0) {
       // Print tracking valeus otherwise.
-      Serial.print(code_track);
-      Serial.print(DELIM);
-      Serial.print(ts);
-      Serial.print(DELIM);
-      Serial.println(trackOutVal);
+      sendEvent(code_track, ts, trackOutVal, true);
 
       if (inSession &&
           (trackOutVal > (int)stepThresh) && // need to cast uint to int
@@ -276,9 +316,7 @@ void loop() {
       resetConveyer = false;
       tone(speakerPin, cueFreq, cueDur);
 
-      Serial.print(code_trial_start);
-      Serial.print(DELIM);
-      Serial.println(ts);
+      sendEvent(code_trial_start, ts, 0, false);
     }
     else {
       if (ts >= nextResetTS) {
@@ -14,9 +14,15 @@
 #define ENDCODE 48
 #define STARTCODE 69
 #define DELIM ","         // Delimiter used for serial outputs
+#define SEQDELIM ";"      // Precedes sequence number in serial outputs
 #define STEPSHIFT 1       // Scale factor to convert tracking to stepper
 #define STEPCODE 53
 #define STEPMAX 127       // Maximum number of steps by stepper
+#define CODEBAUD 66       // 'B': baud rate proposal (see rig/baud.py)
+#define BAUDMAX 1000000   // Fastest baud rate offered to the computer
+#define BAUDWAIT 500      // ms to wait for the computer at a new baud rate
+#define CODEPARAMS 80     // 'P': binary parameter block (see rig/protocol.py)
+#define PARAMVERSION 1    // Parameter block layout offered to the computer
 
 
 // Pins
@@ -62,6 +68,7 @@ unsigned int trackPeriod;
 unsigned long* trials;          // Pointer to array for DMA; initialized later
 boolean* csplus_trials;
 volatile int trackChange = 0;   // Rotations within tracking epochs
+byte seqs[16];                  // Next sequence number of each event code
 
 
 void track() {
@@ -71,11 +78,25 @@ void track() {
 }
 
 
+void sendEvent(byte code, unsigned long ts, long value, boolean hasValue) {
+  // Send event to computer as "code,ts[,value];seq" line
+  // (code_next_trial sends the time to the next trial in place of ts)
+  byte seq = seqs[code & 15]++;   // Per-code sequence number, lets computer count lost events
+  Serial.print(code);
+  Serial.print(DELIM);
+  Serial.print(ts);
+  if (hasValue) {
+    Serial.print(DELIM);
+    Serial.print(value);
+  }
+  Serial.print(SEQDELIM);
+  Serial.println(seq);
+}
+
+
 void endSession(unsigned long ts) {
   // Send "end" signal
-  Serial.print(code_end);
-  Serial.print(DELIM);
-  Serial.println(ts);
+  sendEvent(code_end, ts, 0, false);
   digitalWrite(imgStopPin, HIGH);
 
   // Reset pins
@@ -92,12 +113,69 @@ void endSession(unsigned long ts) {
 }
 
 
+uint16_t crc16(uint16_t crc, const byte *data, int n) {
+  // CRC-16/CCITT, as binascii.crc_hqx() on the computer
+  while (n--) {
+    crc ^= (uint16_t)*data++ << 8;
+    for (int i = 0; i < 8; i++) crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+
+long readParamBlock(unsigned long *values, int count) {
+  // Binary parameter block: 'P', version, count, count x uint32 and the
+  // CRC-16 of everything before it. Returns the CRC, or -1 if the block is
+  // incomplete, has the wrong layout or fails the check.
+  byte header[3];
+  byte check[2];
+  uint16_t crc;
+
+  if (Serial.readBytes(header, 3) < 3) return -1;
+  if (header[0] != CODEPARAMS || header[1] != PARAMVERSION || header[2] != count) return -1;
+  if (Serial.readBytes((byte *)values, 4 * count) < 4 * count) return -1;  // AVR/ARM are little-endian
+  if (Serial.readBytes(check, 2) < 2) return -1;
+
+  crc = crc16(0xFFFF, header, 3);
+  crc = crc16(crc, (byte *)values, 4 * count);
+  if (crc != (check[0] | (uint16_t)check[1] << 8)) return -1;
+  return crc;
+}
+
+
+void discardInput() {
+  // Drop incoming bytes until the line has been quiet for 20 ms
+  unsigned long t = millis();
+  while (millis() - t < 20) {
+    if (Serial.available() > 0) {
+      Serial.read();
+      t = millis();
+    }
+  }
+}
+
+
 // Retrieve parameters from serial
 void updateParams() {
   const int paramNum = 15;
   unsigned long parameters[paramNum];
-  for (int p = 0; p < paramNum; p++) {
-    parameters[p] = Serial.parseInt();
+  long crc;
+
+  if (Serial.peek() == CODEPARAMS) {
+    // Binary block; ask for it again until it arrives intact
+    while ((crc = readParamBlock(parameters, paramNum)) < 0) {
+      discardInput();
+      Serial.println("P!");
+      while (Serial.available() <= 0);
+    }
+    Serial.print("P");
+    Serial.println(crc);
+  }
+  else {
+    // '+'-joined text from older computer-side code
+    for (int p = 0; p < paramNum; p++) {
+      parameters[p] = Serial.parseInt();
+    }
   }
 
   csplusNum       = parameters[0];
@@ -211,6 +289,41 @@ void waitForStart() {
 }
 
 
+void negotiateBaud() {
+  // Switch to a faster baud rate if the computer proposes one (see rig/baud.py).
+  // Returns once the next byte isn't a proposal, i.e. parameters are coming.
+  unsigned long rate;
+  unsigned long t0;
+
+  while (1) {
+    while (Serial.available() <= 0);
+    if (Serial.peek() != CODEBAUD) return;
+    Serial.read();
+    rate = Serial.parseInt();
+    Serial.read();              // '\n'
+    if (rate == 0 || rate > BAUDMAX) {
+      Serial.println("B0");
+      continue;
+    }
+
+    // Acknowledge at the old rate, then wait for the computer at the new one
+    Serial.print("B");
+    Serial.println(rate);
+    Serial.flush();
+    Serial.begin(rate);
+    t0 = millis();
+    while (millis() - t0 < BAUDWAIT) {
+      if (Serial.read() == CODEBAUD) {
+        Serial.print("B");
+        Serial.println(rate);
+        return;
+      }
+    }
+    Serial.begin(9600);         // Not confirmed: back to the default rate
+  }
+}
+
+
 void setup() {
   Serial.begin(9600);
   Serial1.begin(9600);
@@ -228,7 +341,12 @@ void setup() {
   // Wait for parameters from serial
   Serial.println("conveyer_arduino\n"
                  "Waiting for parameters to load.");
-  while (Serial.available() <= 0);
+  Serial.print("Baud: ");
+  Serial.println(BAUDMAX);
+  Serial.println("Seq: 1");
+  Serial.print("Params: ");
+  Serial.println(PARAMVERSION);
+  negotiateBaud();
   updateParams();
 
   // Create trials
@@ -248,15 +366,9 @@ void setup() {
   attachInterrupt(digitalPinToInterrupt(trackPinA), track, RISING);
 
   // Print timestamp of first trial and length of session
-  Serial.print(code_session_length);
-  Serial.print(DELIM);
-  Serial.print(0);
-  Serial.print(DELIM);
-  Serial.println(tsEnd);
+  sendEvent(code_session_length, 0, tsEnd, true);
   
-  Serial.print(code_next_trial);
-  Serial.print(DELIM);
-  Serial.println(trials[0]);
+  sendEvent(code_next_trial, trials[0], 0, false);
 
   // Start imaging if whole session is imaged
   if (imageAll) digitalWrite(imgStartPin, HIGH);
@@ -300,11 +412,7 @@ void loop() {
   if (Serial1.available() > 1) {
     // Transmit step data from Arduino slave.
     if (Serial1.read() == STEPCODE) {  // Throw out first byte
-      Serial.print(code_conveyer_steps);
-      Serial.print(DELIM);
-      Serial.print(ts);
-      Serial.print(DELIM);
-      Serial.println(Serial1.read());
+      sendEvent(code_conveyer_steps, ts, Serial1.read(), true);
     }
   }
 
@@ -335,14 +443,8 @@ void loop() {
       digitalWrite(ledPin, HIGH);
 
       // Print trial start time
-      if (csplus_trials[nextTrial]) {
-        Serial.print(code_trial_onset_csplus);
-      }
-      else {
-        Serial.print(code_trial_onset_csminus);
-      }
-      Serial.print(DELIM);
-      Serial.println(ts);
+      sendEvent(csplus_trials[nextTrial] ? code_trial_onset_csplus : code_trial_onset_csminus,
+                ts, 0, false);
     }
 
     // End of trial
@@ -365,16 +467,12 @@ void loop() {
         // For all trials except last, increment trial index and send time to
         // next trial via serial.
         nextTrial++;
-        Serial.print(code_next_trial);
-        Serial.print(DELIM);
-        Serial.println(trials[nextTrial] - ts);
+        sendEvent(code_next_trial, trials[nextTrial] - ts, 0, false);
       }
       else {
         // For last trial
         running = false;
-        Serial.print(code_next_trial);
-        Serial.print(DELIM);
-        Serial.println("0");        // Indicates no more trials left.
+        sendEvent(code_next_trial, 0, 0, false);      // Indicates no more trials left.
       }
     }
   }
@@ -391,9 +489,7 @@ void loop() {
     endOfRail = true;
 
     // Relay to computer
-    Serial.print(code_rail_end);
-    Serial.print(DELIM);
-    Serial.println(ts);
+    sendEvent(code_rail_end, ts, 0, false);
   }
 
   if (ts >= nextTrackTS) {
@@ -402,11 +498,7 @@ void loop() {
     
     if (trackOutVal != 0) {
       // Print tracking valeus otherwise.
-      Serial.print(code_track);
-      Serial.print(DELIM);
-      Serial.print(ts);
-      Serial.print(DELIM);
-      Serial.println(trackOutVal);
+      sendEvent(code_track, ts, trackOutVal, true);
 
       if (inTrial &&
           csplus_trials[nextTrial] &&
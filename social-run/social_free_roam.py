@@ -7,6 +7,14 @@ Creates GUI to control behavioral and imaging devices for in vivo calcium
 imaging. Script interfaces with Arduino microcontroller and imaging devices.
 """
 
+import os
+import sys
+
+# Shared rig modules live at the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from rig import startup
+startup.install()     # Time imports until the window is up
+
 from Tkinter import *
 import tkMessageBox
 import tkFileDialog
@@ -14,14 +22,10 @@ import collections
 import serial
 import serial.tools.list_ports
 import threading
-from Queue import Queue
-from slacker import Slacker
 import time
 from datetime import datetime
 from datetime import timedelta
-import os
-import sys
-import h5py
+h5py = startup.lazy_import('h5py')
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
@@ -31,19 +35,35 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolb
 from matplotlib.figure import Figure
 from matplotlib import gridspec
 from matplotlib.collections import LineCollection
-import seaborn as sns
-import pdb
+pdb = startup.lazy_import('pdb')
+
+# Shared rig modules
+from rig.baud import BAUD_DEFAULT
+from rig.dispatch import EventBatch, EventDispatcher, EventQueue
+from rig.handshake import Handshake
+from rig.latency import LatencyMonitor, now_ns
+from rig.storage import GrowableArray
+from rig.notify import SlackNotifier, SlackerBackend
+from rig.protocol import LineDecoder, LossCounter, offered_seq
 
 
 # Setup Slack
 # Token is stored in text file 'key_file'
+# Messages are sent from a background thread (see rig.notify)
 key_file = 'slack.txt'
 if os.path.isfile(key_file):
-    with open(key_file, 'r') as kf:
-        slack = Slacker(kf.read())
+    def slack_backend():
+        from slacker import Slacker
+        with open(key_file, 'r') as kf:
+            return SlackerBackend(Slacker(kf.read()))
+    slack = SlackNotifier(slack_backend, username="Social conveyer bot")
 else:
     slack = None
 
+# Names of the event streams in loss counts
+STREAMS = {0: 'end', 1: 'steps', 2: 'rail_end', 3: 'trial_start', 6: 'session_length',
+           7: 'track'}
+
 
 class InputManager(object):
 
@@ -145,6 +165,15 @@ class InputManager(object):
         self.print_var = BooleanVar()
         self.check_print = Checkbutton(debug_frame, text="Print Arduino output", variable=self.print_var)
         self.check_print.grid(row=0, column=0)
+        self.var_latency = BooleanVar()
+        self.check_latency = Checkbutton(debug_frame, text="Latency stats", variable=self.var_latency)
+        self.check_latency.grid(row=1, column=0, sticky=W)
+        self.var_latency_readout = StringVar()
+        self.label_latency = Label(debug_frame, textvariable=self.var_latency_readout, anchor=W)
+        self.label_latency.grid(row=2, column=0, sticky=W)
+        self.var_loss_readout = StringVar()
+        self.label_loss = Label(debug_frame, textvariable=self.var_loss_readout, anchor=W)
+        self.label_loss.grid(row=3, column=0, sticky=W)
 
         ###### SERIAL FRAME ######
         serial_frame = Frame(parameter_frame)
@@ -179,7 +208,7 @@ class InputManager(object):
         Label(slack_frame, text="Slack address for notifications: ", anchor=W).grid(row=0, column=0, sticky=W+E)
         self.entry_slack = Entry(slack_frame)
         self.entry_slack.grid(row=1, column=0, sticky=N+S+W+E)
-        self.button_slack = Button(slack_frame, text="Test", command=lambda: slack_msg(self.entry_slack.get(), "Test", test=True))
+        self.button_slack = Button(slack_frame, text="Test", command=self.slack_test)
         self.button_slack.grid(row=1, column=1, padx=5, sticky=W)
 
         ##### START FRAME #####
@@ -212,7 +241,7 @@ class InputManager(object):
         self.num_rail_segments = 10  # Number of segments to split rail--for plotting
         trial_window = 30000
 
-        sns.set_style('dark')
+        startup.set_plot_style('dark')
         self.color_csplus  = 'steelblue'
         self.color_csminus  = 'coral'
         self.color_track    = 'forestgreen'
@@ -304,7 +333,8 @@ class InputManager(object):
                                        self.entry_step_shift,
                                        self.radio_img_trial,
                                        self.radio_img_all,
-                                       self.check_print]
+                                       self.check_print,
+                                       self.check_latency]
         # Boolean of objects in list above that should be enabled when time...
         self.obj_enabled_at_open = [False] * len(self.obj_to_disable_at_open)
         
@@ -339,12 +369,18 @@ class InputManager(object):
 
         ###### SESSION VARIABLES ######
         self.parameters = collections.OrderedDict()
-        self.ser = serial.Serial(timeout=1, baudrate=9600)
+        self.ser = serial.Serial(timeout=1, baudrate=BAUD_DEFAULT)
         self.start_time = ""
         self.track = np.empty(0)
         self.rail_end = np.empty(0)
         self.counter = {}
-        self.q = Queue()
+        self.q = EventQueue()
+        self.dispatcher = EventDispatcher(self.q, clock_codes=[0, 1, 2, 3, 7])  # codes with timestamps
+        self.seq = False            # Events carry sequence numbers (rig/protocol.py)
+        self.connect_time = None    # s taken by the connect handshake (rig/handshake.py)
+        self.loss = LossCounter()
+        self.latency = None         # LatencyMonitor while 'Latency stats' is on (rig/latency.py)
+        self.last_readout = 0       # Time the loss and latency readouts were last refreshed
 
     def update_ports(self):
         ports_info = list(serial.tools.list_ports.comports())
@@ -400,7 +436,7 @@ class InputManager(object):
 
             self.entry_serial_status.config(state=NORMAL, fg='black')
             self.entry_serial_status.delete(0, END)
-            self.entry_serial_status.insert(0, 'Opened')
+            self.entry_serial_status.insert(0, 'Opened ({})'.format(self.ser.baudrate))
             self.entry_serial_status['state'] = 'readonly'
 
         elif option == 'close':
@@ -483,10 +519,10 @@ class InputManager(object):
         # self.raster_steps.set_segments(blank_segments)
         
         # Initialize/clear old data
-        self.trial_onset = np.zeros(1000, dtype='uint32')
-        self.steps = np.zeros((2, 360000), dtype='uint32')
-        self.track = np.zeros((2, 360000), dtype='int32')
-        self.rail_end = np.zeros(int(self.parameters['session_duration']/10), dtype='uint32')
+        self.trial_onset = GrowableArray('uint32')
+        self.steps = GrowableArray('uint32', rows=2)
+        self.track = GrowableArray('int32', rows=2)
+        self.rail_end = GrowableArray('uint32')
         self.counter = {'trial': 0,
                         'rail_end': 0,
                         'track': 0,
@@ -494,7 +530,7 @@ class InputManager(object):
 
         # Open serial and upload to Arduino
         self.ser.port = self.port_var.get()
-        ser_return = start_arduino(self.ser, self.parameters)
+        ser_return, self.seq, self.connect_time = start_arduino(self.ser, self.parameters)
         if ser_return:
             tkMessageBox.showerror("Serial error",
                                    "{0}: {1}\n\nCould not create serial connection."\
@@ -540,9 +576,16 @@ class InputManager(object):
         self.start_time = datetime.now().strftime("%H:%M:%S")
         print "Session start ~ " + self.start_time
 
+        # Per-stage timing of events, serial to disk (rig/latency.py)
+        self.latency = LatencyMonitor() if self.var_latency.get() else None
+        self.dispatcher.latency = self.latency
+
         # Create thread to scan serial
         thread_scan = threading.Thread(target=scan_serial,
-                                       args=(self.q, self.ser, self.parameters, self.print_var.get()))
+                                       args=(self.q, self.ser, self.parameters, self.print_var.get()),
+                                       kwargs={'latency': self.latency, 'loss': self.loss})
+        self.dispatcher.reset()
+        self.loss.reset()
         thread_scan.start()
 
         # Update GUI alongside Arduino scanning (scan_serial on separate thread)
@@ -568,6 +611,8 @@ class InputManager(object):
         if self.stop.get():
             self.stop.set(False)
             self.ser.write("0")
+            if self.latency:
+                self.latency.stop_requested()
             print "Stopped by user."
             
             # Calculate time (H:M:S) when session ends
@@ -580,12 +625,14 @@ class InputManager(object):
 
         # Incoming queue has format:
         #   [code, ts [, extra values...]]
-        if not self.q.empty():
-            q_in = self.q.get()
+        # Handle all pending events (within time budget of dispatcher)
+        for q_in in self.dispatcher.drain():
             code = q_in[0]
             ts = q_in[1]
 
             if code == code_end:
+                if self.latency:
+                    self.latency.stop_handled()
                 self.parameters['arduino_end'] = ts
                 self.stop_session(data_file)
                 return
@@ -594,7 +641,7 @@ class InputManager(object):
                 dist = int(q_in[2])
 
                 # Record steps
-                self.steps[:, self.counter['steps']] = [ts, dist]
+                self.steps.append((ts, dist))
                 # self.steps_by_trial[self.counter['trial']] += dist
 
                 # Increment counter
@@ -602,16 +649,16 @@ class InputManager(object):
 
             elif code == code_rail_end:
                 # Record time end of rail reached
-                self.rail_end[self.counter['rail_end']] = ts
+                self.rail_end.append(ts)
 
                 # Update scoreboard
                 self.entry_rail_ends.delete(0, END)
-                self.entry_rail_ends.insert(0, np.count_nonzero(self.rail_end))
+                self.entry_rail_ends.insert(0, np.count_nonzero(self.rail_end.data))
 
                 self.counter['rail_end'] += 1
 
             elif code == code_trial_start:
-                self.trial_onset[self.counter['trial']] = ts
+                self.trial_onset.append(ts)
                 self.counter['trial'] += 1
 
             elif code == code_session_length:
@@ -634,31 +681,58 @@ class InputManager(object):
                 dist = int(q_in[2])
 
                 # Record tracking
-                self.track[:, self.counter['track']] = [ts, dist]
+                self.track.append((ts, dist))
                 
                 # Increment counter
                 self.counter['track'] += 1
 
+        # Live latency and serial loss readouts, once a second
+        if time.time() - self.last_readout >= 1:
+            self.last_readout = time.time()
+            if self.latency:
+                self.var_latency_readout.set(self.latency.readout())
+            self.var_loss_readout.set("Serial events " + self.loss.readout(STREAMS))
+
         self.parent.after(refresh_rate, self.update_session, data_file)
 
     def stop_session(self, data_file):
         self.gui_util('stop')
         self.close_serial()
+        if self.latency:
+            self.var_latency_readout.set(self.latency.readout())
+        self.var_loss_readout.set("Serial events " + self.loss.readout(STREAMS))
         end_time = datetime.now().strftime("%H:%M:%S")
 
         if data_file:
+            # Behavior is held in memory and written here in one go ('flush' latency)
+            t0 = now_ns() if self.latency else 0
             behav_grp = data_file.create_group('behavior')
-            behav_grp.create_dataset(name='trials', data=self.trial_onset[:self.counter['trial']], dtype='uint32')
-            behav_grp.create_dataset(name='steps', data=self.steps[:, :self.counter['steps']], dtype='uint32')
+            behav_grp.create_dataset(name='trials', data=self.trial_onset.data, dtype='uint32')
+            behav_grp.create_dataset(name='steps', data=self.steps.data, dtype='uint32')
             # behav_grp.create_dataset(name='steps_by_trial', data=self.steps_by_trial, dtype='uint32')
-            behav_grp.create_dataset(name='track', data=self.track[:, :self.counter['track']], dtype='int32')
-            behav_grp.create_dataset(name='rail_end', data=self.rail_end[:self.counter['rail_end']], dtype='uint32')
+            behav_grp.create_dataset(name='track', data=self.track.data, dtype='int32')
+            behav_grp.create_dataset(name='rail_end', data=self.rail_end.data, dtype='uint32')
+            if self.latency:
+                self.latency.add('flush', now_ns() - t0)
 
             # Store session parameters into behavior group
             behav_grp.attrs['start_time'] = self.start_time
+            behav_grp.attrs['baudrate'] = self.ser.baudrate
+            behav_grp.attrs['connect_time'] = self.connect_time
             behav_grp.attrs['end_time'] = end_time
             for key, value in self.parameters.iteritems():
                 behav_grp.attrs[key] = value
+            for key, value in self.dispatcher.stats().iteritems():
+                behav_grp.attrs[key] = value
+            for key, value in self.loss.summary(STREAMS).iteritems():
+                behav_grp.attrs[key] = value
+            if self.latency:
+                for key, value in self.latency.summary().iteritems():
+                    behav_grp.attrs[key] = value
+            if self.loss.totals() != (0, 0, 0):
+                print "Serial events " + self.loss.readout(STREAMS)
+            elif not self.seq:
+                print "Arduino doesn't number its events; lost events weren't counted."
             
             # Close HDF5 file object
             data_file.close()
@@ -673,6 +747,18 @@ class InputManager(object):
            slack:
             slack_msg(self.entry_slack.get(), "Session ended.")
 
+    def slack_test(self):
+        message = slack_msg(self.entry_slack.get(), "Test")
+        if message:
+            self.parent.after(100, self.slack_test_check, message)
+
+    def slack_test_check(self, message):
+        # Poll test message so the Tk loop never waits on the network
+        if not message.done.is_set():
+            self.parent.after(100, self.slack_test_check, message)
+        elif message.status != 'sent':
+            tkMessageBox.showerror("Slack error", message.error)
+
 
 # def slack_test(slack_recipient, msg):
 #     # Creates Slack message to slack_recipient from Bot. Message is string msg.
@@ -701,46 +787,17 @@ class InputManager(object):
 #                                 icon_emoji=":squirrel:")
 
 
-def slack_msg(slack_recipient, msg, test=False):
-    # Creates Slack message to slack_recipient from Bot. Message is string msg.
-    bot_username = "Social conveyer bot"
-    bot_icon = ":squirrel:"
-
-    # Verify Slack recipient
-    if not slack_recipient:
-        return
-    slack_code = slack_recipient[0]
-    slack_name = slack_recipient[1::]
-    if slack_code is '@':
-        slack_users = slack.users.list().body['members']
-        slack_user_names = [user['name'] for user in slack_users]
-        if slack_name not in slack_user_names:
-            if test:
-                tkMessageBox.showerror("Slack error", "Slack user does not exist")
-            else:
-                print "Slack user does not exist. Message failed to send."
-    elif slack_code is '#':
-        slack_channels = slack.channels.list().body['members']
-        slack_channel_names = [channel['name'] for channel in slack_channels]
-        if slack_name not in slack_channel_names:
-            if test:
-                tkMessageBox.showerror("Slack error", "Slack channel does not exist")
-            else:
-                print "Slack channel does not exist. Message failed to send."
-    else:
-        if test:
-            tkMessageBox.showerror("Slack error", "Slack recipient is invalid.")
-        else:
-            print "Slack recipient invalid. Message failed to send."
-        return
-
-    if msg:
-        slack.chat.post_message(slack_recipient, msg,
-                                username=bot_username,
-                                icon_emoji=bot_icon)
+def slack_msg(slack_recipient, msg):
+    # Queues Slack message `msg` to slack_recipient from Bot. Returns
+    # immediately with a Message whose status can be polled.
+    if not slack:
+        print "No Slack client defined. Message not sent."
+        return None
+    return slack.send(slack_recipient, msg)
 
 
 def start_arduino(ser, parameters):
+    # Returns (error or 0, whether events carry sequence numbers, connect time in s)
 
     values = parameters.values()
     print values
@@ -748,60 +805,58 @@ def start_arduino(ser, parameters):
     sys.stdout.flush()
     
     try:
+        ser.baudrate = BAUD_DEFAULT             # Arduino resets on open
         ser.open()
     except serial.SerialException as err:
         sys.stdout.write("\nFailed to open connection.\n")
-        return err
-
-    # WAIT FOR ARDUINO TO ESTABLISH SERIAL CONNECTION
-    timeout = 10
-    timeout_count = 0
-    while 1:
-        if timeout_count >= timeout:
-            sys.stdout.write(" connection timed out.\n")
-            sys.stdout.flush()
-            return serial.SerialException
-        sys.stdout.write(".")
-        sys.stdout.flush()
-        if ser.read(): break
-        timeout_count += 1
+        return err, False, None
 
-    ser.flushInput()            # Remove opening message from serial
-    ser.write('+'.join(str(s) for s in values))
-    while 1:
-        if timeout_count >= timeout:
-            sys.stdout.write(" connection timed out.\n")
-            sys.stdout.flush()
-            return serial.SerialException
-        sys.stdout.write(".")
+    # Wait for the Arduino to boot, then upload (see rig/handshake.py)
+    handshake = Handshake(ser, values)
+    if not handshake.run():
+        sys.stdout.write("\n{}\n".format(handshake.error))
         sys.stdout.flush()
-        if ser.read(): break
-    print "\nArduino updated."
+        return serial.SerialException(handshake.error), False, None
+    print "\nArduino updated ({} baud, connected in {:.2f} s).".format(ser.baudrate, handshake.elapsed)
 
-    return 0
+    return 0, offered_seq(handshake.banner), handshake.elapsed
 
 
-def scan_serial(q, ser, parameters, print_arduino=False):
+def scan_serial(q, ser, parameters, print_arduino=False, latency=None, loss=None):
     #  Continually check serial connection for data sent from Arduino. Stop when "0 code" is received.
+    #  Lost, repeated and malformed events are counted in `loss`; with a LatencyMonitor (`latency`)
+    #  each batch is stamped.
 
     code_end = 0
 
     if print_arduino: print "  Scanning Arduino outputs."
+    decoder = LineDecoder(loss)
+
     while 1:
-        input_arduino = ser.readline()
-        if input_arduino == '': continue
-        if print_arduino: sys.stdout.write('  [a]: ' + input_arduino)
-
-        try:
-            input_split = map(int, input_arduino.split(','))
-        except ValueError:
-            # If not all comma-separated values are int castable
-            pass
-        else:
-            if input_arduino: q.put(input_split)
-            if input_split[0] == code_end: 
-                if print_arduino: print "  Scan complete."
-                return
+        data = ser.read(ser.in_waiting or 1)
+        if not data: continue
+        t_read = now_ns() if latency else 0
+
+        # All complete lines of this read go on the queue as one batch
+        events, text = decoder.decode(data)
+        if print_arduino:
+            for event in events:
+                sys.stdout.write('  [a]: ' + ','.join(map(str, event)) + '\n')
+            if text: sys.stdout.write('  [a]: ' + text)
+        if not events: continue
+
+        batch = EventBatch()
+        for event in events:
+            batch.append(event)
+            if event[0] == code_end: break
+        if latency:
+            latency.stamp(batch, t_read)
+            latency.add('parse', now_ns() - t_read)
+        q.put(batch)
+
+        if batch[-1][0] == code_end:
+            if print_arduino: print "  Scan complete."
+            return
 
 
 def main():
@@ -811,8 +866,13 @@ def main():
     if os.name == 'nt':
         root.iconbitmap(os.path.join(os.getcwd(), 'neuron.ico'))
     InputManager(root)
+    root.after_idle(startup.report)
     root.mainloop()
 
+    # Give queued Slack messages a chance to go out
+    if slack:
+        slack.close()
+
 
 if __name__ == '__main__':
     main()
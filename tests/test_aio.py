@@ -0,0 +1,109 @@
+import asyncio
+import os
+import pty
+import time
+import tty
+from queue import Queue
+
+import pytest
+import serial
+
+from rig.aio import SerialHub, SerialStream
+from rig.protocol import LossCounter, encode
+
+
+@pytest.fixture
+def port():
+    ''' (master fd, Serial on the slave side of a pty) '''
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    ser = serial.Serial(os.ttyname(slave), timeout=1)
+    yield master, ser
+    ser.close()
+    os.close(master)
+    os.close(slave)
+
+
+def collect(port, data, **kwargs):
+    ''' Events read by a SerialStream, and its text output, after `data` is written '''
+    master, ser = port
+    text = []
+
+    async def main():
+        stream = SerialStream(ser, on_text=text.append, **kwargs)
+        stream.start()
+        os.write(master, data)
+        return [list(event) async for event in stream.events(timeout=2)]
+
+    return asyncio.run(main()), ''.join(text)
+
+
+def test_stream_reads_lines(port):
+    events, text = collect(port, b'Ready\r\n7,10,1\r\n7,20,-2\r\n3,30,0\r\n0,40\r\n7,50,1\r\n')
+    assert events == [[7, 10, 1], [7, 20, -2], [3, 30, 0], [0, 40]]
+    assert 'Ready' in text
+
+
+def test_stream_reads_binary(port):
+    data = b''.join(encode(7, ts, ts % 5 - 2, seq) for seq, ts in enumerate(range(10, 60, 10)))
+    loss = LossCounter()
+    events, _ = collect(port, data + encode(0, 60, 0, 0), binary=True, seq=True, loss=loss)
+    assert events == [[7, ts, ts % 5 - 2] for ts in range(10, 60, 10)] + [[0, 60, 0]]
+    assert loss.totals() == (0, 0, 0)
+
+
+def test_stream_timeout(port):
+    master, ser = port
+
+    async def main():
+        stream = SerialStream(ser)
+        stream.start()
+        with pytest.raises(asyncio.TimeoutError):
+            await stream.get(timeout=0.05)
+        stream.close()
+        assert await stream.get() is None
+        assert await stream.get_batch() is None
+
+    asyncio.run(main())
+
+
+def test_stream_batches_per_read(port):
+    master, ser = port
+
+    async def main():
+        stream = SerialStream(ser)
+        stream.start()
+        os.write(master, b'7,10,1\r\n7,20,1\r\n')
+        first = await stream.get_batch(timeout=2)
+        os.write(master, b'0,30\r\n')
+        second = await stream.get_batch(timeout=2)
+        return first, second, await stream.get_batch()
+
+    first, second, end = asyncio.run(main())
+    assert list(first) == [[7, 10, 1], [7, 20, 1]]
+    assert list(second) == [[0, 30]]
+    assert end is None
+
+
+def test_hub_forwards_batches(port):
+    master, ser = port
+    q = Queue()
+    sub = SerialHub.shared().add(ser, q)
+    time.sleep(0.05)
+    os.write(master, b'7,10,1\r\n7,20,1\r\n0,30\r\n')
+    events = []
+    while not events or events[-1][0] != 0:
+        events += list(q.get(timeout=2))
+    assert events == [[7, 10, 1], [7, 20, 1], [0, 30]]
+    assert sub.done.wait(1)
+
+
+def test_hub_cancel_releases_port(port):
+    master, ser = port
+    q = Queue()
+    sub = SerialHub.shared().add(ser, q)
+    time.sleep(0.05)
+    assert sub.cancel()
+    os.write(master, b'7,10,1\r\n')
+    assert ser.read(8) == b'7,10,1\r\n'     # Nothing else is reading the port
+    assert q.empty()
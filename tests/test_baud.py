@@ -0,0 +1,63 @@
+import time
+
+import pytest
+import serial
+
+from rig.baud import BAUD_DEFAULT, negotiate_baud, offered_baud
+from rig.simulator import SimulatedArduino
+
+
+@pytest.fixture
+def board():
+    ''' Opens a SimulatedArduino; returns (sim, serial port, startup banner) '''
+    sims = []
+
+    def open_board(**kwargs):
+        sim = SimulatedArduino(reset_delay=0.05, **kwargs)
+        sims.append(sim)
+        sim.start()
+        ser = serial.Serial(sim.port, BAUD_DEFAULT, timeout=1)
+        banner = b''
+        while b'Seq: 1' not in banner:
+            line = ser.readline()
+            assert line, 'No banner from simulator'
+            banner += line
+        return sim, ser, banner.decode('ascii')
+
+    yield open_board
+    for sim in sims:
+        sim.close()
+
+
+def test_offered_baud():
+    assert offered_baud('Simulated Arduino\r\nBaud: 250000\r\n') == 250000
+    assert offered_baud('Simulated Arduino\r\n') is None
+
+
+def test_negotiates_fastest_offered_rate(board):
+    sim, ser, banner = board(max_baud=250000)
+    assert negotiate_baud(ser, banner) == 250000
+    assert ser.baudrate == 250000
+    time.sleep(0.05)
+    assert sim.baudrate == 250000
+
+
+def test_falls_through_rejected_rates(board):
+    sim, ser, banner = board(max_baud=250000)
+    t0 = time.time()
+    assert negotiate_baud(ser, 'Baud: 1000000') == 250000
+    assert time.time() - t0 < 1        # Rejections are answered, not timed out
+
+
+def test_no_rate_offered(board):
+    sim, ser, banner = board(max_baud=None)
+    assert negotiate_baud(ser, banner) == BAUD_DEFAULT
+    ser.write(b'1+2+3')
+    time.sleep(0.2)
+    assert sim.parameters == [1, 2, 3]      # No 'B' was sent before the parameters
+
+
+def test_no_usable_rate(board):
+    sim, ser, banner = board(max_baud=250000)
+    assert negotiate_baud(ser, banner, rates=(1000000, 500000)) == BAUD_DEFAULT
+    assert ser.baudrate == BAUD_DEFAULT
@@ -0,0 +1,129 @@
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from rig.camera import FrameRing, FrameWriter, available_codecs, chunk_frames, create_frame_dataset
+
+
+@pytest.fixture
+def h5():
+    f = h5py.File('session.h5', 'w', driver='core', backing_store=False)
+    yield f
+    f.close()
+
+
+def frames(n, shape=(24, 32)):
+    # Distinct, compressible frames
+    return [np.full(shape, i % 256, dtype='uint8') for i in range(n)]
+
+
+def record(h5, n, codec='none', **kwargs):
+    group = h5.create_group('cam')
+    writer = FrameWriter(create_frame_dataset(group, 'frames', (24, 32), 0, codec),
+                         group.create_dataset('timestamps', (0, ), 'float64', maxshape=(None, )),
+                         **kwargs)
+    writer.start()
+    for i, frame in enumerate(frames(n)):
+        while not writer.ring.push(frame, i / 10.):
+            time.sleep(0.001)
+    writer.ring.close()
+    writer.join()
+    group['frames'].resize((writer.written, 24, 32))
+    group['timestamps'].resize((writer.written, ))
+    return group
+
+
+# -- FrameRing -- #
+
+def test_ring_push_wait_release():
+    ring = FrameRing(4, (2, 2))
+    for i in range(3):
+        assert ring.push(np.full((2, 2), i), i)
+    slot, count = ring.wait(2)
+    assert (slot, count) == (0, 2)
+    assert ring.frames[slot:slot + count, 0, 0].tolist() == [0, 1]
+    ring.release(count)
+    assert ring.wait(1) == (2, 1)
+
+
+def test_ring_drops_when_full():
+    ring = FrameRing(2, (2, 2))
+    assert ring.push(np.zeros((2, 2)), 0)
+    assert ring.push(np.zeros((2, 2)), 1)
+    assert not ring.push(np.zeros((2, 2)), 2)
+    assert ring.dropped == 1
+    ring.release(1)
+    assert ring.push(np.zeros((2, 2)), 3)
+
+
+def test_ring_runs_stop_at_wrap_around():
+    ring = FrameRing(4, (1, ))
+    for i in range(3):
+        ring.push(i, i)
+    ring.release(3)
+    for i in range(3, 6):
+        ring.push(i, i)
+    slot, count = ring.wait(3)
+    assert (slot, count) == (3, 1)
+    ring.release(count)
+    slot, count = ring.wait(2)
+    assert (slot, count) == (0, 2)
+    assert ring.ts[:2].tolist() == [4, 5]
+
+
+def test_ring_close_returns_remaining():
+    ring = FrameRing(8, (1, ))
+    ring.push(1, 0)
+    ring.close()
+    assert ring.wait(4) == (0, 1)
+
+
+# -- FrameWriter -- #
+
+def test_writer_round_trip(h5):
+    group = record(h5, 50)
+    assert group['frames'].shape == (50, 24, 32)
+    assert group['frames'][:, 0, 0].tolist() == list(range(50))
+    assert group['timestamps'][...].tolist() == pytest.approx([i / 10. for i in range(50)])
+
+
+def test_writer_ring_holds_whole_blocks(h5):
+    group = h5.create_group('cam')
+    dset = create_frame_dataset(group, 'frames', (24, 32), 0)
+    writer = FrameWriter(dset, group.create_dataset('timestamps', (0, ), 'float64', maxshape=(None, )),
+                         buffer_frames=20)
+    assert writer.block == dset.chunks[0]
+    assert writer.ring.capacity % writer.block == 0
+    assert writer.ring.capacity >= max(20, 2 * writer.block)
+
+
+# -- Compression -- #
+
+@pytest.mark.parametrize('codec', available_codecs())
+def test_codec_round_trip(h5, codec):
+    group = record(h5, 40, codec)
+    assert group['frames'].attrs['codec'] == codec
+    assert group['frames'].shape == (40, 24, 32)
+    assert all((group['frames'][i] == frame).all() for i, frame in enumerate(frames(40)))
+
+
+def test_gzip_with_worker_pool(h5):
+    group = record(h5, 40, 'gzip', workers=2)
+    assert group['frames'].compression == 'gzip'
+    assert group['frames'].attrs['level'] == 4
+    assert group['frames'][:, 5, 5].tolist() == list(range(40))
+
+
+def test_unavailable_codec(h5):
+    with pytest.raises(ValueError):
+        create_frame_dataset(h5, 'frames', (24, 32), 0, 'bz2')
+
+
+def test_chunk_frames():
+    assert chunk_frames((24, 32)) == 16
+    assert chunk_frames((256, 320)) == 12
+    assert chunk_frames((1024, 1280)) == 4
+    assert chunk_frames((1024, 1280), itemsize=2) == 4
+    assert chunk_frames((256, 320), min_frames=1, max_frames=2) == 2
@@ -0,0 +1,72 @@
+import random
+
+import numpy as np
+import pytest
+
+from rig.clock import ClockSync, arduino_to_host, fit_clock, host_to_arduino
+
+OFFSET = 1.7e9      # Host time (s) of Arduino ts = 0
+
+
+def exchanges(drift, n=30, delays=(), seed=0):
+    '''(ts, send, receive) of pings every 2 s answered after ~1 ms each way.
+
+    `delays` maps ping numbers to extra s before the reply is read.
+    '''
+    rng = random.Random(seed)
+    delays = dict(delays)
+    samples = []
+    for i in range(n):
+        ts = 1000 + 2000 * i
+        t = OFFSET + ts / 1000. * (1 + drift * 1e-6)    # Host time when the Arduino answers
+        out = 0.001 + rng.uniform(0, 1e-4)
+        back = 0.001 + rng.uniform(0, 1e-4) + delays.get(i, 0)
+        samples.append((ts, t - out, t + back))
+    return samples
+
+
+@pytest.mark.parametrize('drift', [0., 50., -120.])
+def test_fit_recovers_offset_and_drift(drift):
+    fit = fit_clock(exchanges(drift))
+    assert fit['clock_offset'] == pytest.approx(OFFSET, abs=2e-4)
+    assert fit['clock_drift'] == pytest.approx(drift, abs=1)
+    assert fit['clock_rms'] < 0.1
+    assert fit['clock_rtt'] == pytest.approx(2, abs=0.2)
+
+
+def test_fit_ignores_delayed_replies():
+    # Replies read late (e.g. the reader was busy) would pull the midpoints up
+    samples = exchanges(20., delays={3: 0.05, 11: 0.2, 12: 0.1, 25: 0.03})
+    fit = fit_clock(samples)
+    assert fit['clock_offset'] == pytest.approx(OFFSET, abs=2e-4)
+    assert fit['clock_drift'] == pytest.approx(20, abs=1)
+    assert fit['clock_syncs'] <= 15
+
+
+def test_fit_needs_two_exchanges():
+    assert fit_clock([]) == {}
+    assert fit_clock(exchanges(0., n=1)) == {}
+
+
+def test_fit_same_ts():
+    # Pings answered within the same ms give no slope; offset only
+    samples = [(1000, OFFSET + 0.999, OFFSET + 1.001), (1000, OFFSET + 0.9995, OFFSET + 1.0015)]
+    fit = fit_clock(samples)
+    assert fit['clock_drift'] == 0
+    assert fit['clock_offset'] == pytest.approx(OFFSET, abs=1e-3)
+
+
+def test_host_arduino_round_trip():
+    attrs = fit_clock(exchanges(75.))
+    ts = np.array([0, 1234, 10 ** 7])
+    assert host_to_arduino(arduino_to_host(ts, attrs), attrs) == pytest.approx(ts, abs=1e-3)
+    assert arduino_to_host(60000, attrs) == pytest.approx(OFFSET + 60 * (1 + 75e-6), abs=2e-4)
+
+
+def test_echo_ignores_unknown_pings():
+    clock = ClockSync()
+    clock.sent = [OFFSET + 1, OFFSET + 3]
+    assert clock.echo([8, 1000, 0, OFFSET + 1.002]) == (1000, OFFSET + 1, OFFSET + 1.002)
+    assert clock.echo([8, 3000, 2, OFFSET + 5]) is None
+    assert clock.echo([8, 3000, -1, OFFSET + 5]) is None
+    assert len(clock.samples) == 1
@@ -0,0 +1,90 @@
+import threading
+import time
+
+from rig.dispatch import EventBatch, EventDispatcher, EventQueue
+
+
+def queue_of(*batches):
+    q = EventQueue()
+    for batch in batches:
+        q.put(EventBatch(batch))
+    return q
+
+
+def test_drain_yields_batches_in_order():
+    q = queue_of([[7, 10, 1], [7, 20, 2]], [[1, 30, 5]], [])
+    dispatcher = EventDispatcher(q)
+    assert list(dispatcher.drain()) == [[7, 10, 1], [7, 20, 2], [1, 30, 5]]
+    assert dispatcher.handled == 3
+    assert dispatcher.last_ts == 30
+
+
+def test_drain_accepts_single_events():
+    q = EventQueue()
+    q.put([7, 10, 1])
+    q.put(EventBatch([[7, 20, 2]]))
+    assert list(EventDispatcher(q).drain()) == [[7, 10, 1], [7, 20, 2]]
+
+
+def test_drain_stops_at_budget_and_resumes_mid_batch():
+    q = queue_of([[7, ts, 0] for ts in range(5)], [[7, 5, 0]])
+    dispatcher = EventDispatcher(q, budget=0)      # Deadline passes after one event
+    drained = []
+    for _ in range(6):
+        events = list(dispatcher.drain())
+        assert len(events) == 1
+        drained += events
+    assert [event[1] for event in drained] == list(range(6))
+    assert list(dispatcher.drain()) == []
+
+
+def test_drain_budget_limits_time():
+    q = queue_of([[7, ts, 0] for ts in range(1000)])
+    dispatcher = EventDispatcher(q, budget=20)
+    t0 = time.time()
+    n = 0
+    for _ in dispatcher.drain():
+        n += 1
+        time.sleep(0.005)
+    assert 2 <= n < 1000
+    assert time.time() - t0 < 0.2
+
+
+def test_drain_timeout_waits_for_first_event():
+    q = EventQueue()
+    dispatcher = EventDispatcher(q)
+    t0 = time.time()
+    assert list(dispatcher.drain(timeout=0.1)) == []
+    assert time.time() - t0 >= 0.09
+
+    timer = threading.Timer(0.05, q.put, [EventBatch([[7, 10, 1]])])
+    timer.start()
+    assert list(dispatcher.drain(timeout=2)) == [[7, 10, 1]]
+    timer.join()
+
+
+def test_clock_codes_set_last_ts():
+    q = queue_of([[7, 100, 1], [3, 5, 0], [7, 200, 1]])
+    dispatcher = EventDispatcher(q, clock_codes=[3])
+    list(dispatcher.drain())
+    assert dispatcher.last_ts == 5
+
+
+def test_stats():
+    dispatcher = EventDispatcher(queue_of([[7, 10, 1]] * 3))
+    list(dispatcher.drain())
+    stats = dispatcher.stats()
+    assert stats['events_handled'] == 3
+    dispatcher.reset()
+    assert dispatcher.handled == 0
+
+
+def test_depth_counts_events_not_batches():
+    q = queue_of([[7, ts, 0] for ts in range(50)], [[7, 50, 0]] * 30)
+    dispatcher = EventDispatcher(q, budget=0)
+    assert q.pending() == 80
+    list(dispatcher.drain())
+    assert dispatcher.depth == 79
+    assert dispatcher.max_depth == 79
+    q.clear()
+    assert q.pending() == 0
@@ -0,0 +1,86 @@
+import os
+import pty
+import time
+import tty
+
+import pytest
+import serial
+
+from rig.baud import BAUD_DEFAULT
+from rig.handshake import Handshake
+from rig.simulator import SimulatedArduino
+
+VALUES = [30000, 30000, 15, 10000, 60000, 0, 100, 50, 5]
+
+
+@pytest.fixture
+def board():
+    ''' Starts a SimulatedArduino; returns (sim, serial port opened on it) '''
+    opened = []
+
+    def open_board(**kwargs):
+        kwargs.setdefault('reset_delay', 0.05)
+        sim = SimulatedArduino(**kwargs)
+        sim.start()
+        ser = serial.Serial(sim.port, BAUD_DEFAULT, timeout=1)
+        opened.append((sim, ser))
+        return sim, ser
+
+    yield open_board
+    for sim, ser in opened:
+        ser.close()
+        sim.close()
+
+
+def test_handshake(board):
+    sim, ser = board()
+    text = []
+    handshake = Handshake(ser, VALUES, on_text=text.append)
+    assert handshake.run()
+    assert handshake.state == 'ready'
+    assert handshake.error is None
+    assert sim.parameters == VALUES
+    assert handshake.baudrate == sim.baudrate == 1000000
+    assert 'Baud: 1000000' in handshake.banner
+    assert set(handshake.times) == set(Handshake.STATES[:-1])
+    assert handshake.elapsed < 1
+    assert ser.timeout == 1
+    assert any('Paremeters processed' in line for line in text)
+
+
+def test_text_parameters(board):
+    sim, ser = board(param_block=False, max_baud=None)
+    handshake = Handshake(ser, VALUES)
+    assert handshake.run()
+    assert sim.parameters == VALUES
+    assert handshake.baudrate == BAUD_DEFAULT
+
+
+def test_banner_without_marker(board):
+    # Startup output goes quiet without the marker: upload at the default rate
+    sim, ser = board(banner='Other firmware v2', max_baud=None)
+    t0 = time.time()
+    handshake = Handshake(ser, VALUES, banner_timeout=5)
+    assert handshake.run()
+    assert time.time() - t0 < 1.5
+    assert handshake.banner == ''
+    assert sim.parameters == VALUES
+
+
+def test_silent_board():
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    ser = serial.Serial(os.ttyname(slave), BAUD_DEFAULT)
+    try:
+        handshake = Handshake(ser, VALUES, timeout=0.3, banner_timeout=0.1)
+        t0 = time.time()
+        assert not handshake.run()
+        assert time.time() - t0 < 1
+        assert handshake.state == 'ack'
+        assert 'Start prompt not found' in handshake.error
+        assert handshake.times['banner'] == pytest.approx(0.1, abs=0.05)
+        assert os.read(master, 100) == b'+'.join(str(v).encode('ascii') for v in VALUES) + b'\n'
+    finally:
+        ser.close()
+        os.close(master)
+        os.close(slave)
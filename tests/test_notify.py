@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from rig.notify import LocalBackend, SlackNotifier
+
+
+@pytest.fixture
+def notifier_for():
+    notifiers = []
+
+    def make(backend, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        notifier = SlackNotifier(backend, **kwargs)
+        notifiers.append(notifier)
+        return notifier
+
+    yield make
+    for notifier in notifiers:
+        notifier.close()
+
+
+def wait(message):
+    assert message.done.wait(5)
+    return message.status
+
+
+def test_send_does_not_block(notifier_for):
+    backend = LocalBackend(users=['ann'], delay=0.2)
+    notifier = notifier_for(backend)
+    t0 = time.time()
+    message = notifier.send('@ann', 'Session ended.')
+    assert time.time() - t0 < 0.1
+    assert wait(message) == 'sent'
+    assert backend.sent == [('@ann', 'Session ended.')]
+
+
+def test_retries_network_errors(notifier_for):
+    backend = LocalBackend(channels=['rig'], fail=2)
+    message = notifier_for(backend, retries=3).send('#rig', 'hi')
+    assert wait(message) == 'sent'
+    assert backend.calls == 4       # 2 failures, channel list, post
+
+
+def test_gives_up_after_retries_with_backoff(notifier_for):
+    backend = LocalBackend(users=['ann'], fail=10)
+    notifier = notifier_for(backend, retries=2, backoff=0.05)
+    t0 = time.time()
+    message = notifier.send('@ann', 'hi')
+    assert wait(message) == 'failed'
+    assert time.time() - t0 >= 0.05 + 0.1
+    assert backend.calls == 3
+    assert backend.sent == []
+
+
+def test_recipient_lists_are_cached(notifier_for):
+    backend = LocalBackend(users=['ann', 'bob'])
+    notifier = notifier_for(backend, cache_ttl=0.2)
+    for name in ('@ann', '@bob', '@ann'):
+        assert wait(notifier.send(name, 'hi')) == 'sent'
+    assert backend.calls == 1 + 3
+
+    time.sleep(0.25)
+    assert wait(notifier.send('@bob', 'hi')) == 'sent'
+    assert backend.calls == 1 + 3 + 2
+
+
+def test_invalid_recipients(notifier_for):
+    backend = LocalBackend(users=['ann'], channels=['rig'])
+    notifier = notifier_for(backend)
+    assert wait(notifier.send('ann', 'hi')) == 'invalid'
+    assert wait(notifier.send('@', 'hi')) == 'invalid'
+    assert wait(notifier.send('@nobody', 'hi')) == 'invalid'
+    assert wait(notifier.send('#rig', '')) == 'sent'       # Recipient check only
+    assert backend.sent == []
+
+
+def test_backend_factory_runs_on_notifier_thread(notifier_for):
+    made_on = []
+
+    def factory():
+        made_on.append(threading.current_thread())
+        return LocalBackend(users=['ann'])
+
+    notifier = notifier_for(factory)
+    assert wait(notifier.send('@ann', 'hi')) == 'sent'
+    assert made_on == [notifier]
+
+
+def test_close_delivers_queued_messages():
+    backend = LocalBackend(users=['ann'], delay=0.05)
+    notifier = SlackNotifier(backend)
+    messages = [notifier.send('@ann', str(i)) for i in range(3)]
+    notifier.close()
+    assert [message.status for message in messages] == ['sent'] * 3
+    assert not notifier.is_alive()
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from rig.plotting import SpanBar
+
+
+@pytest.fixture
+def bar():
+    fig = Figure(figsize=(4, 0.5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_xlim(0, 100)
+    bar = SpanBar(fig.canvas, ax)
+    bar.reset(10)
+    return bar
+
+
+def count_blits(bar):
+    blits = []
+    bar.canvas.blit = lambda bbox=None: blits.append(bbox)
+    return blits
+
+
+def test_reset_allocates_hidden_spans(bar):
+    assert len(bar.collection.get_paths()) == 10
+    assert not bar.collection.get_facecolor()[:, 3].any()
+    assert all((path.vertices[:, 0] == 0).all() for path in bar.paths)
+
+
+def test_add_fills_span_in_place(bar):
+    paths = bar.collection.get_paths()
+    bar.add(3, 10, 20, 'red')
+    assert bar.collection.get_paths() is paths
+    assert paths[3].vertices.tolist() == [[10, 0], [10, 1], [20, 1], [20, 0]]
+    assert bar.collection.get_facecolor()[3].tolist() == [1, 0, 0, 1]
+    assert not bar.collection.get_facecolor()[4].any()
+
+
+def test_blit_only_after_draw_and_changes(bar):
+    blits = count_blits(bar)
+    bar.add(0, 0, 5, 'blue')
+    bar.blit()
+    assert blits == []              # No background cached yet
+
+    bar.canvas.draw()
+    assert bar.background is not None
+    bar.blit()
+    assert blits == []              # Full draw already showed the span
+
+    bar.add(1, 5, 10, 'green')
+    bar.blit()
+    bar.blit()
+    assert len(blits) == 1
+
+
+def test_spans_are_drawn(bar):
+    bar.ax.set_axis_off()
+    bar.add(0, 0, 50, 'black')
+    bar.canvas.draw()
+    pixels = np.asarray(bar.canvas.buffer_rgba())
+    row = pixels[pixels.shape[0] // 2, :, :3].sum(axis=1)
+    left, right = row[:len(row) // 3], row[-len(row) // 4:]
+    assert (left == 0).any()
+    assert (right > 0).all()
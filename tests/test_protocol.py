@@ -0,0 +1,244 @@
+import random
+import threading
+
+import pytest
+
+from rig.protocol import (PARAM_VERSION, FrameDecoder, LineDecoder, LossCounter, decode_params,
+                          encode, encode_params, offered_params, offered_seq)
+
+# Conveyor DEFAULT_PARAMETERS, in upload order
+VALUES = [30000, 30000, 15, 10000, 60000, 0, 100, 50, 5]
+
+
+def sketch_crc16(crc, data):
+    # Bit-by-bit port of crc16() in the sketches
+    for byte in bytearray(data):
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+
+def make_events(n, seed=0):
+    rng = random.Random(seed)
+    return [(rng.choice([1, 7]), 1000 + 37 * i + rng.randint(0, 5), rng.randint(-20, 20)) for i in range(n)]
+
+
+def encode_all(events, seq=False):
+    seqs = {}
+    records = []
+    for code, ts, value in events:
+        records.append(encode(code, ts, value, seqs.get(code, 0) if seq else None))
+        seqs[code] = (seqs.get(code, 0) + 1) & 0xFF
+    return records
+
+
+def decode_all(decoder, chunks):
+    events = []
+    text = ''
+    for chunk in chunks:
+        decoded, chunk_text = decoder.decode(chunk)
+        events += [tuple(event) for event in decoded.tolist()]
+        text += chunk_text
+    return events, text
+
+
+# -- Event records -- #
+
+def test_frames_split_anywhere():
+    events = make_events(20)
+    data = b''.join(encode_all(events))
+    for cut in range(1, 25):
+        decoded, text = decode_all(FrameDecoder(), [data[:cut], data[cut:]])
+        assert decoded == events
+        assert text == ''
+
+
+def test_frames_byte_at_a_time():
+    events = make_events(5)
+    data = b''.join(encode_all(events))
+    decoded, _ = decode_all(FrameDecoder(), [data[i:i + 1] for i in range(len(data))])
+    assert decoded == events
+
+
+def test_frames_with_text():
+    events = make_events(6)
+    records = encode_all(events)
+    data = b'Session starting\r\n' + b''.join(records[:3]) + b'Trial over\r\n' + b''.join(records[3:])
+    decoded, text = decode_all(FrameDecoder(), [data[:40], data[40:]])
+    assert decoded == events
+    assert text == 'Session starting\r\nTrial over\r\n'
+
+
+@pytest.mark.parametrize('seq', [False, True])
+def test_frames_resync_after_garbled_record(seq):
+    events = make_events(30, seed=1)
+    records = encode_all(events, seq)
+    records[10] = records[10][:3] + bytearray([records[10][3] ^ 0x01]) + records[10][4:]
+    records[20] = records[20][:6]           # Truncated
+    loss = LossCounter()
+    decoder = FrameDecoder(seq, loss)
+    decoded, _ = decode_all(decoder, [b''.join(records)])
+    assert decoded == events[:10] + events[11:20] + events[21:]
+    assert decoder.bad_frames >= 2
+    assert loss.malformed == 2
+    if seq:
+        assert loss.totals()[:2] == (2, 0)
+
+
+def test_frames_equal_check_bytes():
+    # Records whose check bytes match start valid-looking candidates at the check byte
+    events = [(7, ts, 1) for ts in range(20)]
+    records = encode_all(events, seq=True)  # seq == ts, so checks are all 7 | 0x80 ^ 1
+    assert len(set(record[-1] for record in records)) == 1
+    decoded, _ = decode_all(FrameDecoder(seq=True), [b'x' + b''.join(records)])
+    assert decoded == events
+
+
+def test_lines_split_anywhere():
+    data = b'7,10,1;0\r\n1,12,5;0\r\n7,20,-1;1\r\n'
+    for cut in range(1, len(data)):
+        decoder = LineDecoder()
+        first, _ = decoder.decode(data[:cut])
+        second, _ = decoder.decode(data[cut:])
+        assert first + second == [[7, 10, 1], [1, 12, 5], [7, 20, -1]]
+
+
+# -- Parameter blocks -- #
+
+def test_params_round_trip():
+    block, crc = encode_params(VALUES)
+    assert decode_params(block) == (VALUES, crc)
+
+
+def test_params_layout():
+    block, crc = encode_params(VALUES)
+    assert block[:3] == b'P' + bytearray([PARAM_VERSION, len(VALUES)])
+    assert len(block) == 5 + 4 * len(VALUES)
+    assert block[-2:] == bytearray([crc & 0xFF, crc >> 8])
+
+
+def test_params_crc_matches_sketch():
+    # CRC-16/CCITT with init 0xFFFF: standard check value, then a fixed block
+    assert sketch_crc16(0xFFFF, b'123456789') == 0x29B1
+    block, crc = encode_params(VALUES)
+    assert crc == sketch_crc16(0xFFFF, block[:-2]) == 34487
+
+
+def test_params_corrupt_block_rejected():
+    block, _ = encode_params(VALUES)
+    for i in range(len(block)):
+        corrupt = bytearray(block)
+        corrupt[i] ^= 0x10
+        assert decode_params(corrupt) is None
+    assert decode_params(block[:-1]) is None
+
+
+@pytest.mark.parametrize('values', [[-1], [2 ** 32], [0] * 256])
+def test_params_out_of_range(values):
+    with pytest.raises(ValueError):
+        encode_params(values)
+
+
+def test_offered_params():
+    assert offered_params('Conveyor\nWaiting for parameters...\nBaud: 1000000\nParams: 1\n') == 1
+    assert offered_params('Conveyor\nWaiting for parameters...\n') is None
+
+
+# -- Sequence numbers -- #
+
+def loss_after(*batches):
+    loss = LossCounter()
+    for seqs in batches:
+        loss.add([7] * len(seqs), seqs)
+    return loss
+
+
+def test_loss_in_order():
+    assert loss_after([0, 1, 2, 3]).totals() == (0, 0, 0)
+
+
+def test_loss_gap():
+    loss = loss_after([0, 1, 4, 5])
+    assert loss.totals() == (2, 0, 0)
+    assert loss.received == {7: 4}
+
+
+def test_loss_wraps_at_255():
+    assert loss_after([253, 254, 255, 0, 1]).totals() == (0, 0, 0)
+    assert loss_after([250, 2]).totals() == (7, 0, 0)        # 251-255, 0, 1
+
+
+def test_loss_counts_across_batches():
+    assert loss_after([0, 1], [2, 3], [6]).totals() == (2, 0, 0)
+    assert loss_after([255], [1]).totals() == (1, 0, 0)
+
+
+def test_loss_repeat():
+    assert loss_after([0, 1, 1, 2]).totals() == (0, 1, 0)
+    assert loss_after([0, 1, 2], [0]).totals() == (0, 1, 0)
+
+
+def test_loss_gap_of_128_is_a_repeat():
+    # Up to 127 missing events count as lost; beyond that the number looks like it went back
+    assert loss_after([0, 128]).totals() == (127, 0, 0)
+    assert loss_after([0, 129]).totals() == (0, 1, 0)
+
+
+def test_loss_per_code():
+    loss = LossCounter()
+    loss.add([7, 1, 7, 1, 7], [0, 0, 1, 2, 3])
+    summary = loss.summary({7: 'track', 1: 'steps'})
+    assert summary['serial_lost'] == 2
+    assert summary['serial_lost_steps'] == 1
+    assert summary['serial_lost_track'] == 1
+    assert summary['serial_numbered'] == 5
+    assert loss.readout({7: 'track', 1: 'steps'}) == 'lost 2 (steps 1, track 1), repeated 0, malformed 0'
+
+
+def test_loss_reset():
+    loss = loss_after([0, 5])
+    loss.reset()
+    loss.add([7], [9])
+    assert loss.totals() == (0, 0, 0)
+
+
+def test_loss_summary_while_adding():
+    # New codes appear in every dict at once for readers on other threads
+    loss = LossCounter()
+
+    def reader():
+        while not done.is_set():
+            loss.summary()
+            loss.readout()
+
+    done = threading.Event()
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        for _ in range(200):
+            loss.reset()
+            for code in range(16):
+                loss.add([code], [0])
+    finally:
+        done.set()
+        thread.join()
+    assert loss.summary()['serial_numbered'] == 16
+
+
+def test_line_decoder_counts_loss():
+    loss = LossCounter()
+    decoder = LineDecoder(loss)
+    events, text = decoder.decode(b'7,10,1;0\r\n7,20,-1;2\r\nSession starting\r\n7,30\r\n0\r\n7,4')
+    assert events == [[7, 10, 1], [7, 20, -1], [7, 30]]
+    assert text == 'Session starting\n0\n'
+    assert loss.totals() == (1, 0, 1)       # Unnumbered "7,30" is accepted; lone "0" is malformed
+
+    events, _ = decoder.decode(b'0,5;3\r\n')
+    assert events == [[7, 40, 5]]
+    assert loss.totals() == (1, 0, 1)
+
+
+def test_offered_seq():
+    assert offered_seq('Conveyor\nWaiting for parameters...\nSeq: 1\n')
+    assert not offered_seq('Conveyor\nWaiting for parameters...\n')
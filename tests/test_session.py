@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+import h5py
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'conveyor'))
+from session import DEFAULT_PARAMETERS, Session, load_parameters, simulated_arduino
+
+SHORT = dict(DEFAULT_PARAMETERS, pre_session=200, post_session=200, trial_num=2,
+             trial_duration=300, iti=200, track_period=50)
+
+
+@pytest.fixture(params=[False, True], ids=['ascii', 'binary'])
+def rig(request):
+    sim = simulated_arduino(SHORT, binary=request.param)
+    sim.start()
+    session = Session(binary=request.param, latency=True)
+    assert session.open(sim.port, SHORT)
+    yield session
+    sim.close()
+
+
+def test_headless_session(rig, tmp_path):
+    filename = str(tmp_path / 'session.h5')
+    rig.start(filename)
+    rig.run(notes='test')
+    assert not rig.running
+
+    with h5py.File(filename, 'r') as f:
+        behavior = f['behavior']
+        assert behavior['trials'][...].tolist() == [200, 700]
+        assert behavior['rail_home'].shape == (2, )
+        assert behavior['track'].shape[1] == pytest.approx(1400 / 50, abs=1)
+        assert behavior.attrs['notes'] == 'test'
+        assert behavior.attrs['arduino_end'] >= 1400
+        assert behavior.attrs['trial_num'] == 2
+        assert behavior.attrs['baudrate'] == rig.baudrate
+        assert behavior.attrs['events_handled'] > 0
+
+
+def test_run_finishes_file_on_error(rig, tmp_path):
+    filename = str(tmp_path / 'session.h5')
+    rig.start(filename)
+
+    def fail(q_in):
+        raise RuntimeError('handler failed')
+    rig.handle = fail
+    with pytest.raises(RuntimeError):
+        rig.run()
+    assert rig.data_file is None
+
+    with h5py.File(filename, 'r') as f:
+        assert f['behavior/trials'].shape == (0, )
+        assert f['behavior'].attrs['arduino_end'] == -1
+
+
+def test_load_parameters(tmp_path):
+    filename = str(tmp_path / 'params.json')
+    with open(filename, 'w') as f:
+        json.dump({'trial_num': 3, 'iti': '5000'}, f)
+    parameters = load_parameters(filename)
+    assert list(parameters) == list(DEFAULT_PARAMETERS)
+    assert parameters['trial_num'] == 3
+    assert parameters['iti'] == 5000
+    assert parameters['pre_session'] == DEFAULT_PARAMETERS['pre_session']
+
+
+def test_load_parameters_rejects_unknown_keys(tmp_path):
+    filename = str(tmp_path / 'params.json')
+    with open(filename, 'w') as f:
+        json.dump({'trial_num': 3, 'trials': 4}, f)
+    with pytest.raises(ValueError, match='trials'):
+        load_parameters(filename)
@@ -0,0 +1,177 @@
+import threading
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from rig.storage import BehaviorWriter, GrowableArray, StorageError, StorageWorker
+
+
+@pytest.fixture
+def h5():
+    f = h5py.File('session.h5', 'w', driver='core', backing_store=False)
+    yield f
+    if f:
+        f.close()
+
+
+def behavior(h5, **kwargs):
+    writer = BehaviorWriter(h5.create_group('behavior'), **kwargs)
+    writer.create('trials', 'uint32')
+    writer.create('track', 'int32', rows=2)
+    return writer
+
+
+# -- Buffered writes -- #
+
+def test_writes_are_buffered_until_flush(h5):
+    writer = behavior(h5, flush_size=100)
+    for i in range(10):
+        writer.write('track', i, (i * 50, i - 5))
+    assert not h5['behavior/track'][...].any()
+
+    writer.flush()
+    assert h5['behavior/track'][:, :10].tolist() == [[i * 50 for i in range(10)], [i - 5 for i in range(10)]]
+
+
+def test_flush_size(h5):
+    writer = behavior(h5, flush_size=4)
+    for i in range(6):
+        writer.write('trials', i, i + 1)
+    assert h5['behavior/trials'][:6].tolist() == [1, 2, 3, 4, 0, 0]
+
+
+def test_non_contiguous_index_flushes_pending(h5):
+    writer = behavior(h5)
+    writer.write('trials', 0, 10)
+    writer.write('trials', 1, 11)
+    writer.write('trials', 5, 15)       # Gap: first two go out now
+    assert h5['behavior/trials'][:2].tolist() == [10, 11]
+    writer.write('trials', 1, 12)       # Rewrite
+    writer.flush()
+    assert h5['behavior/trials'][:6].tolist() == [10, 12, 0, 0, 0, 15]
+
+
+def test_poll_flushes_after_interval(h5):
+    writer = behavior(h5, flush_interval=0.05)
+    writer.write('trials', 0, 7)
+    writer.poll()
+    assert h5['behavior/trials'][0] == 0
+    time.sleep(0.06)
+    writer.poll()
+    assert h5['behavior/trials'][0] == 7
+
+
+def test_chunks(h5):
+    behavior(h5, chunk_size=512)
+    assert h5['behavior/trials'].chunks == (512, )
+    assert h5['behavior/track'].chunks == (2, 512)
+
+
+# -- Growth and trimming -- #
+
+def test_datasets_grow_geometrically(h5):
+    writer = behavior(h5, chunk_size=16, flush_size=8)
+    lengths = set()
+    for i in range(100):
+        writer.write('track', i, (i, -i))
+        writer.write('trials', i, i)
+        lengths.add(h5['behavior/track'].shape[1])
+    writer.flush()
+    assert sorted(lengths) == [16, 32, 64, 128]
+    assert h5['behavior/trials'].shape == (128, )
+    assert h5['behavior/track'][:, :100].tolist() == [list(range(100)), [-i for i in range(100)]]
+
+
+def test_trim_to_counters(h5):
+    writer = behavior(h5, chunk_size=16)
+    for i in range(20):
+        writer.write('trials', i, i)
+    writer.flush()
+    h5['behavior/trials'].resize((20, ))
+    h5['behavior/track'].resize((2, 0))
+    assert h5['behavior/trials'][...].tolist() == list(range(20))
+    assert h5['behavior/track'].shape == (2, 0)
+
+
+def test_growable_array():
+    a = GrowableArray('uint32', capacity=4)
+    for i in range(10):
+        a.append(i)
+    assert len(a) == 10
+    assert a.buffer.shape == (16, )
+    assert a.data.tolist() == list(range(10))
+
+
+def test_growable_array_rows():
+    a = GrowableArray('int32', rows=2, capacity=2)
+    assert a.data.shape == (2, 0)
+    for i in range(5):
+        a.append((i, -i))
+    assert a.data.tolist() == [[0, 1, 2, 3, 4], [0, -1, -2, -3, -4]]
+    assert a.buffer.shape == (2, 8)
+
+
+
+
+# -- Storage thread -- #
+
+@pytest.fixture
+def session_file(tmp_path):
+    return str(tmp_path / 'session.h5')
+
+
+def start_worker(filename, **kwargs):
+    data_file = h5py.File(filename, 'w')
+    worker = StorageWorker(data_file, behavior(data_file, **kwargs))
+    worker.start()
+    return worker
+
+
+def test_worker_writes_resizes_and_closes(session_file):
+    worker = start_worker(session_file, chunk_size=16)
+    for i in range(20):
+        worker.write('trials', i, i + 1)
+    worker.close(resize={'behavior/trials': (20, ), 'behavior/track': (2, 0)},
+                 attrs={'/': {'mouse': 'm1'}, 'behavior': {'n_trials': 20}})
+    assert not worker.is_alive()
+    assert not worker.data_file
+
+    with h5py.File(session_file, 'r') as f:
+        assert f['behavior/trials'][...].tolist() == list(range(1, 21))
+        assert f['behavior/track'].shape == (2, 0)
+        assert f.attrs['mouse'] == 'm1'
+        assert f['behavior'].attrs['n_trials'] == 20
+
+
+def test_worker_call_runs_on_storage_thread(session_file):
+    ran_on = []
+    worker = start_worker(session_file)
+    worker.call(lambda: ran_on.append(threading.current_thread()))
+    worker.close()
+    assert ran_on == [worker]
+
+
+def test_worker_flushes_when_idle(session_file):
+    worker = start_worker(session_file, flush_interval=0.05)
+    worker.write('trials', 0, 7)
+    seen = []
+    time.sleep(0.2)
+    worker.call(lambda: seen.append(worker.data_file['behavior/trials'][0]))
+    worker.close()
+    assert seen == [7]
+
+
+def test_worker_errors_raise_at_close(session_file):
+    worker = start_worker(session_file)
+    worker.write('missing', 0, 1)
+    worker.write('trials', 0, 5)
+    worker.call(lambda: 1 / 0)
+    with pytest.raises(StorageError) as info:
+        worker.close(resize={'behavior/trials': (1, )})
+    assert '2 storage operation(s) failed' in str(info.value)
+    assert isinstance(worker.error, KeyError)
+
+    with h5py.File(session_file, 'r') as f:
+        assert f['behavior/trials'][...].tolist() == [5]
@@ -0,0 +1,63 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'conveyor'))
+from session import DEFAULT_PARAMETERS
+from supervisor import default_save, load_rigs
+
+
+@pytest.fixture
+def config(tmp_path):
+    ''' Writes a supervisor config (and any parameter files) and returns its path '''
+    def write(rigs, params_files=None, **kwargs):
+        for name, values in (params_files or {}).items():
+            with open(str(tmp_path / name), 'w') as f:
+                json.dump(values, f)
+        filename = str(tmp_path / 'rigs.json')
+        with open(filename, 'w') as f:
+            json.dump(dict(kwargs, rigs=rigs), f)
+        return filename
+    return write
+
+
+def test_load_rigs(config):
+    rigs = load_rigs(config([
+        {'name': 'box1', 'port': 'COM3', 'params': 'day1.json'},
+        {'name': 'box2', 'port': 'COM4', 'params': {'trial_num': 20}, 'save': 'b2.h5', 'binary': True},
+        {'name': 'box3', 'port': 'COM5'},
+    ], {'day1.json': {'iti': 5000}}, save='{name}.h5'))
+
+    assert [rig.name for rig in rigs] == ['box1', 'box2', 'box3']
+    assert [rig.port for rig in rigs] == ['COM3', 'COM4', 'COM5']
+    assert rigs[0].parameters['iti'] == 5000
+    assert rigs[1].parameters['trial_num'] == 20
+    assert rigs[2].parameters == DEFAULT_PARAMETERS
+    assert list(rigs[1].parameters) == list(DEFAULT_PARAMETERS)
+    assert [rig.save for rig in rigs] == ['{name}.h5', 'b2.h5', '{name}.h5']
+    assert [rig.session.binary for rig in rigs] == [False, True, False]
+
+
+def test_default_save(config):
+    rig, = load_rigs(config([{'name': 'box1', 'port': 'COM3'}]))
+    assert rig.save == default_save
+
+
+def test_port_required_unless_simulated(config):
+    filename = config([{'name': 'box1'}])
+    with pytest.raises(ValueError, match='box1'):
+        load_rigs(filename)
+    rig, = load_rigs(filename, simulate=True)
+    assert rig.port is None and rig.simulate
+
+
+def test_duplicate_names(config):
+    with pytest.raises(ValueError, match='unique'):
+        load_rigs(config([{'name': 'box1', 'port': 'COM3'}, {'name': 'box1', 'port': 'COM4'}]))
+
+
+def test_bad_parameter_file(config):
+    with pytest.raises(ValueError, match='trials'):
+        load_rigs(config([{'name': 'box1', 'port': 'COM3', 'params': 'p.json'}], {'p.json': {'trials': 3}}))